@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Compare the audio remapping graphs built by plan_audio_layout with the
+# former pan+amerge graphs: number of filter nodes, planning time with and
+# without memoization and, if ffmpeg is available, ffmpeg run time on a
+# synthetic wide-channel source.
+#
+# usage: bench/audio_layout.py [iterations] [duration]
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from toolbox2.worker import ffmpeg
+
+
+# (description, input layout, channels_per_stream)
+LAYOUTS = [
+    ('16 mono -> 2x8', tuple([(i + 1, 1) for i in range(16)]), 8),
+    ('8 mono -> 1x8', tuple([(i + 1, 1) for i in range(8)]), 8),
+    ('1x8 -> 8 mono', ((1, 8), ), 1),
+    ('2x8 -> 8 stereo', ((1, 8), (2, 8)), 2),
+    ('4 stereo -> 1x8', tuple([(i + 1, 2) for i in range(4)]), 8),
+]
+
+
+def legacy_plan(layout, channels_per_stream):
+    o_streams = ffmpeg._group_audio_channels(layout, channels_per_stream)
+    nb_channels = dict(layout)
+    filter_chain = ''
+    map_chain = []
+    for index, input_channels in enumerate(o_streams):
+        streams = set([stream for stream, _ in input_channels])
+        if len(streams) == 1 and nb_channels[input_channels[0][0]] == len(input_channels):
+            map_chain.append(('-map', '0:%s' % input_channels[0][0]))
+            continue
+        filter_merge = ''
+        for stream, channel in input_channels:
+            filter_chain += '[0:%s]pan=mono:c0=c%s[p%s_%s];' % (stream, channel, stream, channel)
+            filter_merge += '[p%s_%s]' % (stream, channel)
+        if len(input_channels) > 1:
+            filter_chain += '%samerge=inputs=%s[m%s];' % (filter_merge, len(input_channels), index)
+            map_chain.append(('-map', '[m%s]' % index))
+        else:
+            map_chain.append(('-map', filter_merge))
+    return filter_chain.rstrip(';'), map_chain
+
+
+def new_plan(layout, channels_per_stream):
+    ffmpeg._audio_layout_plans.clear()
+    return cached_plan(layout, channels_per_stream)
+
+
+def cached_plan(layout, channels_per_stream):
+    plan = ffmpeg.plan_audio_layout(layout, channels_per_stream, None)
+    return plan[0].rstrip(';'), list(plan[1])
+
+
+def count_nodes(filter_chain):
+    if not filter_chain:
+        return 0
+    return len(filter_chain.split(';'))
+
+
+def measure_planning(func, layout, channels_per_stream, iterations):
+    start = time.time()
+    for _ in range(iterations):
+        func(layout, channels_per_stream)
+    return (time.time() - start) / iterations * 1000000
+
+
+def make_source(path, layout, duration):
+    args = ['ffmpeg', '-y', '-v', 'error']
+    for _ in layout:
+        args += ['-f', 'lavfi', '-i', 'sine=frequency=1000:sample_rate=48000:duration=%s' % duration]
+    # Layouts number audio streams from 1, the video stream is mapped first
+    args += ['-f', 'lavfi', '-i', 'color=size=16x16:duration=%s' % duration]
+    maps = ['-map', '%s:v' % len(layout)]
+    filters = []
+    for index, (_, channels) in enumerate(layout):
+        if channels > 1:
+            filters.append('[%s:a]aformat=channel_layouts=mono,asplit=%s%s;%samerge=inputs=%s[a%s]' % (
+                index, channels, ''.join(['[s%s_%s]' % (index, c) for c in range(channels)]),
+                ''.join(['[s%s_%s]' % (index, c) for c in range(channels)]), channels, index))
+            maps += ['-map', '[a%s]' % index]
+        else:
+            maps += ['-map', '%s:a' % index]
+    if filters:
+        args += ['-filter_complex', ';'.join(filters)]
+    args += maps + ['-c:v', 'rawvideo', '-c:a', 'pcm_s24le', path]
+    subprocess.check_call(args)
+
+
+def measure_ffmpeg(path, filter_chain, map_chain):
+    args = ['ffmpeg', '-y', '-v', 'error', '-i', path]
+    if filter_chain:
+        args += ['-filter_complex', filter_chain]
+    for option in map_chain:
+        args += list(option)
+    args += ['-c:a', 'pcm_s24le', '-f', 'null', '-']
+    start = time.time()
+    subprocess.check_call(args)
+    return time.time() - start
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    duration = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    has_ffmpeg = find_executable('ffmpeg') is not None
+    tmp_dir = tempfile.mkdtemp()
+
+    print '%-18s %12s %12s %14s %14s %14s %12s %12s' % (
+        'layout', 'legacy nodes', 'nodes', 'legacy plan us', 'plan us', 'cached plan us', 'legacy run s', 'run s')
+    try:
+        for index, (description, layout, channels_per_stream) in enumerate(LAYOUTS):
+            legacy = legacy_plan(layout, channels_per_stream)
+            new = new_plan(layout, channels_per_stream)
+            legacy_us = measure_planning(legacy_plan, layout, channels_per_stream, iterations)
+            new_us = measure_planning(new_plan, layout, channels_per_stream, iterations)
+            cached_us = measure_planning(cached_plan, layout, channels_per_stream, iterations)
+
+            legacy_run = new_run = float('nan')
+            if has_ffmpeg:
+                path = os.path.join(tmp_dir, 'source%s.mov' % index)
+                make_source(path, layout, duration)
+                legacy_run = measure_ffmpeg(path, *legacy)
+                new_run = measure_ffmpeg(path, *new)
+
+            print '%-18s %12d %12d %14.1f %14.1f %14.1f %12.2f %12.2f' % (
+                description, count_nodes(legacy[0]), count_nodes(new[0]),
+                legacy_us, new_us, cached_us, legacy_run, new_run)
+    finally:
+        shutil.rmtree(tmp_dir, True)
+
+    if not has_ffmpeg:
+        print 'ffmpeg not found, run times were not measured'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Measure the latency of Command.run + Command.wait for a short lived
+# child process with the popen and spawn launchers, for increasing
+# resident set sizes of the supervising process.
+#
+# usage: bench/spawn_latency.py [iterations] [rss_mb,rss_mb,...]
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from toolbox2 import posix
+from toolbox2.command import Command
+
+
+def get_rss():
+    with open('/proc/self/statm') as fileobj:
+        pages = int(fileobj.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def measure(launcher, iterations, base_dir):
+    command = Command(base_dir)
+    command.launcher = launcher
+    command.memory_limit = 512 * 1024 * 1024
+    start = time.time()
+    for _ in range(iterations):
+        command.run(['true'])
+        command.wait()
+    return (time.time() - start) / iterations * 1000
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    sizes = [int(x) for x in (sys.argv[2] if len(sys.argv) > 2 else '0,256,1024').split(',')]
+    base_dir = tempfile.mkdtemp()
+
+    launchers = ['popen']
+    if posix.spawn_available():
+        launchers.append('spawn')
+
+    print '%10s %10s %s' % ('rss (MB)', 'launcher', 'latency (ms)')
+    ballast = []
+    for size in sizes:
+        # Touch every page so it is really resident
+        ballast.append(bytearray(max(size - get_rss(), 0) * 1024 * 1024))
+        for launcher in launchers:
+            latency = measure(launcher, iterations, base_dir)
+            print '%10d %10s %.3f' % (get_rss(), launcher, latency)
+
+    os.rmdir(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from toolbox2.agent import Agent
+from toolbox2.command import CommandException
+from toolbox2.executor import AgentExecutor
+
+log = logging.getLogger('toolbox2.test_agent')
+log.addHandler(logging.NullHandler())
+
+
+class AgentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmp_dir, 'agent.sock')
+        self.agent = Agent(log, self.address, 2, tools={'sh': '/bin/sh'})
+        self.agent.bind()
+        self.thread = threading.Thread(target=self.agent.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.executor = AgentExecutor(self.address)
+
+    def tearDown(self):
+        self.agent.shutdown()
+        self.thread.join(5)
+        shutil.rmtree(self.tmp_dir, True)
+
+    def run_command(self, args):
+        command = self.executor.create_command(self.tmp_dir)
+        command.set_timeout(0.1)
+        command.run(args)
+        return command
+
+    def wait(self, command):
+        output = []
+        command.wait(lambda stdout, stderr: output.append((stdout, stderr)))
+        stdout = ''.join([stdout for stdout, _ in output])
+        stderr = ''.join([stderr for _, stderr in output])
+        return command.process.returncode, stdout, stderr
+
+    def test_output_is_streamed(self):
+        command = self.run_command(['sh', '-c', 'echo out; echo err >&2; pwd'])
+        returncode, stdout, stderr = self.wait(command)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, 'out\n%s\n' % os.path.realpath(self.tmp_dir))
+        self.assertEqual(stderr, 'err\n')
+
+    def test_exit_code_is_propagated(self):
+        command = self.run_command(['sh', '-c', 'exit 3'])
+        self.assertEqual(self.wait(command)[0], 3)
+
+    def test_kill(self):
+        command = self.run_command(['sh', '-c', 'sleep 30'])
+        started_at = time.time()
+        command.process.kill()
+        self.assertNotEqual(command.process.wait(), 0)
+        self.assertTrue(time.time() - started_at < 10)
+
+    def test_unconfigured_tool_is_rejected(self):
+        self.assertRaises(CommandException, self.run_command, ['rm', '-rf', self.tmp_dir])
+        self.assertTrue(os.path.isdir(self.tmp_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
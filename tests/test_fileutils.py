@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from toolbox2 import fileutils
+from toolbox2.fileutils import copy_file, clone_file
+from toolbox2.iosched import TokenBucket
+
+
+class CopyFileTest(unittest.TestCase):
+
+    size = 3 * 1024 * 1024
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'src.bin')
+        with open(self.src, 'wb') as fileobj:
+            fileobj.write(os.urandom(self.size))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def read(self, path):
+        with open(path, 'rb') as fileobj:
+            return fileobj.read()
+
+    def test_copy_without_budget(self):
+        dst = os.path.join(self.tmp_dir, 'dst.bin')
+        copy_file(self.src, dst)
+        self.assertEqual(self.read(self.src), self.read(dst))
+
+    def test_budget_slows_copy(self):
+        # The first second of budget is available at once
+        throttle = TokenBucket(1024 * 1024)
+        dst = os.path.join(self.tmp_dir, 'dst.bin')
+        started_at = time.time()
+        copy_file(self.src, dst, throttle)
+        self.assertTrue(time.time() - started_at >= 1.5)
+        self.assertEqual(self.read(self.src), self.read(dst))
+        self.assertEqual(throttle.get_summary()['copied_bytes'], self.size)
+
+    def test_clone_regular_copy_uses_budget(self):
+        # Fail reflinks, so that the regular copy is used on any filesystem
+        def ioctl(fd, request, arg=0):
+            raise IOError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+        throttle = TokenBucket(1024 * 1024)
+        dst = os.path.join(self.tmp_dir, 'dst.bin')
+        started_at = time.time()
+        saved_ioctl = fcntl.ioctl
+        fileutils.fcntl.ioctl = ioctl
+        try:
+            clone_file(self.src, dst, hardlink=False, throttle=throttle)
+        finally:
+            fileutils.fcntl.ioctl = saved_ioctl
+        self.assertTrue(time.time() - started_at >= 1.5)
+        self.assertEqual(self.read(self.src), self.read(dst))
+        self.assertEqual(throttle.get_summary()['copied_bytes'], self.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
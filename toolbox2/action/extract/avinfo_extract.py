@@ -3,13 +3,32 @@
 import os
 import os.path
 import re
-
-from toolbox2.action import Action, ActionException
-from toolbox2.worker.ffprobe import FFprobeWorker
+import zlib
+import base64
+import Queue
+import tempfile
+import threading
+import ConfigParser
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from toolbox2.action import Action, ActionException, get_config
+from toolbox2.command import CommandException
+from toolbox2.exception import Toolbox2Exception
+from toolbox2.fileutils import clone_file, get_file_identity
+from toolbox2.worker.ffprobe import FFprobeWorker, FFprobeIndexWorker
 from toolbox2.worker.ffmpeg import FFmpegWorker
 
 
-class AVInfo(object):
+class BaseAVInfo(object):
+    """
+    Resolution and frame rate checks shared by AVInfo representations.
+    """
+
+    __slots__ = ()
 
     RES_SD_PAL      = '720x576'
     RES_SD_PAL_VBI  = '720x608'
@@ -23,6 +42,27 @@ class AVInfo(object):
     FPS_NTSC        = [29.97, 30, 59.94, 60]
     FPS_FILM        = [23.97, 23.98, 24]
 
+    def video_has_VBI(self):
+        return self.video_has_vbi
+
+    def video_is_SD_PAL(self):
+        return self.video_res in [self.RES_SD_PAL, self.RES_SD_PAL_VBI]
+
+    def video_is_SD_NTSC(self):
+        return self.video_res in [self.RES_SD_NTSC, self.RES_SD_NTSC_VBI]
+
+    def video_is_HD(self):
+        return self.video_res in [self.RES_HD, self.RES_HD_1280, self.RES_HD_1440]
+
+    def video_is_SD(self):
+        return not self.video_is_HD()
+
+    def __repr__(self):
+        return '%s (video_res=%s, video_has_vbi=%s, timecode=%s)' % (self.__class__.__name__, self.video_res, self.video_has_vbi, self.timecode)
+
+
+class AVInfo(BaseAVInfo):
+
     def __init__(self, data):
         self.data = data
         self.audio_format = None
@@ -30,6 +70,7 @@ class AVInfo(object):
         self.video_has_vbi = False
         self.video_fps = 0
         self.video_dar = 0
+        self.duration = 0
         self.timecode = '00:00:00:00'
         self.video_streams = []
         self.audio_streams = []
@@ -49,6 +90,7 @@ class AVInfo(object):
         self._init_dar()
         self._init_timecode()
         self._init_audio_format()
+        self._init_duration()
 
     def _init_res(self):
         if self.video_streams:
@@ -98,29 +140,346 @@ class AVInfo(object):
         if match:
             self.audio_format = match.groups()[0]
 
-    def video_has_VBI(self):
-        return self.video_has_vbi
+    def _init_duration(self):
+        try:
+            self.duration = float(self.format.get('duration', 0))
+        except ValueError:
+            self.duration = 0
 
-    def video_is_SD_PAL(self):
-        return self.video_res in [self.RES_SD_PAL, self.RES_SD_PAL_VBI]
 
-    def video_is_SD_NTSC(self):
-        return self.video_res in [self.RES_SD_NTSC, self.RES_SD_NTSC_VBI]
+class CompactFields(object):
+    """
+    Typed fields of an ffprobe section, stored in slots instead of a dict.
+    Fields can still be read like dict items, missing ones raise KeyError.
+    """
 
-    def video_is_HD(self):
-        return self.video_res in [self.RES_HD, self.RES_HD_1280, self.RES_HD_1440]
+    __slots__ = ()
+
+    # Field name and type, in serialization order
+    fields = ()
+
+    def __init__(self, data=None):
+        data = data or {}
+        for name, _type in self.fields:
+            value = data.get(name)
+            if value is not None:
+                try:
+                    value = _type(value)
+                except (TypeError, ValueError):
+                    value = None
+            if isinstance(value, str):
+                # Codec and format names are repeated in most instances
+                value = intern(value)
+            setattr(self, name, value)
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        data = {}
+        for name, _ in self.fields:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        return data
+
+    def to_list(self):
+        return [getattr(self, name) for name, _ in self.fields]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(dict(zip([name for name, _ in cls.fields], values)))
+
+    def __getstate__(self):
+        return self.to_list()
+
+    def __setstate__(self, state):
+        for (name, _), value in zip(self.fields, state):
+            setattr(self, name, value)
+
+
+def _str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class CompactStream(CompactFields):
+
+    fields = (
+        ('index', int),
+        ('codec_type', _str),
+        ('codec_name', _str),
+        ('pix_fmt', _str),
+        ('width', int),
+        ('height', int),
+        ('field_order', _str),
+        ('has_b_frames', int),
+        ('sample_rate', int),
+        ('channels', int),
+        ('bit_rate', int),
+        ('duration', float),
+        ('nb_frames', int),
+        ('nb_read_packets', int),
+    )
+    __slots__ = tuple([name for name, _ in fields])
+
+
+class CompactFormat(CompactFields):
+
+    fields = (
+        ('format_name', _str),
+        ('start_time', float),
+        ('duration', float),
+        ('size', int),
+        ('bit_rate', int),
+        ('nb_streams', int),
+    )
+    __slots__ = tuple([name for name, _ in fields])
+
+
+class CompactAVInfo(BaseAVInfo):
+    """
+    Memory efficient AVInfo, for applications keeping many of them. Only
+    fields used by actions are kept, in slots with typed values, and raw
+    ffprobe output is dropped unless requested. Instances are serialized
+    to a compact json form with dumps and loads.
+    """
 
-    def video_is_SD(self):
-        return not self.video_is_HD()
+    __slots__ = ('audio_format', 'video_width', 'video_height', 'video_has_vbi', 'video_fps', 'video_dar',
+                 'duration', 'timecode', 'format', 'video_streams', 'audio_streams', 'data_streams', '_raw')
 
-    def __repr__(self):
-        return 'AVInfo (video_res=%s, video_has_vbi=%s, timecode=%s)' % (self.video_res, self.video_has_vbi, self.timecode)
+    version = 1
+
+    def __init__(self, data=None, keep_raw=False):
+        """
+        :param data: ffprobe output, as returned by FFprobeWorker
+        :type data: dict
+
+        :param keep_raw: keep ffprobe output compressed, returned by
+                         get_data
+        :type keep_raw: bool
+        """
+        self._raw = None
+        if data is None:
+            return
+
+        avinfo = AVInfo(data)
+        self.audio_format = avinfo.audio_format and intern(_str(avinfo.audio_format))
+        self.video_width, self.video_height = 0, 0
+        if avinfo.video_streams:
+            self.video_width = int(avinfo.video_streams[0]['width'])
+            self.video_height = int(avinfo.video_streams[0]['height'])
+        self.video_has_vbi = avinfo.video_has_vbi
+        self.video_fps = avinfo.video_fps
+        self.video_dar = avinfo.video_dar and intern(_str(avinfo.video_dar))
+        self.duration = avinfo.duration
+        self.timecode = _str(avinfo.timecode)
+        self.format = CompactFormat(avinfo.format)
+        self.video_streams = tuple([CompactStream(stream) for stream in avinfo.video_streams])
+        self.audio_streams = tuple([CompactStream(stream) for stream in avinfo.audio_streams])
+        self.data_streams = tuple([CompactStream(stream) for stream in avinfo.data_streams])
+        if keep_raw:
+            self._raw = zlib.compress(json.dumps(data, separators=(',', ':')))
+
+    @property
+    def video_res(self):
+        if not self.video_width:
+            return None
+        return '%sx%s' % (self.video_width, self.video_height)
+
+    def get_data(self):
+        """
+        Return ffprobe output if it has been kept, None otherwise.
+        """
+        if self._raw is None:
+            return None
+        return json.loads(zlib.decompress(self._raw))
+
+    def __getstate__(self):
+        return json.loads(self.dumps())
+
+    def __setstate__(self, state):
+        self._load(state)
+
+    def dumps(self):
+        """
+        Serialize to a json string, fields are stored as lists of values.
+        """
+        state = [
+            self.version,
+            [self.audio_format, self.video_width, self.video_height, self.video_has_vbi, self.video_fps,
+             self.video_dar, self.duration, self.timecode],
+            self.format.to_list(),
+            [[stream.to_list() for stream in streams]
+             for streams in [self.video_streams, self.audio_streams, self.data_streams]],
+            self._raw and base64.b64encode(self._raw),
+        ]
+        return json.dumps(state, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, buf):
+        """
+        Return an instance serialized by dumps.
+        """
+        avinfo = cls()
+        try:
+            avinfo._load(json.loads(buf))
+        except (ValueError, TypeError, IndexError), exc:
+            raise AVInfoActionException('Invalid serialized AVInfo: %s' % exc)
+        return avinfo
+
+    def _load(self, state):
+        version, fields, format_values, streams, raw = state
+        if version != self.version:
+            raise ValueError('unsupported version %s' % version)
+        (self.audio_format, self.video_width, self.video_height, self.video_has_vbi, self.video_fps,
+         self.video_dar, self.duration, self.timecode) = [isinstance(value, unicode) and _str(value) or value
+                                                          for value in fields]
+        self.format = CompactFormat.from_list(format_values)
+        self.video_streams, self.audio_streams, self.data_streams = [
+            tuple([CompactStream.from_list(values) for values in stream_values]) for stream_values in streams]
+        self._raw = raw and base64.b64decode(raw)
 
 
 class AVInfoActionException(ActionException):
     pass
 
 
+PROBE_DEFAULT_CONCURRENCY = 4
+
+
+def _new_probe_worker(log, conf):
+    worker = FFprobeWorker(log)
+    for section, option, attribute in [('tools', 'ffprobe', 'tool'), ('process', 'launcher', 'launcher')]:
+        try:
+            if conf:
+                setattr(worker, attribute, conf.get(section, option))
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            pass
+    return worker
+
+
+def probe_files(log, paths, concurrency=PROBE_DEFAULT_CONCURRENCY, base_dir=None, count_packets=False,
+                compact=False, profile='transcode'):
+    """
+    Probe media files with ffprobe, running at most concurrency processes
+    at the same time, and yield results as they complete. Unlike
+    AVInfoAction, no working directory is created per file. Paths are
+    consumed as processes become available, so that paths may be a long
+    running iterator.
+
+        for path, avinfo, error in probe_files(log, paths):
+            ...
+
+    :param paths: paths of files to probe
+    :type paths: iterable
+
+    :param base_dir: working directory of ffprobe processes, a temporary
+                     directory by default
+    :type base_dir: string
+
+    :param count_packets: count packets of each stream, which reads whole
+                          files
+    :type count_packets: bool
+
+    :param compact: yield CompactAVInfo instead of AVInfo
+    :type compact: bool
+
+    :param profile: probe profile: minimal, transcode or full
+    :type profile: string
+
+    :return: path, AVInfo and None, or path, None and the exception raised
+             while probing it
+    :rtype: generator of tuples
+    """
+    base_dir = base_dir or tempfile.gettempdir()
+    conf = None
+    try:
+        conf = get_config()
+    except (IOError, OSError, ConfigParser.Error), exc:
+        log.warning('Using default ffprobe: %s', exc)
+
+    pending = Queue.Queue(concurrency)
+    results = Queue.Queue()
+    stop_event = threading.Event()
+
+    def probe(path):
+        worker = _new_probe_worker(log, conf)
+        worker.set_profile(profile)
+        worker.add_input_file(path)
+        if count_packets:
+            worker.count_packets()
+        worker.run(base_dir)
+        try:
+            worker.wait()
+        finally:
+            worker.kill()
+        if compact:
+            return CompactAVInfo(worker.metadata)
+        return AVInfo(worker.metadata)
+
+    def run():
+        while True:
+            path = pending.get()
+            if path is None:
+                break
+            if stop_event.isSet():
+                continue
+            try:
+                results.put((path, probe(path), None))
+            except (Toolbox2Exception, CommandException, EnvironmentError, KeyError, ValueError), exc:
+                results.put((path, None, exc))
+            except Exception, exc:
+                log.exception('Probe of %s failed', path)
+                results.put((path, None, exc))
+
+    threads = []
+    for _ in range(concurrency):
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    nb_pending = 0
+    try:
+        for path in paths:
+            pending.put(path)
+            nb_pending += 1
+            # Yield completed results while feeding paths
+            while True:
+                try:
+                    result = results.get_nowait()
+                except Queue.Empty:
+                    break
+                nb_pending -= 1
+                yield result
+
+        while nb_pending > 0:
+            nb_pending -= 1
+            yield results.get()
+    finally:
+        # Paths still queued are dropped if the caller stops early, probes
+        # in progress complete
+        stop_event.set()
+        for thread in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+
+
 class AVInfoAction(Action):
     """
     Extract audio/video information from media files using ffprobe/ffmpeg.
@@ -131,6 +490,7 @@ class AVInfoAction(Action):
     category = 'extract'
     description = 'audio/video information extract tool'
     required_params = {}
+    tools = ['ffprobe', 'ffmpeg']
 
     def __init__(self, log, base_dir, _id, params=None, resources=None):
         Action.__init__(self, log, base_dir, _id, params, resources)
@@ -138,7 +498,9 @@ class AVInfoAction(Action):
         self.thumbnail = None
         self.probe_worker = None
         self.probe2_worker = None
+        self.index_worker = None
         self.ffmpeg_worker = None
+        self.index = None
 
         if not os.path.isdir(self.tmp_dir):
             os.makedirs(self.tmp_dir)
@@ -146,6 +508,10 @@ class AVInfoAction(Action):
         self.do_thumbnail = self.params.get('thumbnail', False)
         self.do_count_frames = self.params.get('count_frames', False)
         self.do_count_packets = self.params.get('count_packets', False)
+        self.do_build_index = self.params.get('build_index', False)
+        self.compact = self.params.get('compact', False)
+        self.probe_profile = self.params.get('probe_profile', 'full')
+        self.probe_description = self.params.get('probe_description')
 
         self.thumbnail_options = {
             'width': int(self.params.get('thumbnail_width', 0)),
@@ -154,9 +520,45 @@ class AVInfoAction(Action):
     def _setup(self):
         self.input_file = self.get_input_resource(1).get('path')
         self.thumbnail = os.path.join(self.tmp_dir, 'thumbnail.jpg')
+        self.index_path = os.path.join(self.tmp_dir, 'index.bin')
+
+    def _build_index(self, avinfo, callback=None):
+        """
+        Get the packet index of the first video stream from the index cache,
+        or build it with a single ffprobe pass and store it in the cache.
+        """
+        cache = self._get_index_cache()
+        key = None
+        if cache:
+            key = cache.get_key(self.input_file)
+            index_path = key and cache.get_index_path(key)
+            if index_path:
+                self.index = cache.load(key)
+                if self.index:
+                    self.log.info('Packet index of %s found in cache', self.input_file)
+                    clone_file(index_path, self.index_path, throttle=self.io_budget)
+                    return
+
+        self.index_worker = self._new_worker(FFprobeIndexWorker)
+        self.index_worker.add_input_file(self.input_file)
+        self.index_worker.set_duration(avinfo.duration)
+        self.workers.append(self.index_worker)
+        self.worker_idx = len(self.workers) - 1
+        self._execute_current_worker(callback)
+
+        self.index = self.index_worker.index
+        self.index.header.update({
+            'source': os.path.realpath(self.input_file),
+            'identity': get_file_identity(self.input_file),
+            'codec_name': avinfo.video_streams[0].get('codec_name'),
+        })
+        self.index.save(self.index_path)
+        if cache and key:
+            cache.store(key, self.index_path, self.input_file)
 
     def _execute(self, callback=None):
         self.probe_worker = self._new_worker(FFprobeWorker)
+        self.probe_worker.set_profile(self.probe_profile, self.probe_description)
         self.probe_worker.add_input_file(self.input_file)
         self.workers.append(self.probe_worker)
         self.worker_idx = 0
@@ -173,13 +575,28 @@ class AVInfoAction(Action):
             self.ffmpeg_worker.make_thumbnail(self.thumbnail_options)
 
             self.workers.append(self.ffmpeg_worker)
-            self.worker_idx = 1
+            self.worker_idx = len(self.workers) - 1
             self._execute_current_worker(callback)
             self.update_metadata({'thumbnail': self.thumbnail})
             self.add_output_resource('thumbnail', self.thumbnail)
 
+        if has_video_streams and self.do_build_index:
+            self._build_index(avinfo, callback)
+            index_metadata = self.index.get_summary()
+            index_metadata['path'] = self.index_path
+            self.update_metadata({'index': index_metadata})
+            self.add_output_resource('index', {'path': self.index_path})
+
+            # Packets do not need to be read again to be counted
+            if self.do_count_packets:
+                self.probe_worker.metadata['streams'][avinfo.video_streams[0]['index']]['nb_read_packets'] = \
+                    str(self.index.get_frame_count())
+                self.update_metadata(self.probe_worker.metadata)
+                self.do_count_packets = False
+
         if has_video_streams and (self.do_count_frames or self.do_count_packets):
             self.probe2_worker = self._new_worker(FFprobeWorker)
+            self.probe2_worker.set_profile(self.probe_profile, self.probe_description)
             self.probe2_worker.add_input_file(self.input_file)
             if self.do_count_packets:
                 self.probe2_worker.count_packets()
@@ -187,8 +604,7 @@ class AVInfoAction(Action):
                 self.probe2_worker.count_frames()
 
             self.workers.append(self.probe2_worker)
-            self.worker_idx = 2
-            self.workers.append(self.probe2_worker)
+            self.worker_idx = len(self.workers) - 1
             self._execute_current_worker(callback)
             self.update_metadata(self.probe2_worker.metadata)
 
@@ -200,4 +616,6 @@ class AVInfoAction(Action):
 
     def run(self, callback=None):
         Action.run(self, callback)
+        if self.compact:
+            return CompactAVInfo(self.get_metadata())
         return AVInfo(self.get_metadata())
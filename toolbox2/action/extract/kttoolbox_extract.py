@@ -20,11 +20,14 @@ class KTToolboxAction(Action):
     category = 'extract'
     description = 'kt-toolbox extract tool'
     required_params = {}
+    tools = ['kt-toolbox']
 
     def __init__(self, log, base_dir, _id, params=None, resources=None):
         Action.__init__(self, log, base_dir, _id, params, resources)
         self.input_file = None
         self.kttoolbox_worker = None
+        self.user_callback = None
+        self.published_outputs = {}
 
         if not os.path.isdir(self.tmp_dir):
             os.makedirs(self.tmp_dir)
@@ -44,35 +47,54 @@ class KTToolboxAction(Action):
         worker = self._new_worker(KTToolboxWorker, self.kttoolbox_params)
         worker.add_input_file(self.input_file)
         worker.add_output_file(self.tmp_dir)
+        worker.set_output_callback(self._publish_output)
 
         self.kttoolbox_worker = worker
         self.workers.append(worker)
 
-    def _finalize(self):
-        index = 1
-        for _id, path in self.kttoolbox_worker.stls.iteritems():
-            output = self.kttoolbox_params.get('teletext_track_output_path_%s' % _id, None)
+    def _execute(self, callback=None):
+        # Kept to notify the user as soon as an output is published
+        self.user_callback = callback
+        Action._execute(self, callback)
+
+    def _publish_output(self, worker, _id, path):
+        """
+        Move an STL file announced by kt-toolbox to its requested location
+        and register it as an output resource.
+        """
+        if _id in self.published_outputs:
+            return
+
+        output = self.kttoolbox_params.get('teletext_track_output_path_%s' % _id, None)
 
-            if output:
-                dest = os.path.realpath(self.tmp_dir + '/' + output)
-                basedir = os.path.dirname(dest)
+        if output:
+            dest = os.path.realpath(self.tmp_dir + '/' + output)
+            basedir = os.path.dirname(dest)
 
-                # Silent here if output directory is self.tmp_dir
-                try:
-                    os.makedirs(basedir)
-                except OSError:
-                    pass
+            # Silent here if output directory is self.tmp_dir
+            try:
+                os.makedirs(basedir)
+            except OSError:
+                pass
 
-                os.rename(path, dest)
-                path = dest
+            os.rename(path, dest)
+            path = dest
 
-            rel_path = os.path.relpath(path, self.tmp_dir)
-            self.add_output_resource(index, {'path': path, 'rel_path': rel_path})
+        self.published_outputs[_id] = path
+        index = len(self.published_outputs)
 
-            # Create entry if it does not exist.
-            # User of kt-toolbox extract can retrieve specific STL file using it.
-            metadata = {'teletext_track_output_path_%s' % _id: path}
-            self.kttoolbox_params.update(metadata)
-            self.update_metadata(metadata)
+        rel_path = os.path.relpath(path, self.tmp_dir)
+        self.add_output_resource(index, {'path': path, 'rel_path': rel_path})
 
-            index = index + 1
+        # Create entry if it does not exist.
+        # User of kt-toolbox extract can retrieve specific STL file using it.
+        metadata = {'teletext_track_output_path_%s' % _id: path}
+        self.kttoolbox_params.update(metadata)
+        self.update_metadata(metadata)
+
+        self.log.info('Teletext track %s extracted to %s', _id, path)
+        self._callback(self.user_callback)
+
+    def _finalize(self):
+        for _id, path in self.kttoolbox_worker.stls.iteritems():
+            self._publish_output(self.kttoolbox_worker, _id, path)
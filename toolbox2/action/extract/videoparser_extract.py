@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from toolbox2.action import Action, ActionException
+from toolbox2.worker.videoparser import VideoparserWorker
+
+
+class VideoparserActionException(ActionException):
+    pass
+
+
+class VideoparserAction(Action):
+    """
+    Extract video elementary stream information using videoparser.
+    """
+
+    name = 'videoparser_extract'
+    engine = 'videoparser'
+    category = 'extract'
+    description = 'video elementary stream information extract tool'
+    required_params = {}
+    tools = ['videoparser']
+
+    def __init__(self, log, base_dir, _id, params=None, resources=None):
+        Action.__init__(self, log, base_dir, _id, params, resources)
+        self.input_file = None
+        self.videoparser_worker = None
+
+        if not os.path.isdir(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+
+        self.videoparser_params = self.params.get(self.name, {})
+        self.full_desc_max_size = int(self.params.get('full_desc_max_size',
+                                                      VideoparserWorker.FULL_DESC_MAX_SIZE))
+
+    def _setup(self):
+        self.input_file = self.get_input_resource(1).get('path')
+        if self.input_file is None:
+            raise VideoparserActionException('No specified path for input (index = 1)')
+
+        worker = self._new_worker(VideoparserWorker, self.videoparser_params)
+        worker.add_input_file(self.input_file)
+        worker.set_full_desc_max_size(self.full_desc_max_size)
+
+        self.videoparser_worker = worker
+        self.workers.append(worker)
+
+    def _callback(self, user_callback):
+        # Expose metadata parsed so far to the user
+        if self.videoparser_worker:
+            self.update_metadata(self.videoparser_worker.metadata)
+        Action._callback(self, user_callback)
+
+    def _finalize(self):
+        self.update_metadata(self.videoparser_worker.metadata)
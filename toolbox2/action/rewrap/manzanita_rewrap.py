@@ -4,6 +4,7 @@ import os
 
 from toolbox2.action import Action, ActionException
 from toolbox2.action.extract.avinfo_extract import AVInfoAction
+from toolbox2.timecode import TimecodeException, get_range
 from toolbox2.worker.manzanita import ManzanitaMuxWorker
 from toolbox2.worker.ffmpeg import FFmpegWorker
 
@@ -19,11 +20,14 @@ class ManzanitaRewrapAction(Action):
     category = 'rewrap'
     description = 'Manzanita rewrap tool'
     required_params = {}
+    tools = ['ffprobe', 'ffmpeg', 'mp2tsms']
 
     def __init__(self, log, base_dir, _id, params=None, resources=None):
         Action.__init__(self, log, base_dir, _id, params, resources)
         self.input_file = None
         self.output_file = None
+        self.range_in = self.params.get('in')
+        self.range_out = self.params.get('out')
 
         if 'manzanita' not in self.params:
             self.params['manzanita'] = {}
@@ -60,7 +64,15 @@ class ManzanitaRewrapAction(Action):
         self.output_file = os.path.join(self.tmp_dir, output_filename)
         self.add_output_resource(1, {'path': self.output_file})
 
-        avinfo_action = AVInfoAction(self.log, self.base_dir, self.id)
+        has_range = self.range_in not in [None, ''] or self.range_out not in [None, '']
+        # Copied ranges start at the keyframe preceding them, found in the
+        # packet index, built unless it is cached
+        avinfo_action = AVInfoAction(self.log, self.base_dir, self.id, {'probe_profile': 'transcode',
+                                                                      'build_index': has_range,
+                                                                      'io_class': self.io_class,
+                                                                      'priority': self.priority})
+        # Probe reads count against the bandwidth budget of the action
+        avinfo_action.io_budget = self.io_budget
         avinfo_action.add_input_resource(1, {'path': self.input_file})
         avinfo = avinfo_action.run()
 
@@ -68,6 +80,19 @@ class ManzanitaRewrapAction(Action):
         ffmpeg = self._new_worker(FFmpegWorker)
         ffmpeg.add_input_file(self.input_file, {}, avinfo)
         ffmpeg.set_nb_frames(nb_video_frames)
+        if has_range:
+            # Essences are copied, the range starts at its preceding keyframe
+            index = avinfo_action.index
+            if index and not nb_video_frames:
+                nb_video_frames = index.get_frame_count()
+                ffmpeg.set_nb_frames(nb_video_frames)
+            try:
+                start_frame, end_frame = get_range(self.range_in, self.range_out, avinfo.video_fps,
+                                                   avinfo.timecode, nb_video_frames)
+            except TimecodeException, exc:
+                raise ManzanitaRewrapException('Invalid range: %s' % exc)
+            first_frame = ffmpeg.set_range(start_frame, end_frame, index, False)
+            self.add_metadata('range', {'start_frame': first_frame, 'end_frame': end_frame, 'seek': ffmpeg.seek})
         ffmpeg.demux(self.tmp_dir)
 
         # Setup mp2tsms muxer
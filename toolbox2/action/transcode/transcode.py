@@ -1,13 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import os.path
 
 from toolbox2.action import Action, ActionException
+from toolbox2.cpuset import get_cpu_share
+from toolbox2.fileutils import clone_file
+from toolbox2.timecode import TimecodeException, get_range, offset_timecode
 from toolbox2.action.extract.avinfo_extract import AVInfoAction
 from toolbox2.worker.bmx import Raw2BmxWorker
 from toolbox2.worker.flvtools2 import FLVTool2Worker
-from toolbox2.worker.ffmpeg import FFmpegWorker
+from toolbox2.worker import ParallelWorker
+from toolbox2.worker.ffmpeg import FFmpegWorker, plan_audio_layout
 from toolbox2.worker.omneon import OmneonCopyWorker, OmneonQueryWorker
 from toolbox2.worker.qtfaststart import QtFastStartWorker
 
@@ -26,6 +31,37 @@ class TranscodeAction(Action):
     category = 'transcode'
     description = 'transcode to mpeg2 video and mux to various formats'
     required_params = {}
+    tools = ['ffprobe', 'ffmpeg', 'ommcp', 'ommq', 'raw2bmx', 'flvtool2', 'qt-faststart']
+
+    # Input video streams which can be copied instead of being encoded to a
+    # video codec. The GOP structure of an input is not known from AVInfo,
+    # so only intra-frame codecs can be checked.
+    passthrough_video_profiles = {
+        'imx':         {'codec_name': 'mpeg2video', 'pix_fmt': 'yuv422p', 'bitrate': True, 'intra': True},
+        'dnxhd':       {'codec_name': 'dnxhd', 'bitrate': True, 'intra': True},
+        'dv':          {'codec_name': 'dvvideo', 'intra': True},
+        'mpeg2video':  {'codec_name': 'mpeg2video', 'intra': False},
+        'xdcamhd':     {'codec_name': 'mpeg2video', 'intra': False},
+        'simple_h264': {'codec_name': 'h264', 'intra': False},
+    }
+
+    # Size of container structures relative to essence size
+    container_overhead = 1.05
+
+    passthrough_audio_codecs = {
+        'mpeg2audio': 'mp2',
+        'aac': 'aac',
+    }
+
+    # ffprobe format names and file extensions of containers
+    passthrough_containers = {
+        'mxf':    ('mxf', '.mxf'),
+        'mov':    ('mov', '.mov'),
+        'mp4':    ('mp4', '.mp4'),
+        'flv':    ('flv', '.flv'),
+        'mpegps': ('mpeg', '.mpg'),
+        'gxf':    ('gxf', '.gxf'),
+    }
 
     def __init__(self, log, base_dir, _id, params=None, resources=None):
         Action.__init__(self, log, base_dir, _id, params, resources)
@@ -60,9 +96,21 @@ class TranscodeAction(Action):
         self.container_abs_essence_dir = os.path.join(self.tmp_dir, self.container_essence_dir)
 
         self.muxer = self.params.get('muxer', 'ffmpeg')
-
-        self.decoding_threads = int(self.params.get('decoding_threads', 1))
-        self.encoding_threads = int(self.params.get('encoding_threads', 1))
+        self.parallel_demux = int(self.params.get('parallel_demux', 1))
+        self.passthrough = int(self.params.get('passthrough', 0))
+        self.clone_path = None
+        self.avinfo = None
+        self.passthrough_decision = None
+        self.range_in = self.params.get('in')
+        self.range_out = self.params.get('out')
+        self.output_duration = 0
+
+        self.decoding_threads = self.params.get('decoding_threads', 1)
+        if self.decoding_threads != 'auto':
+            self.decoding_threads = int(self.decoding_threads)
+        self.encoding_threads = self.params.get('encoding_threads', 1)
+        if self.encoding_threads != 'auto':
+            self.encoding_threads = int(self.encoding_threads)
 
         self.audio_codec_options = {
             'format': self.audio_format,
@@ -118,20 +166,302 @@ class TranscodeAction(Action):
             self.log.warning('Only flv, mp4 and mov container support hinting')
             self.container_hinting = 0
 
+    def _get_demux_worker(self, ffmpeg):
+        """
+        Return the worker extracting essences of a demuxing ffmpeg worker:
+        audio and video essences are extracted concurrently if enabled.
+        """
+        if not self.parallel_demux:
+            return ffmpeg
+        workers = ffmpeg.split_demux()
+        if len(workers) == 1:
+            return ffmpeg
+        return ParallelWorker(self.log, workers)
+
+    def _get_video_mismatches(self, avinfo):
+        """
+        Return why input video can not be copied instead of being encoded.
+        """
+        if len(avinfo.video_streams) != 1:
+            return ['%d video streams' % len(avinfo.video_streams)]
+
+        stream = avinfo.video_streams[0]
+        reasons = []
+
+        if self.video_letterbox:
+            reasons.append('letterboxing requested')
+        if self.video_burn:
+            reasons.append('burning requested')
+        if self.video_aspect_ratio not in ['default', avinfo.video_dar]:
+            reasons.append('aspect ratio %s requested' % self.video_aspect_ratio)
+        if self.video_resolution not in ['default', avinfo.video_res]:
+            reasons.append('resolution %s requested' % self.video_resolution)
+
+        profile = self.passthrough_video_profiles.get(self.video_codec)
+        if not profile:
+            return reasons + ['no passthrough profile for %s' % self.video_codec]
+
+        if stream.get('codec_name') != profile['codec_name']:
+            reasons.append('video codec is %s' % stream.get('codec_name'))
+
+        pix_fmt = profile.get('pix_fmt', self.video_pix_fmt)
+        if stream.get('pix_fmt') != pix_fmt:
+            reasons.append('pixel format is %s' % stream.get('pix_fmt'))
+
+        if profile.get('bitrate'):
+            bitrate = int(stream.get('bit_rate') or 0)
+            if abs(bitrate - self.video_bitrate * 1000) > self.video_bitrate * 10:
+                reasons.append('video bitrate is %s' % (bitrate or 'unknown'))
+
+        if not profile['intra']:
+            reasons.append('GOP structure can not be checked')
+        elif int(stream.get('has_b_frames', 0)):
+            reasons.append('video is not intra-frame coded')
+
+        # IMX is encoded with VBI lines, DV without them
+        if self.video_codec == 'imx' and not avinfo.video_has_vbi:
+            reasons.append('video has no VBI lines')
+        if self.video_codec == 'dv' and (avinfo.video_has_vbi or not avinfo.video_is_SD()):
+            reasons.append('resolution is %s' % avinfo.video_res)
+        if self.video_codec == 'dnxhd' and not avinfo.video_is_HD():
+            reasons.append('resolution is %s' % avinfo.video_res)
+
+        field_order = stream.get('field_order')
+        if self.video_codec == 'imx' and avinfo.video_is_SD_NTSC() and field_order not in ['tt', 'tb']:
+            reasons.append('field order is %s' % field_order)
+        if self.video_codec == 'dnxhd':
+            if not field_order:
+                reasons.append('field order is unknown')
+            elif (field_order != 'progressive') != bool(self.video_interlaced):
+                reasons.append('field order is %s' % field_order)
+
+        return reasons
+
+    def _get_audio_mismatches(self, avinfo):
+        """
+        Return why input audio can not be copied instead of being encoded.
+        """
+        reasons = []
+
+        if self.audio_codec == 'pcm':
+            codec_name = 'pcm_%s' % self.audio_format
+        else:
+            codec_name = self.passthrough_audio_codecs.get(self.audio_codec)
+
+        for stream in avinfo.audio_streams:
+            if stream.get('codec_name') != codec_name:
+                reasons.append('audio stream #%s codec is %s' % (stream['index'], stream.get('codec_name')))
+            if int(stream.get('sample_rate', 0)) != self.audio_sample_rate:
+                reasons.append('audio stream #%s sample rate is %s' % (stream['index'], stream.get('sample_rate')))
+            if self.audio_codec != 'pcm' and self.audio_bitrate and \
+               int(stream.get('bit_rate') or 0) != self.audio_bitrate * 1000:
+                reasons.append('audio stream #%s bitrate is %s' % (stream['index'], stream.get('bit_rate')))
+
+        channels_per_stream = self.audio_channels_per_stream
+        if self.container == 'gxf':
+            channels_per_stream = 1
+        audio_min_streams = None
+        if self.audio_min_streams:
+            audio_min_streams = tuple(self.audio_min_streams)
+        layout = tuple([(stream['index'], stream['channels']) for stream in avinfo.audio_streams])
+        filter_chain, _, _, empty_streams, _ = plan_audio_layout(layout, channels_per_stream, audio_min_streams)
+        if filter_chain or empty_streams:
+            reasons.append('audio layout must be remapped')
+
+        return reasons
+
+    def _get_container_mismatches(self, avinfo):
+        """
+        Return why input file can not be cloned once its streams conform.
+        """
+        reasons = []
+        format_name, extension = self.passthrough_containers.get(self.container, (None, None))
+        if format_name not in avinfo.format.get('format_name', '').split(',') or \
+           os.path.splitext(self.input_file)[1].lower() != extension:
+            reasons.append('container is %s' % avinfo.format.get('format_name'))
+        if self.muxer != 'ffmpeg':
+            reasons.append('%s muxer requested' % self.muxer)
+        if self.container_mapping != 'default' or self.container_version != 'default':
+            reasons.append('container mapping or version requested')
+        if self.container_hinting:
+            reasons.append('hinting requested')
+        return reasons
+
+    def _get_passthrough(self, avinfo):
+        """
+        Compare input with the requested profile and decide what can be
+        skipped: the whole transcode if the input file conforms (clone),
+        or the encoding of conformant video or audio (copy).
+        """
+        video_reasons = self._get_video_mismatches(avinfo)
+        audio_reasons = self._get_audio_mismatches(avinfo)
+        reasons = video_reasons + audio_reasons
+
+        if not reasons:
+            reasons = self._get_container_mismatches(avinfo)
+            decision = reasons and 'rewrap' or 'clone'
+        elif not video_reasons or not audio_reasons:
+            decision = 'partial'
+        else:
+            decision = 'transcode'
+
+        return {
+            'decision': decision,
+            'video': video_reasons and 'transcode' or 'copy',
+            'audio': audio_reasons and 'transcode' or 'copy',
+            'reasons': reasons,
+        }
+
+    def _get_video_rate(self):
+        """
+        Return output video bitrate in bit/s.
+        """
+        if self.passthrough_decision and self.passthrough_decision['video'] == 'copy':
+            bitrate = int(self.avinfo.video_streams[0].get('bit_rate') or 0)
+            return bitrate or int(os.path.getsize(self.input_file) * 8 / self.avinfo.duration)
+        if self.video_codec == 'dv':
+            if self.video_pix_fmt == 'yuv422p':
+                return 50000000
+            return 25000000
+        return self.video_bitrate * 1000
+
+    def _get_audio_rate(self):
+        """
+        Return output audio bitrate in bit/s, for all streams.
+        """
+        rate = 0
+        for stream in self.avinfo.audio_streams:
+            if self.passthrough_decision and self.passthrough_decision['audio'] == 'copy':
+                rate += int(stream.get('bit_rate') or 0)
+            elif self.audio_codec == 'pcm':
+                sample_size = int(re.sub('[^0-9]', '', self.audio_format) or 16)
+                rate += self.audio_sample_rate * sample_size * int(stream.get('channels', 1))
+            else:
+                rate += (self.audio_bitrate or 384) * 1000
+        return rate
+
+    def get_job_metrics(self):
+        metrics = Action.get_job_metrics(self)
+        metrics.update({
+            'video_codec': self.video_codec,
+            'muxer': self.muxer,
+            'decoding_threads': self.decoding_threads,
+            'encoding_threads': self.encoding_threads,
+        })
+        if self.avinfo:
+            metrics.update({
+                'duration': self.output_duration or self.avinfo.duration,
+                'resolution': self.avinfo.video_res,
+                'fps': self.avinfo.video_fps,
+            })
+        return metrics
+
+    def estimate_resources(self):
+        """
+        Estimate peak scratch usage from input duration and target bitrates:
+        outputs, plus essence files with omneon and bmx muxers, plus hinted
+        copies of mov and mp4 outputs. Each intermediate file is written then
+        read again.
+        """
+        if not self.avinfo or not self.avinfo.duration:
+            return None
+
+        duration = self.avinfo.duration
+        input_size = os.path.getsize(self.input_file)
+        if self.output_duration:
+            # Only the range is read
+            input_size = int(input_size * min(self.output_duration / duration, 1))
+            duration = self.output_duration
+        if self.clone_path:
+            return {'disk': input_size, 'bandwidth': int(2 * input_size / duration)}
+
+        output_size = int(duration * (self._get_video_rate() + self._get_audio_rate()) / 8 * self.container_overhead)
+        copies = 0
+        if self.muxer in ['omneon', 'bmx']:
+            copies += 1
+        if self.container_hinting and self.container in ['mp4', 'mov']:
+            copies += 1
+
+        disk = output_size * (1 + copies)
+        io = input_size + output_size * (1 + 2 * copies)
+        return {'disk': disk, 'bandwidth': int(io / duration)}
+
+    def has_range(self):
+        return self.range_in not in [None, ''] or self.range_out not in [None, '']
+
+    def _build_packet_index(self):
+        """
+        Build the packet index of the input, required to copy a range from
+        the keyframe preceding it.
+        """
+        avinfo_action = AVInfoAction(self.log, self.base_dir, self.id, {'probe_profile': 'minimal',
+                                                                      'build_index': True,
+                                                                      'io_class': self.io_class,
+                                                                      'priority': self.priority})
+        avinfo_action.io_budget = self.io_budget
+        avinfo_action.add_input_resource(1, {'path': self.input_file})
+        avinfo_action.run()
+        return avinfo_action.index
+
+    def _set_range(self, ffmpeg, avinfo, nb_video_frames, accurate):
+        """
+        Restrict transcode to the range between in and out points, seeking
+        the input with its packet index if available, and offset output
+        timecode to the first output frame.
+        """
+        index = self.get_packet_index(self.input_file)
+        if not index and not accurate:
+            index = self._build_packet_index()
+        if index and not nb_video_frames:
+            nb_video_frames = index.get_frame_count()
+            ffmpeg.set_nb_frames(nb_video_frames)
+
+        try:
+            start_frame, end_frame = get_range(self.range_in, self.range_out, avinfo.video_fps,
+                                               avinfo.timecode, nb_video_frames)
+            first_frame = ffmpeg.set_range(start_frame, end_frame, index, accurate)
+            ffmpeg.set_timecode(offset_timecode(avinfo.timecode, first_frame, avinfo.video_fps))
+        except TimecodeException, exc:
+            raise TranscodeException('Invalid range: %s' % exc)
+
+        if first_frame != start_frame:
+            self.log.warning('Copied video starts at keyframe %d instead of frame %d', first_frame, start_frame)
+
+        if end_frame is not None:
+            self.output_duration = (end_frame - first_frame) / avinfo.video_fps
+        elif avinfo.duration:
+            self.output_duration = max(avinfo.duration - first_frame / avinfo.video_fps, 0)
+        self.add_metadata('range', {'start_frame': first_frame, 'end_frame': end_frame,
+                                    'timecode': ffmpeg.timecode, 'seek': ffmpeg.seek})
+
     def _setup(self):
         self.input_file = self.get_input_resource(1).get('path')
         nb_video_frames = int(self.get_input_resource(1).get('nb_video_frames', 0))
         self.input_basename = os.path.splitext(os.path.basename(self.input_file))[0]
 
-        avinfo_action = AVInfoAction(self.log, self.base_dir, self.id)
+        avinfo_action = AVInfoAction(self.log, self.base_dir, self.id, {'probe_profile': 'transcode',
+                                                                      'io_class': self.io_class,
+                                                                      'priority': self.priority})
+        # Probe reads count against the bandwidth budget of the action
+        avinfo_action.io_budget = self.io_budget
         avinfo_action.add_input_resource(1, {'path': self.input_file})
         avinfo = avinfo_action.run()
+        self.avinfo = avinfo
 
         ffmpeg = self._new_worker(FFmpegWorker)
         ffmpeg.add_input_file(self.input_file, {}, avinfo)
         ffmpeg.set_nb_frames(nb_video_frames)
         ffmpeg.set_audio_min_streams(self.audio_min_streams)
         ffmpeg.set_timecode(avinfo.timecode)
+        if 'auto' in [self.decoding_threads, self.encoding_threads]:
+            nb_cpus = get_cpu_share(self.cpuset)
+            decoding_threads, encoding_threads = ffmpeg.get_auto_threads(self.video_codec, nb_cpus)
+            if self.decoding_threads == 'auto':
+                self.decoding_threads = decoding_threads
+            if self.encoding_threads == 'auto':
+                self.encoding_threads = encoding_threads
+            self.log.info('Using %d decoding and %d encoding threads (%d cpus available)',
+                          self.decoding_threads, self.encoding_threads, nb_cpus)
         ffmpeg.set_threads(self.decoding_threads, self.encoding_threads)
         ffmpeg.set_channels_per_stream(self.audio_channels_per_stream)
 
@@ -142,10 +472,43 @@ class TranscodeAction(Action):
                 self.audio_format = 's16le'
             self.audio_codec_options['format'] = self.audio_format
 
-        ffmpeg.transcode(self.video_codec, self.video_codec_options)
-        ffmpeg.transcode(self.audio_codec, self.audio_codec_options)
+        passthrough = None
+        if self.passthrough:
+            passthrough = self._get_passthrough(avinfo)
+            self.passthrough_decision = passthrough
+            self.add_metadata('passthrough', passthrough)
+            self.log.info('Passthrough decision: %s (%s)', passthrough['decision'],
+                          ', '.join(passthrough['reasons']) or 'input conforms')
+
+            if passthrough['decision'] == 'clone' and self.has_range():
+                passthrough['decision'] = 'rewrap'
+                passthrough['reasons'].append('range')
+
+            if passthrough['decision'] == 'clone':
+                self.clone_path = os.path.join(self.tmp_dir, os.path.basename(self.input_file))
+                self.add_output_resource(1, {'path': self.clone_path})
+                return
+
+        if self.has_range():
+            self._set_range(ffmpeg, avinfo, nb_video_frames, not passthrough or passthrough['video'] != 'copy')
+
+        if passthrough and passthrough['video'] == 'copy':
+            ffmpeg.transcode('copy')
+            if self.video_codec == 'imx' and self.container == 'mov' and \
+               not avinfo.format.get('format_name', '').startswith('mov'):
+                ffmpeg.mov_imx_header = True
+        else:
+            ffmpeg.transcode(self.video_codec, self.video_codec_options)
+
+        if passthrough and passthrough['audio'] == 'copy':
+            ffmpeg.copy_audio()
+        else:
+            ffmpeg.transcode(self.audio_codec, self.audio_codec_options)
 
-        if self.video_aspect_ratio == 'default':
+        if passthrough and passthrough['video'] == 'copy':
+            # Keep input aspect ratio, which conforms
+            pass
+        elif self.video_aspect_ratio == 'default':
             if avinfo.video_dar == '16:9':
                 ffmpeg.set_aspect_ratio('16:9')
             else:
@@ -206,7 +569,7 @@ class TranscodeAction(Action):
             for output_file in ommcp.output_files:
                 ommq.add_input_file(output_file.path)
 
-            ommq.set_timecode(avinfo.timecode)
+            ommq.set_timecode(ffmpeg.timecode)
 
             index = 0
             for output_file in ommcp.output_files:
@@ -218,7 +581,7 @@ class TranscodeAction(Action):
                     self.add_output_resource(index + 1, {'path': output_file.path})
                     index += 1
 
-            self.workers.append(ffmpeg)
+            self.workers.append(self._get_demux_worker(ffmpeg))
             self.workers.append(ommcp)
             self.workers.append(ommq)
 
@@ -236,14 +599,14 @@ class TranscodeAction(Action):
                 raw2bmx.add_input_file(output_file.path, params)
 
             base_path = os.path.join(self.tmp_dir, self.input_basename)
-            raw2bmx.set_timecode(avinfo.timecode)
+            raw2bmx.set_timecode(ffmpeg.timecode)
             raw2bmx.mux(base_path, self.container_options)
             index = 0
             for output_file in raw2bmx.output_files:
                 self.add_output_resource(index + 1, {'path': output_file.path})
                 index += 1
 
-            self.workers.append(ffmpeg)
+            self.workers.append(self._get_demux_worker(ffmpeg))
             self.workers.append(raw2bmx)
 
         # Unsupported muxer
@@ -251,4 +614,5 @@ class TranscodeAction(Action):
             raise TranscodeException('Unsupported muxer: %s' % self.muxer)
 
     def _finalize(self):
-        pass
+        if self.clone_path:
+            clone_file(self.input_file, self.clone_path, hardlink=False, throttle=self.io_budget)
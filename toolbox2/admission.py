@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import time
+
+from toolbox2.exception import Toolbox2Exception
+from toolbox2.state import SharedState, get_process_start_time, process_exists
+
+ADMISSION_DEFAULT_POLL_INTERVAL = 5
+
+
+class AdmissionException(Toolbox2Exception):
+    pass
+
+
+def get_free_space(path):
+    """
+    Return the space available to unprivileged users on the filesystem of
+    path, in bytes.
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def get_disk_usage(path, exclude=None):
+    """
+    Return the space allocated to files below path, in bytes.
+
+    :param exclude: names of directories which are not accounted
+    :type exclude: list
+    """
+    usage = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        if exclude:
+            dirnames[:] = [dirname for dirname in dirnames if dirname not in exclude]
+        for filename in filenames:
+            try:
+                usage += os.lstat(os.path.join(dirpath, filename)).st_blocks * 512
+            except OSError:
+                pass
+    return usage
+
+
+class AdmissionController(object):
+    """
+    Admit jobs of all toolbox2 processes of a node on a shared scratch
+    volume only when their estimated peak disk usage fits in its free space,
+    and their estimated I/O bandwidth fits in the node bandwidth.
+
+    Running jobs reserve their estimate. As their files are already counted
+    in free space, only the part of a reservation which is not written yet
+    is deducted from it.
+    """
+
+    def __init__(self, state_path, scratch_path, reserve=0, bandwidth=0, speed=1.0, timeout=0,
+                 poll_interval=ADMISSION_DEFAULT_POLL_INTERVAL):
+        """
+        :param state_path: path of the file shared by all processes of the node
+        :type state_path: string
+
+        :param scratch_path: path on the scratch volume
+        :type scratch_path: string
+
+        :param reserve: space kept free on the scratch volume, in bytes
+        :type reserve: int
+
+        :param bandwidth: I/O bandwidth of the node in bytes per second,
+                          0 for unlimited
+        :type bandwidth: int
+
+        :param speed: expected processing speed relative to real time, job
+                      bandwidth estimates are multiplied by it
+        :type speed: float
+
+        :param timeout: maximum time in seconds to wait for admission,
+                        0 to wait forever
+        :type timeout: int
+        """
+        self.state_path = state_path
+        self.scratch_path = scratch_path
+        self.reserve = reserve
+        self.bandwidth = bandwidth
+        self.speed = speed
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def _update(self, state):
+        jobs = state.data.setdefault('jobs', {})
+        for key, job in jobs.items():
+            if not process_exists(job['pid'], job['start_time']):
+                del jobs[key]
+        return jobs
+
+    def _get_headroom(self, jobs):
+        disk = get_free_space(self.scratch_path) - self.reserve
+        bandwidth = self.bandwidth
+        for job in jobs.itervalues():
+            disk -= max(job['disk'] - get_disk_usage(job['path'], ['staging']), 0)
+            bandwidth -= job['bandwidth']
+        return (disk, bandwidth)
+
+    def try_acquire(self, key, path, disk, bandwidth):
+        """
+        Reserve resources for a job if they are available.
+
+        :param key: job identifier, unique on the node
+        :type key: string
+
+        :param path: working directory of the job, on the scratch volume
+        :type path: string
+
+        :param disk: estimated peak disk usage in bytes
+        :type disk: int
+
+        :param bandwidth: estimated I/O bandwidth at real time speed, in
+                          bytes per second
+        :type bandwidth: int
+
+        :return: True if the job was admitted
+        :rtype: bool
+        """
+        pid = os.getpid()
+        bandwidth = int(bandwidth * self.speed)
+
+        with SharedState(self.state_path) as state:
+            jobs = self._update(state)
+            if key in jobs:
+                return True
+
+            free_disk, free_bandwidth = self._get_headroom(jobs)
+            if disk > free_disk:
+                if not jobs:
+                    raise AdmissionException('Job needs %d MB on scratch volume, only %d MB are available' % (
+                                             disk / 1048576, max(free_disk, 0) / 1048576))
+                return False
+            # A job is always admitted on an idle node, whatever its bandwidth
+            if self.bandwidth and jobs and bandwidth > free_bandwidth:
+                return False
+
+            jobs[key] = {
+                'pid': pid,
+                'start_time': get_process_start_time(pid),
+                'path': path,
+                'disk': disk,
+                'bandwidth': bandwidth,
+            }
+            return True
+
+    def acquire(self, key, path, disk, bandwidth):
+        """
+        Wait until resources are available for a job and reserve them.
+
+        :return: time spent waiting, in seconds
+        :rtype: float
+        """
+        started_at = time.time()
+        while not self.try_acquire(key, path, disk, bandwidth):
+            waited = time.time() - started_at
+            if self.timeout and waited > self.timeout:
+                raise AdmissionException('Job not admitted after %d seconds' % waited)
+            time.sleep(self.poll_interval)
+        return time.time() - started_at
+
+    def release(self, key):
+        """
+        Release resources reserved by a job.
+        """
+        with SharedState(self.state_path) as state:
+            self._update(state).pop(key, None)
+
+    def get_jobs(self):
+        """
+        Return reservations of jobs which are still running.
+        """
+        with SharedState(self.state_path) as state:
+            return self._update(state).values()
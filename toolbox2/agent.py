@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import select
+import socket
+import SocketServer
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from toolbox2.command import Command, CommandException, COMMAND_DEFAULT_LAUNCHER
+from toolbox2.exception import Toolbox2Exception
+from toolbox2.scheduler import Scheduler
+
+# Interval at which running commands check for kill requests, in seconds
+AGENT_POLL_INTERVAL = 0.2
+
+
+class AgentException(Toolbox2Exception):
+    pass
+
+
+def parse_address(address):
+    """
+    Return the socket family and address of an agent address: a path for
+    a Unix socket, or host:port for a TCP socket.
+
+    :rtype: tuple
+    """
+    if address.startswith('/'):
+        return (socket.AF_UNIX, address)
+    host, _, port = address.rpartition(':')
+    try:
+        return (socket.AF_INET, (host, int(port)))
+    except ValueError:
+        raise AgentException('Invalid agent address: %s' % address)
+
+
+def is_local_address(family, address):
+    """
+    Return True if an agent address is only reachable from its node.
+    """
+    return family == socket.AF_UNIX or address[0] in ['localhost', '127.0.0.1', '::1']
+
+
+def check_secret(secret, expected):
+    """
+    Compare a secret in constant time.
+    """
+    if not isinstance(secret, basestring) or len(secret) != len(expected):
+        return False
+    result = 0
+    for x, y in zip(secret, expected):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def encode_output(buf):
+    """
+    Make process output JSON serializable. Bytes are mapped to code points
+    one to one, so that decode_output restores them exactly.
+    """
+    return buf.decode('latin-1')
+
+
+def decode_output(text):
+    return text.encode('latin-1')
+
+
+class AgentRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Run a single command for a client connection. The client sends the
+    command as a JSON line and receives events as JSON lines until the
+    command exits:
+
+        {"command": "run", "args": [...], "cwd": ..., "memory_limit": ..., "kill_timeout": ..., "secret": ...}
+        {"event": "started", "pid": ...}
+        {"event": "output", "stdout": ..., "stderr": ...}
+        {"event": "exit", "returncode": ..., "cpu_time": ...}
+        {"event": "error", "error": ...}
+
+    A {"command": "kill"} line, or closing the connection, kills the
+    command. Only tools configured on the agent are run, and the secret of
+    the agent, if any, must be given.
+    """
+
+    # Do not buffer reads, so that kill requests are seen by select
+    rbufsize = 0
+
+    def _send(self, event):
+        try:
+            self.wfile.write(json.dumps(event) + '\n')
+            self.wfile.flush()
+        except socket.error:
+            self.disconnected = True
+
+    def _kill_requested(self):
+        """
+        Return True if the client asked to kill the command or has gone.
+        """
+        if self.disconnected:
+            return True
+        while select.select([self.connection], [], [], 0)[0]:
+            line = self.rfile.readline()
+            if not line:
+                self.disconnected = True
+                return True
+            try:
+                if json.loads(line).get('command') == 'kill':
+                    return True
+            except (ValueError, AttributeError):
+                pass
+        return False
+
+    def handle(self):
+        self.disconnected = False
+        agent = self.server.agent
+
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get('command') != 'run':
+                raise ValueError('unknown command %s' % request.get('command'))
+            args = [str(arg) for arg in request['args']]
+            cwd = request.get('cwd') or '/'
+            if not args:
+                raise ValueError('empty command line')
+        except (ValueError, TypeError, KeyError, AttributeError), exc:
+            self._send({'event': 'error', 'error': 'Invalid request: %s' % exc})
+            return
+
+        if agent.secret and not check_secret(request.get('secret'), agent.secret):
+            agent.log.warning('Rejected request from %s: invalid secret', self.client_address)
+            self._send({'event': 'error', 'error': 'Invalid secret'})
+            return
+
+        tool = agent.get_tool(args[0])
+        if tool is None:
+            agent.log.warning('Rejected request from %s: %s is not a configured tool', self.client_address, args[0])
+            self._send({'event': 'error', 'error': '%s is not a configured tool' % args[0]})
+            return
+        args[0] = tool
+
+        agent.scheduler.acquire()
+        try:
+            if self._kill_requested():
+                return
+            self._run(agent, request, args, cwd)
+        finally:
+            agent.scheduler.release()
+
+    def _run(self, agent, request, args, cwd):
+        command = Command(cwd)
+        command.memory_limit = int(request.get('memory_limit', 0))
+        command.kill_timeout = int(request.get('kill_timeout', command.kill_timeout))
+        command.launcher = agent.launcher
+        command.set_timeout(AGENT_POLL_INTERVAL)
+
+        try:
+            command.run(args)
+        except (OSError, IOError), exc:
+            self._send({'event': 'error', 'error': 'Could not run %s: %s' % (args[0], exc)})
+            return
+
+        agent.log.info('Running command (pid = %s): %s', command.process.pid, ' '.join(args))
+        self._send({'event': 'started', 'pid': command.process.pid})
+
+        def callback(stdout, stderr):
+            if stdout or stderr:
+                self._send({'event': 'output', 'stdout': encode_output(stdout), 'stderr': encode_output(stderr)})
+
+        try:
+            while command.wait(callback, loop=False) is None:
+                if self._kill_requested():
+                    agent.log.info('Killing command (pid = %s)', command.process.pid)
+                    try:
+                        command.process.kill()
+                    except OSError:
+                        pass
+        except CommandException, exc:
+            self._send({'event': 'error', 'error': str(exc)})
+            return
+
+        self._send({'event': 'exit', 'returncode': command.process.returncode, 'cpu_time': command.get_cpu_time()})
+
+
+class AgentServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixAgentServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Agent(object):
+    """
+    Resident process running commands of workers on behalf of toolbox2
+    instances of other nodes, see toolbox2.executor.AgentExecutor. Paths
+    in commands must be valid on the agent node, usually on a shared
+    filesystem. At most concurrency commands run at the same time, other
+    ones wait for a free slot.
+
+    Only tools of the agent configuration are run, given by name or by
+    configured path. Agents listening on TCP require a shared secret,
+    unless they only listen on localhost.
+    """
+
+    def __init__(self, log, address, concurrency=1, launcher=COMMAND_DEFAULT_LAUNCHER, tools=None, secret=None):
+        """
+        :param log: logger instance to use
+        :type log: logging.Logger
+
+        :param address: path of a Unix socket or host:port to listen on
+        :type address: string
+
+        :param concurrency: number of commands run at the same time
+        :type concurrency: int
+
+        :param launcher: how processes are launched: popen or spawn
+        :type launcher: string
+
+        :param tools: paths of the tools which may be run, by name
+        :type tools: dict
+
+        :param secret: secret clients must send with their commands
+        :type secret: string
+        """
+        if concurrency < 1:
+            raise AgentException('Concurrency must be at least 1')
+        if not tools:
+            raise AgentException('No tool configured')
+
+        self.log = log
+        self.address = address
+        self.family, self.socket_address = parse_address(address)
+        if not secret and not is_local_address(self.family, self.socket_address):
+            raise AgentException('A secret is required to listen on %s' % address)
+        self.tools = tools
+        self.secret = secret
+        self.scheduler = Scheduler(concurrency)
+        self.launcher = launcher
+        self.server = None
+
+    def get_tool(self, name):
+        """
+        Return the path of a configured tool given by name or path, or None
+        if it is not configured.
+        """
+        if name in self.tools:
+            return self.tools[name]
+        if name in self.tools.values():
+            return name
+        return None
+
+    def bind(self):
+        """
+        Create the listening socket.
+        """
+        if self.family == socket.AF_UNIX:
+            if os.path.exists(self.socket_address):
+                os.unlink(self.socket_address)
+            dirname = os.path.dirname(self.socket_address)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self.server = UnixAgentServer(self.socket_address, AgentRequestHandler)
+        else:
+            self.server = AgentServer(self.socket_address, AgentRequestHandler)
+        self.server.agent = self
+        return self.server.server_address
+
+    def serve_forever(self):
+        """
+        Listen on the socket and serve clients until interrupted.
+        """
+        if not self.server:
+            self.bind()
+        self.log.info('Listening on %s', self.address)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if self.family == socket.AF_UNIX and os.path.exists(self.socket_address):
+                os.unlink(self.socket_address)
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import time
+import sqlite3
+import threading
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from toolbox2 import Loader
+from toolbox2.action import get_config
+from toolbox2.exception import Toolbox2Exception
+from toolbox2.metrics import RuntimeModel, get_metrics_store
+from toolbox2.scheduler import JobQueue, SCHEDULER_DEFAULT_AGING
+
+
+class BatchException(Toolbox2Exception):
+    pass
+
+
+def run_job(log, base_dir, action_id, job, callback=None):
+    """
+    Run the action described by a job and return its result: status done
+    or error, output resources, metadata and error message.
+
+    :param log: logger instance to use
+    :type log: logging.Logger
+
+    :param base_dir: default working base directory of the action
+    :type base_dir: string
+
+    :param action_id: identifier of the action working directory
+    :type action_id: string
+
+    :param job: action, params and resources of the job
+    :type job: dict
+
+    :param callback: user defined callback passed to the action
+    :type callback: callable(action)
+
+    :rtype: dict
+    """
+    result = {'status': 'error'}
+    started_at = time.time()
+    try:
+        result['action'] = job['action']
+        action_class = Loader().get_class(job['action'])
+        action = action_class(log, job.get('base_dir', base_dir), action_id,
+                              job.get('params'), job.get('resources'))
+        action.run(callback)
+
+        result['status'] = 'done'
+        result['outputs'] = action.get_output_resources()
+        result['metadata'] = action.get_metadata()
+    except (KeyError, TypeError, AttributeError, Toolbox2Exception), exc:
+        log.error('Action %s failed: %s', action_id, exc)
+        result['error'] = str(exc)
+    except Exception, exc:
+        log.exception('Action %s failed', action_id)
+        result['error'] = str(exc)
+
+    result['running_time'] = time.time() - started_at
+    return result
+
+
+def get_runtime_model(log):
+    """
+    Return a runtime model fitted on the metrics store described in
+    configuration, predicting from input size only if there is none.
+    """
+    store = None
+    try:
+        store = get_metrics_store(get_config())
+    except (IOError, OSError, sqlite3.Error), exc:
+        log.warning('Job metrics unavailable: %s', exc)
+    return RuntimeModel(store)
+
+
+class BatchRunner(object):
+    """
+    Run a stream of jobs read as JSON lines, each line describing an action
+    the same way as toolbox2 --path files:
+
+        {"action": "avinfo_extract", "params": {}, "resources": {"inputs": {"1": {"path": "/in.mxf"}}}}
+
+    An optional id can be given with each job, it is reported with its
+    result instead of the job line number. Jobs are run by a fixed number of
+    threads, and results are written as JSON lines in completion order. Jobs
+    are read only when a thread is about to be free, so memory use does not
+    depend on the number of jobs.
+
+    With sjf scheduling, up to lookahead jobs are read ahead and the one
+    with the shortest expected runtime, corrected by aging, is run first.
+    """
+
+    def __init__(self, log, base_dir, concurrency=1, policy='fifo', lookahead=0, aging=SCHEDULER_DEFAULT_AGING):
+        """
+        :param log: logger instance to use
+        :type log: logging.Logger
+
+        :param base_dir: working base directory of actions
+        :type base_dir: string
+
+        :param concurrency: number of jobs run at the same time
+        :type concurrency: int
+
+        :param policy: scheduling policy of read jobs: fifo or sjf
+        :type policy: string
+
+        :param lookahead: number of jobs read ahead of free threads
+        :type lookahead: int
+
+        :param aging: seconds of expected runtime forgiven per second waited
+        :type aging: float
+        """
+        if concurrency < 1:
+            raise BatchException('Concurrency must be at least 1')
+
+        self.log = log
+        self.base_dir = base_dir
+        self.concurrency = concurrency
+        # Discover actions once for all jobs
+        Loader()
+        self.queue = JobQueue(concurrency, policy, aging)
+        self.model = None
+        if policy == 'sjf':
+            self.queue = JobQueue(concurrency + max(lookahead, 0), policy, aging)
+            self.model = get_runtime_model(log)
+        self.output = None
+        self.output_lock = threading.Lock()
+        self.succeeded = 0
+        self.failed = 0
+        self.prefix = '%.6f' % time.time()
+
+    def _write_result(self, result):
+        line = json.dumps(result, default=str)
+        with self.output_lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+            if result['status'] == 'done':
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def _predict(self, line):
+        """
+        Return the expected runtime of a job, 0 if it can not be parsed.
+        """
+        if not self.model:
+            return 0
+        try:
+            job = json.loads(line)
+            return self.model.predict(job['action'], job.get('params'), job.get('resources'))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return 0
+
+    def run_job(self, lineno, line):
+        """
+        Run a single job and return its result.
+
+        :param lineno: job line number, used as default job id
+        :type lineno: int
+
+        :param line: JSON description of the job
+        :type line: string
+        """
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError('Job must be a JSON object')
+        except ValueError, exc:
+            self.log.error('Job #%s failed: %s', lineno, exc)
+            return {'id': str(lineno), 'line': lineno, 'status': 'error', 'error': str(exc)}
+
+        job_id = str(job.get('id', lineno))
+        result = run_job(self.log, self.base_dir, '%s-%s' % (self.prefix, lineno), job)
+        result.update(id=job_id, line=lineno)
+        return result
+
+    def _run_worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write_result(self.run_job(*item))
+            finally:
+                self.queue.task_done()
+
+    def run(self, input_file, output_file):
+        """
+        Run all jobs read from input_file and write their results to
+        output_file.
+
+        :param input_file: file object jobs are read from
+        :type input_file: file
+
+        :param output_file: file object results are written to
+        :type output_file: file
+
+        :return: number of succeeded and failed jobs
+        :rtype: tuple
+        """
+        self.output = output_file
+        self.succeeded = 0
+        self.failed = 0
+
+        threads = []
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self._run_worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        lineno = 0
+        # readline does not read ahead, which matters when jobs are piped
+        for line in iter(input_file.readline, ''):
+            lineno += 1
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            # Blocks while all threads are busy and the queue is full
+            self.queue.put((self._predict(line), (lineno, line)))
+
+        for _ in threads:
+            self.queue.put((None, None))
+        for thread in threads:
+            thread.join()
+
+        return (self.succeeded, self.failed)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+from distutils.spawn import find_executable
+
+from toolbox2.fileutils import get_file_identity, get_file_checksum, clone_file
+
+
+class DirectoryCache(object):
+    """
+    Size-capped cache storing entries as directories, evicted in least
+    recently used order. Each entry holds a manifest and a set of files.
+    Concurrent processes sharing the same cache directory are serialized
+    through a lock file.
+    """
+
+    def __init__(self, path, max_size):
+        """
+        :param path: cache directory
+        :type path: string
+
+        :param max_size: maximum size of cached files in bytes
+        :type max_size: int
+        """
+        self.path = path
+        self.max_size = max_size
+        self.lock_path = os.path.join(self.path, '.lock')
+        self.lock_fd = None
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def __enter__(self):
+        self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.close(self.lock_fd)
+        self.lock_fd = None
+
+    def _get_entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _get_entries(self):
+        entries = []
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if prefix.startswith('.') or not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                if '.tmp-' in key:
+                    continue
+                manifest_path = os.path.join(prefix_path, key, 'manifest.json')
+                try:
+                    with open(manifest_path, 'r') as fileobj:
+                        size = json.load(fileobj).get('size', 0)
+                    mtime = os.stat(manifest_path).st_mtime
+                except (IOError, OSError, ValueError):
+                    continue
+                entries.append((mtime, size, key))
+        return entries
+
+    def get(self, key):
+        """
+        Return the manifest of an entry and mark it as recently used, or
+        None if the entry does not exist.
+        """
+        manifest_path = os.path.join(self._get_entry_path(key), 'manifest.json')
+        try:
+            with open(manifest_path, 'r') as fileobj:
+                manifest = json.load(fileobj)
+            os.utime(manifest_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return manifest
+
+    def get_file_path(self, key, rel_path):
+        """
+        Return the absolute path of a file stored in an entry.
+        """
+        return os.path.join(self._get_entry_path(key), 'files', rel_path)
+
+    def put(self, key, files, manifest, move=False, hardlink=True):
+        """
+        Store an entry made of files and evict least recently used entries
+        if the cache exceeds its maximum size. Return False if the entry
+        could not be stored.
+
+        :param files: files to store, indexed by their relative path
+        :type files: dict
+
+        :param manifest: entry description, must be json serializable
+        :type manifest: dict
+
+        :param move: move files instead of copying them, they must be
+                     located on the cache filesystem
+        :type move: bool
+
+        :param hardlink: allow copies to share the inode of files
+        :type hardlink: bool
+        """
+        size = 0
+        for path in files.itervalues():
+            size += os.path.getsize(path)
+        if size > self.max_size:
+            return False
+
+        entry_path = self._get_entry_path(key)
+        if os.path.isdir(entry_path):
+            return False
+
+        tmp_path = '%s.tmp-%s' % (entry_path, os.getpid())
+        try:
+            for rel_path, path in files.iteritems():
+                dst = os.path.join(tmp_path, 'files', rel_path)
+                if move:
+                    if not os.path.isdir(os.path.dirname(dst)):
+                        os.makedirs(os.path.dirname(dst))
+                    os.rename(path, dst)
+                else:
+                    clone_file(path, dst, hardlink)
+
+            manifest = dict(manifest, key=key, size=size, created_at=time.time())
+            with open(os.path.join(tmp_path, 'manifest.json'), 'w') as fileobj:
+                json.dump(manifest, fileobj)
+
+            os.rename(tmp_path, entry_path)
+        except (IOError, OSError):
+            shutil.rmtree(tmp_path, True)
+            return False
+
+        self.evict()
+        return True
+
+    def remove(self, key):
+        shutil.rmtree(self._get_entry_path(key), True)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits its maximum
+        size.
+        """
+        entries = self._get_entries()
+        entries.sort()
+
+        total_size = sum([size for _, size, _ in entries])
+        for _, size, key in entries:
+            if total_size <= self.max_size:
+                break
+            self.remove(key)
+            total_size -= size
+
+
+class ResultCache(DirectoryCache):
+    """
+    Cache of action results, keyed by the action name, the identity or
+    content of its input files, its normalized parameters and the identity
+    of the tools it uses. Files are copied, or cloned when the filesystem
+    supports it, but never hard linked, so that outputs modified after
+    they have been stored or restored do not alter cached entries.
+    """
+
+    # Parameters which do not change action results
+    volatile_params = [
+        'debug',
+        'callback_interval',
+        'cache',
+        'cache_key',
+        'checkpoint',
+        'checkpoint_checksum',
+        'stage_inputs',
+        'admission',
+        'metrics',
+        'telemetry_interval',
+    ]
+
+    def __init__(self, path, max_size, content_key=False):
+        """
+        :param content_key: identify input files by their checksum instead
+                            of their metadata
+        :type content_key: bool
+        """
+        DirectoryCache.__init__(self, path, max_size)
+        self.content_key = content_key
+
+    def _get_tool_identity(self, tool):
+        path = find_executable(tool)
+        if not path:
+            return None
+        return get_file_identity(os.path.realpath(path))
+
+    def get_key(self, action):
+        """
+        Compute the cache key of an action before it is run.
+        """
+        params = {}
+        for key, value in action.params.iteritems():
+            if key not in self.volatile_params:
+                params[key] = value
+
+        inputs = {}
+        for index, resource in action.get_input_resources().iteritems():
+            resource = dict(resource)
+            path = resource.pop('path', None)
+            if path:
+                if self.content_key:
+                    resource['checksum'] = get_file_checksum(path)
+                else:
+                    resource['identity'] = get_file_identity(os.path.realpath(path))
+            inputs[index] = resource
+
+        tools = {}
+        for tool in action.tools:
+            tools[tool] = self._get_tool_identity(action.get_tool_path(tool))
+
+        data = {
+            'action': action.name,
+            'params': params,
+            'inputs': inputs,
+            'outputs': action.get_output_resources(),
+            'tools': tools,
+        }
+        buf = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha1(buf).hexdigest()
+
+    def _replace_prefix(self, data, old, new):
+        if isinstance(data, dict):
+            ret = {}
+            for key, value in data.iteritems():
+                ret[key] = self._replace_prefix(value, old, new)
+            return ret
+        elif isinstance(data, list):
+            return [self._replace_prefix(value, old, new) for value in data]
+        elif isinstance(data, basestring) and data.startswith(old):
+            return new + data[len(old):]
+        return data
+
+    def _get_resource_path(self, resource):
+        # Some actions register output files by their path only
+        if isinstance(resource, basestring):
+            return resource
+        if isinstance(resource, dict):
+            return resource.get('path')
+        return None
+
+    def store(self, key, action):
+        """
+        Store action output files and metadata. Only output files located in
+        the action working directory are cached.
+        """
+        tmp_dir = os.path.join(action.tmp_dir, '')
+
+        files = {}
+        for resource in action.get_output_resources().itervalues():
+            path = self._get_resource_path(resource)
+            if not path or not os.path.isfile(path) or not path.startswith(tmp_dir):
+                return False
+            files[os.path.relpath(path, tmp_dir)] = path
+
+        manifest = {
+            'tmp_dir': tmp_dir,
+            'outputs': action.get_output_resources(),
+            'metadata': action.get_metadata(),
+        }
+
+        with self:
+            return self.put(key, files, manifest, hardlink=False)
+
+    def restore(self, key, action):
+        """
+        Restore cached output files into the action working directory and
+        update action resources. Return False on cache miss.
+        """
+        tmp_dir = os.path.join(action.tmp_dir, '')
+
+        with self:
+            manifest = self.get(key)
+            if not manifest:
+                return False
+
+            outputs = self._replace_prefix(manifest['outputs'], manifest['tmp_dir'], tmp_dir)
+            try:
+                for resource in outputs.itervalues():
+                    path = self._get_resource_path(resource)
+                    if os.path.exists(path):
+                        os.unlink(path)
+                    clone_file(self.get_file_path(key, os.path.relpath(path, tmp_dir)), path, hardlink=False)
+            except (IOError, OSError):
+                self.remove(key)
+                return False
+
+        action.resources['outputs'].update(outputs)
+        action.update_metadata(self._replace_prefix(manifest['metadata'], manifest['tmp_dir'], tmp_dir))
+        return True
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import json
+import hashlib
+
+from toolbox2.fileutils import get_file_identity, get_file_checksum
+
+
+class Checkpoint(object):
+    """
+    Persist worker completion records of an action, so a rerun of the same
+    action can skip workers whose outputs are still valid.
+
+    Each record holds a hash of the worker command line and parameters, the
+    identity of its input files when it started, and the size and checksum
+    of its output files.
+    """
+
+    def __init__(self, path, checksum=True):
+        """
+        :param path: path of the file used to persist records
+        :type path: string
+
+        :param checksum: whether output files content is checksummed
+        :type checksum: bool
+        """
+        self.path = path
+        self.checksum = checksum
+        self.records = {}
+        self.load()
+
+    def load(self):
+        """
+        Load records from disk. Missing or corrupted files are ignored.
+        """
+        try:
+            with open(self.path, 'r') as fileobj:
+                self.records = json.load(fileobj)
+        except (IOError, ValueError):
+            self.records = {}
+
+    def save(self):
+        """
+        Atomically write records to disk.
+        """
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as fileobj:
+            json.dump(self.records, fileobj)
+        os.rename(tmp_path, self.path)
+
+    def _get_worker_hash(self, worker):
+        data = [
+            worker.get_checkpoint_args(),
+            [(f.path, f.params) for f in worker.input_files],
+            [(f.path, f.params) for f in worker.output_files],
+        ]
+        buf = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.sha1(buf).hexdigest()
+
+    def _get_output(self, path):
+        output = get_file_identity(path)
+        if output and self.checksum and os.path.isfile(path):
+            output['checksum'] = get_file_checksum(path)
+        return output
+
+    def get_hash(self, worker, base_dir):
+        """
+        Return the hash of the worker command line and files. It must be
+        called before worker inputs are replaced by staged copies, since
+        records are checked against the original inputs.
+        """
+        worker.prepare(base_dir)
+        return self._get_worker_hash(worker)
+
+    def get_inputs(self, worker):
+        """
+        Return the identity of worker input files. It must be called before
+        the worker is run.
+        """
+        inputs = {}
+        for input_file in worker.input_files:
+            inputs[input_file.path] = get_file_identity(input_file.path)
+        return inputs
+
+    def is_valid(self, index, worker, base_dir):
+        """
+        Check if the worker at index has already been run with the same
+        command line and inputs, and if its outputs are still there.
+        """
+        record = self.records.get(str(index))
+        if not record or not worker.resumable:
+            return False
+
+        if record['hash'] != self.get_hash(worker, base_dir):
+            return False
+
+        for path, identity in record['inputs'].iteritems():
+            if get_file_identity(path) != identity:
+                return False
+
+        for path, output in record['outputs'].iteritems():
+            identity = get_file_identity(path)
+            if not identity or not output or identity['size'] != output['size']:
+                return False
+            if 'checksum' in output and get_file_checksum(path) != output['checksum']:
+                return False
+
+        return True
+
+    def invalidate(self, index):
+        """
+        Drop records of the worker at index and all following workers.
+        """
+        for key in self.records.keys():
+            if int(key) >= index:
+                del self.records[key]
+        self.save()
+
+    def add(self, index, worker, inputs, worker_hash):
+        """
+        Record the successful completion of the worker at index, with the
+        hash and inputs taken before it was run. Outputs of previous workers
+        modified in place by this worker are refreshed.
+        """
+        for record in self.records.itervalues():
+            for path, output in record['outputs'].iteritems():
+                identity = get_file_identity(path)
+                if output and identity and \
+                   (identity['size'] != output['size'] or identity['mtime'] != output['mtime']):
+                    record['outputs'][path] = self._get_output(path)
+
+        outputs = {}
+        for output_file in worker.output_files:
+            outputs[output_file.path] = self._get_output(output_file.path)
+
+        self.records[str(index)] = {
+            'hash': worker_hash,
+            'inputs': inputs,
+            'outputs': outputs,
+        }
+        self.save()
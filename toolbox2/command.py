@@ -9,15 +9,86 @@ import signal
 import errno
 import time
 
+from toolbox2 import posix
+from toolbox2.iosched import apply_io_class
+from toolbox2.state import get_process_state
+
 COMMAND_DEFAULT_TIMEOUT = 1
 COMMAND_DEFAULT_KILL_TIMEOUT = 3600
 COMMAND_DEFAULT_READ_SIZE = 4096
+COMMAND_DEFAULT_LAUNCHER = 'popen'
 
 
 class CommandException(Exception):
     pass
 
 
+class SpawnProcess(object):
+    """
+    Minimal subprocess.Popen replacement launching processes with
+    posix_spawn instead of fork. The child gets its standard outputs
+    redirected to pipes and SIGPIPE reset to its default disposition.
+    """
+
+    def __init__(self, args, cwd):
+        self.returncode = None
+
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        for fd in [stdout_r, stderr_r]:
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+        try:
+            self.pid = posix.spawn(args, cwd, stdout_w, stderr_w,
+                                   sigdefault=[signal.SIGPIPE, signal.SIGXFSZ])
+        except OSError:
+            os.close(stdout_r)
+            os.close(stderr_r)
+            raise
+        finally:
+            os.close(stdout_w)
+            os.close(stderr_w)
+
+        self.stdout = os.fdopen(stdout_r, 'rb')
+        self.stderr = os.fdopen(stderr_r, 'rb')
+
+    def _handle_exitstatus(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        elif os.WIFEXITED(status):
+            self.returncode = os.WEXITSTATUS(status)
+
+    def _waitpid(self, options):
+        while True:
+            try:
+                return os.waitpid(self.pid, options)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    # Already reaped elsewhere, its exit status is lost and
+                    # it is considered successful, as by subprocess.Popen
+                    return (self.pid, 0)
+                raise
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = self._waitpid(os.WNOHANG)
+            if pid == self.pid:
+                self._handle_exitstatus(status)
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            pid, status = self._waitpid(0)
+            if pid == self.pid:
+                self._handle_exitstatus(status)
+        return self.returncode
+
+    def kill(self):
+        os.kill(self.pid, signal.SIGKILL)
+
+
 class Command(object):
 
     def __init__(self, base_dir):
@@ -28,6 +99,12 @@ class Command(object):
         self.timeout = COMMAND_DEFAULT_TIMEOUT
         self.kill_timeout = COMMAND_DEFAULT_KILL_TIMEOUT
         self.read_size = COMMAND_DEFAULT_READ_SIZE
+        self.launcher = COMMAND_DEFAULT_LAUNCHER
+        self.rusage = None
+        self.io_class = None
+        self.suspended = False
+        self.suspended_time = 0
+        self.checked_at = 0
 
     def set_timeout(self, timeout):
         self.timeout = timeout
@@ -42,22 +119,45 @@ class Command(object):
         if self.memory_limit > 0:
             resource.setrlimit(resource.RLIMIT_AS, (self.memory_limit, self.memory_limit))
 
+    def _set_io_class(self, pid):
+        if self.io_class:
+            try:
+                apply_io_class(pid, self.io_class)
+            except (OSError, posix.PosixException):
+                pass
+
     def _preexec_fn(self):
         self._reset_sigpipe_handler()
         self._set_memory_limit()
+        self._set_io_class(0)
+
+    def _spawn(self, args):
+        self.process = SpawnProcess(args, self.base_dir)
+
+        if self.memory_limit > 0:
+            try:
+                posix.set_rlimit(self.process.pid, resource.RLIMIT_AS, self.memory_limit)
+            except (posix.PosixException, OSError):
+                self.process.kill()
+                self.process.wait()
+                raise
+        self._set_io_class(self.process.pid)
 
     def run(self, args):
         if (os.path.isdir(self.base_dir) == False):
             os.makedirs(self.base_dir)
 
         self.last_read = time.time()
-        self.process = subprocess.Popen(args,
-                                        cwd=self.base_dir,
-                                        bufsize=-1,
-                                        close_fds=True,
-                                        preexec_fn=self._preexec_fn,
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE)
+        if self.launcher == 'spawn' and posix.spawn_available():
+            self._spawn(args)
+        else:
+            self.process = subprocess.Popen(args,
+                                            cwd=self.base_dir,
+                                            bufsize=-1,
+                                            close_fds=True,
+                                            preexec_fn=self._preexec_fn,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.PIPE)
 
         fl = fcntl.fcntl(self.process.stdout, fcntl.F_GETFL)
         fcntl.fcntl(self.process.stdout, fcntl.F_SETFL, fl | os.O_NONBLOCK)
@@ -65,11 +165,40 @@ class Command(object):
         fl = fcntl.fcntl(self.process.stderr, fcntl.F_GETFL)
         fcntl.fcntl(self.process.stderr, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
+    def _poll(self):
+        """
+        Reap the process with wait4, which also returns its resource usage.
+        """
+        try:
+            pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+            # Already reaped, for example by a kill
+            self.process.poll()
+            return
+
+        if pid == self.process.pid:
+            self.rusage = rusage
+            if os.WIFSIGNALED(status):
+                self.process.returncode = -os.WTERMSIG(status)
+            elif os.WIFEXITED(status):
+                self.process.returncode = os.WEXITSTATUS(status)
+
+    def get_cpu_time(self):
+        """
+        Return user and system cpu time used by the process once it has
+        exited, in seconds.
+        """
+        if not self.rusage:
+            return 0
+        return self.rusage.ru_utime + self.rusage.ru_stime
+
     def wait(self, callback=None, loop=True):
 
         while self.process.returncode is None:
 
-            self.process.poll()
+            self._poll()
 
             file_r, file_w, file_x, = select.select([self.process.stdout, self.process.stderr],
                                                     [],
@@ -79,13 +208,28 @@ class Command(object):
             if not file_r and not file_w and not file_x:
                 if callback:
                     callback('', '')
+                # Stopped processes are suspended, not idle
+                now = time.time()
+                stopped = get_process_state(self.process.pid) == 'T'
+                if stopped:
+                    if self.suspended:
+                        self.suspended_time += now - self.checked_at
+                    self.last_read = now
+                self.suspended = stopped
+                self.checked_at = now
                 if (time.time() - self.last_read) > self.kill_timeout:
-                    self.process.kill()
+                    try:
+                        self.process.kill()
+                    except OSError:
+                        pass
+                    # Reap the process, so that it does not linger as a zombie
+                    self.process.wait()
                     raise CommandException('Process (pid = %s) has timed out' %
                                             (self.process.pid))
             else:
                 stdout = ''
                 stderr = ''
+                self.suspended = False
                 self.last_read = time.time()
                 for _file in file_r:
                     buf = self._read_all(_file)
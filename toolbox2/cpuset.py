@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import re
+import glob
+
+from toolbox2 import posix
+from toolbox2.state import SharedState, get_process_start_time, process_exists
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Parse a kernel cpu list such as '0-3,8,10-11'.
+    """
+    cpus = []
+    for chunk in cpu_list.strip().split(','):
+        if not chunk:
+            continue
+        if '-' in chunk:
+            first, last = chunk.split('-')
+            cpus += range(int(first), int(last) + 1)
+        else:
+            cpus.append(int(chunk))
+    return cpus
+
+
+def get_allowed_cpus():
+    """
+    Return cpus the current process is allowed to run on.
+    """
+    try:
+        with open('/proc/self/status', 'r') as fileobj:
+            for line in fileobj:
+                match = re.match('Cpus_allowed_list:\s+(.*)', line)
+                if match:
+                    return parse_cpu_list(match.group(1))
+    except IOError:
+        pass
+    return range(os.sysconf('SC_NPROCESSORS_ONLN'))
+
+
+def get_numa_nodes():
+    """
+    Return the list of allowed cpus of each NUMA node. Hosts without NUMA
+    information are described as a single node.
+    """
+    allowed = set(get_allowed_cpus())
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node*/cpulist')):
+        try:
+            with open(path, 'r') as fileobj:
+                cpus = [cpu for cpu in parse_cpu_list(fileobj.read()) if cpu in allowed]
+        except IOError:
+            continue
+        if cpus:
+            nodes.append(cpus)
+
+    if not nodes:
+        nodes = [sorted(allowed)]
+    return nodes
+
+
+class CPUSetAllocator(object):
+    """
+    Partition the cpus of a node between worker processes of all toolbox2
+    processes running on it. Each process gets as many cpus as it runs
+    threads, within a single NUMA node when possible. Cpus are shared only
+    when the node is oversubscribed. The partition is recomputed and applied
+    each time a process is registered or unregistered.
+    """
+
+    def __init__(self, state_path):
+        """
+        :param state_path: path of the file shared by all processes of the node
+        :type state_path: string
+        """
+        self.state_path = state_path
+        self.nodes = get_numa_nodes()
+
+    def _partition(self, processes):
+        load = {}
+        for node in self.nodes:
+            for cpu in node:
+                load[cpu] = 0
+        nb_cpus = len(load)
+
+        cpusets = {}
+        for key, process in sorted(processes.iteritems(), key=lambda item: item[1]['registered']):
+            size = min(process['threads'], nb_cpus)
+
+            # Prefer the node with the most idle cpus, then its least loaded cpus
+            def node_score(node):
+                loads = sorted([load[cpu] for cpu in node])
+                return (sum(loads[:size]), -len(node))
+
+            nodes = sorted(self.nodes, key=node_score)
+            candidates = []
+            for node in nodes:
+                candidates += sorted(node, key=lambda cpu: (load[cpu], cpu))
+
+            cpus = sorted(sorted(candidates, key=lambda cpu: load[cpu])[:size])
+            for cpu in cpus:
+                load[cpu] += 1
+            cpusets[key] = cpus
+        return cpusets
+
+    def _apply(self, pid, cpus):
+        try:
+            tids = [int(tid) for tid in os.listdir('/proc/%d/task' % pid)]
+        except OSError:
+            return
+        for tid in tids:
+            try:
+                posix.set_affinity(tid, cpus)
+            except (OSError, posix.PosixException):
+                pass
+
+    def _update(self, state):
+        processes = state.data.setdefault('processes', {})
+        for key, process in processes.items():
+            if not process_exists(process['pid'], process['start_time']):
+                del processes[key]
+
+        cpusets = self._partition(processes)
+        for key, cpus in cpusets.iteritems():
+            process = processes[key]
+            if process.get('cpus') != cpus:
+                self._apply(process['pid'], cpus)
+                process['cpus'] = cpus
+
+    def acquire(self, pid, threads):
+        """
+        Register a process running the given number of threads and pin it.
+
+        :return: cpus assigned to the process
+        :rtype: list
+        """
+        start_time = get_process_start_time(pid)
+        if start_time is None:
+            return []
+
+        with SharedState(self.state_path) as state:
+            processes = state.data.setdefault('processes', {})
+            state.data['sequence'] = state.data.get('sequence', 0) + 1
+            processes[str(pid)] = {
+                'pid': pid,
+                'start_time': start_time,
+                'threads': threads,
+                'registered': state.data['sequence'],
+            }
+            self._update(state)
+            return processes.get(str(pid), {}).get('cpus', [])
+
+    def release(self, pid):
+        """
+        Unregister a process and rebalance the remaining ones.
+        """
+        with SharedState(self.state_path) as state:
+            state.data.setdefault('processes', {}).pop(str(pid), None)
+            self._update(state)
+
+    def get_processes(self):
+        """
+        Return registered processes which are still running.
+        """
+        with SharedState(self.state_path) as state:
+            self._update(state)
+            return state.data['processes'].values()
+
+
+def get_cpu_share(allocator=None):
+    """
+    Return how many cpus a new job can expect to use on this node. Running
+    processes are taken from the allocator when one is configured, and
+    estimated from the load average otherwise.
+
+    :param allocator: allocator shared by toolbox2 processes of the node
+    :type allocator: CPUSetAllocator
+    """
+    nb_cpus = len(get_allowed_cpus())
+
+    if allocator:
+        processes = allocator.get_processes()
+        busy = sum([min(process['threads'], nb_cpus) for process in processes])
+        fair_share = nb_cpus / (len(processes) + 1)
+        share = max(nb_cpus - busy, fair_share)
+    else:
+        share = int(nb_cpus - os.getloadavg()[0])
+
+    return max(share, 1)
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import time
+import socket
+import threading
+import SocketServer
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from toolbox2 import Loader
+from toolbox2.action import get_config
+from toolbox2.batch import run_job, get_runtime_model
+from toolbox2.exception import Toolbox2Exception
+from toolbox2.scheduler import Scheduler, SCHEDULER_DEFAULT_AGING
+
+
+class DaemonException(Toolbox2Exception):
+    pass
+
+
+def get_job_priority(job):
+    """
+    Return the priority parameter of a job, 0 if it has none.
+    """
+    try:
+        return int((job.get('params') or {}).get('priority', 0))
+    except (TypeError, ValueError, AttributeError):
+        return 0
+
+
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handle a single client connection. The client sends a job as a JSON
+    line, the same way as toolbox2 --path files, and receives events as JSON
+    lines until its action is done:
+
+        {"event": "queued", "id": ...}
+        {"event": "started", "id": ...}
+        {"event": "progress", "id": ..., "progress": ..., "running_time": ..., "suspended_time": ..., "eta": ..., "metadata": {...}}
+        {"event": "done", "id": ..., "status": "done" or "error", "outputs": {...}, "metadata": {...}, "error": ...}
+
+    A {"command": "status"} line returns the number of running and queued
+    jobs instead.
+    """
+
+    def _send(self, event):
+        if self.disconnected:
+            return
+        try:
+            self.wfile.write(json.dumps(event, default=str) + '\n')
+            self.wfile.flush()
+        except socket.error:
+            # The action goes on even if nobody listens anymore
+            self.disconnected = True
+
+    def handle(self):
+        self.disconnected = False
+        daemon = self.server.runner
+
+        line = self.rfile.readline()
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError('Job must be a JSON object')
+        except ValueError, exc:
+            self._send({'event': 'done', 'status': 'error', 'error': 'Invalid job: %s' % exc})
+            return
+
+        if job.get('command') == 'status':
+            self._send(dict(daemon.get_status(), event='status'))
+            return
+
+        sequence = daemon.get_sequence()
+        job_id = str(job.get('id', sequence))
+        cost = daemon.predict(job)
+        self._send({'event': 'queued', 'id': job_id, 'predicted_time': cost})
+
+        def callback(action):
+            self._send({
+                'event': 'progress',
+                'id': job_id,
+                'progress': action.progress,
+                'running_time': action.running_time,
+                'suspended_time': action.suspended_time,
+                'eta': action.get_eta(),
+                'metadata': action.get_metadata(),
+            })
+
+        result = daemon.run_job(sequence, job, lambda: self._send({'event': 'started', 'id': job_id}), callback, cost)
+        result.update(event='done', id=job_id)
+        self._send(result)
+
+
+class DaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """
+    Resident process running actions submitted over a Unix domain socket.
+    Actions are discovered and configuration is parsed once at startup, and
+    at most concurrency actions run at the same time, other ones wait for a
+    free slot. With sjf policy, the waiting job with the shortest expected
+    runtime, corrected by aging, gets the next slot.
+    """
+
+    def __init__(self, log, socket_path, base_dir, concurrency=1, policy='fifo', aging=SCHEDULER_DEFAULT_AGING):
+        """
+        :param log: logger instance to use
+        :type log: logging.Logger
+
+        :param socket_path: path of the Unix socket to listen on
+        :type socket_path: string
+
+        :param base_dir: default working base directory of actions
+        :type base_dir: string
+
+        :param concurrency: number of actions run at the same time
+        :type concurrency: int
+
+        :param policy: scheduling policy of waiting jobs: fifo or sjf
+        :type policy: string
+
+        :param aging: seconds of expected runtime forgiven per second waited
+        :type aging: float
+        """
+        if concurrency < 1:
+            raise DaemonException('Concurrency must be at least 1')
+
+        self.log = log
+        self.socket_path = socket_path
+        self.base_dir = base_dir
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.prefix = '%.6f' % time.time()
+        self.server = None
+
+        Loader()
+        preemption = False
+        try:
+            preemption = get_config().has_section('preemption')
+        except (Exception, IOError), exc:
+            self.log.warning('%s', exc)
+        # Urgent jobs only bypass concurrency if they preempt other ones
+        self.scheduler = Scheduler(concurrency, policy, aging, preemption)
+
+        self.model = None
+        if policy == 'sjf':
+            self.model = get_runtime_model(log)
+
+    def get_sequence(self):
+        """
+        Return a number identifying a new job in this daemon.
+        """
+        with self.lock:
+            self.sequence += 1
+            return self.sequence
+
+    def get_status(self):
+        return dict(self.scheduler.get_status(), concurrency=self.concurrency)
+
+    def predict(self, job):
+        """
+        Return the expected runtime of a job, 0 with fifo policy.
+        """
+        if not self.model:
+            return 0
+        try:
+            return self.model.predict(job.get('action'), job.get('params'), job.get('resources'))
+        except (TypeError, AttributeError):
+            return 0
+
+    def run_job(self, sequence, job, on_start=None, callback=None, cost=0):
+        """
+        Wait for a free slot and run a job.
+
+        :param sequence: job number returned by get_sequence
+        :type sequence: int
+
+        :param on_start: called once the job leaves the queue
+        :type on_start: callable()
+
+        :param callback: user defined callback passed to the action
+        :type callback: callable(action)
+
+        :param cost: expected runtime of the job in seconds
+        :type cost: float
+        """
+        priority = get_job_priority(job)
+        self.scheduler.acquire(cost, priority)
+        try:
+            if on_start:
+                on_start()
+            action_id = '%s-%s' % (self.prefix, sequence)
+            self.log.info('Running job %s (action = %s)', action_id, job.get('action'))
+            return run_job(self.log, self.base_dir, action_id, job, callback)
+        finally:
+            self.scheduler.release(priority)
+
+    def serve_forever(self):
+        """
+        Listen on the socket and serve clients until interrupted.
+        """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        dirname = os.path.dirname(self.socket_path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.server = DaemonServer(self.socket_path, DaemonRequestHandler)
+        self.server.runner = self
+        self.log.info('Listening on %s (concurrency = %d)', self.socket_path, self.concurrency)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+def submit(socket_path, job, callback=None):
+    """
+    Submit a job to a daemon and wait for its result.
+
+    :param socket_path: path of the daemon socket
+    :type socket_path: string
+
+    :param job: action, params and resources of the job
+    :type job: dict
+
+    :param callback: called with each event received before the result
+    :type callback: callable(event)
+
+    :return: the done event, holding the action result
+    :rtype: dict
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        fileobj = sock.makefile('r+b')
+        fileobj.write(json.dumps(job) + '\n')
+        fileobj.flush()
+
+        for line in iter(fileobj.readline, ''):
+            event = json.loads(line)
+            if event.get('event') in ['done', 'status']:
+                return event
+            if callable(callback):
+                callback(event)
+    finally:
+        sock.close()
+
+    raise DaemonException('Connection to %s closed before the job was done' % socket_path)
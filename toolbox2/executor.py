@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import time
+import errno
+import select
+import socket
+import threading
+import ConfigParser
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from toolbox2.agent import parse_address, decode_output
+from toolbox2.command import Command, CommandException
+from toolbox2.command import COMMAND_DEFAULT_TIMEOUT, COMMAND_DEFAULT_KILL_TIMEOUT, COMMAND_DEFAULT_READ_SIZE
+from toolbox2.command import COMMAND_DEFAULT_LAUNCHER
+from toolbox2.exception import Toolbox2Exception
+
+EXECUTOR_TYPES = ['local', 'pool', 'agent']
+EXECUTOR_DEFAULT_CONNECT_TIMEOUT = 10
+
+
+class ExecutorException(Toolbox2Exception):
+    pass
+
+
+class LocalExecutor(object):
+    """
+    Run worker commands as local processes. Executors create the command of
+    each worker run, and are told once its process has exited.
+    """
+
+    # Local processes can be pinned to cpus and sampled from /proc
+    is_local = True
+
+    def reserve(self, count):
+        """
+        Reserve the slots of count commands created afterwards with
+        reserved=True, so that workers running in parallel start together.
+        """
+        pass
+
+    def unreserve(self, count):
+        """
+        Give back reserved slots which have not been used by a command.
+        """
+        pass
+
+    def create_command(self, base_dir, reserved=False):
+        """
+        Return a command to run in base_dir, see toolbox2.command.Command.
+
+        :param reserved: whether the slot of the command has been reserved
+        :type reserved: bool
+        """
+        return Command(base_dir)
+
+    def release(self, command):
+        """
+        Called once the process of a command has exited or has been killed.
+        """
+        pass
+
+
+class PoolExecutor(LocalExecutor):
+    """
+    Run at most size local processes at the same time among all workers
+    sharing the executor, other workers wait for a free slot before
+    launching their process. Workers running in parallel take their slots
+    at once, so that they never hold part of the pool while waiting for
+    the rest.
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ExecutorException('Pool size must be at least 1')
+        self.size = size
+        self.available = size
+        self.condition = threading.Condition()
+
+    def reserve(self, count):
+        if count > self.size:
+            raise ExecutorException('Pool size %d is smaller than %d parallel workers' % (self.size, count))
+        with self.condition:
+            while self.available < count:
+                self.condition.wait()
+            self.available -= count
+
+    def unreserve(self, count):
+        with self.condition:
+            self.available += count
+            self.condition.notify_all()
+
+    def create_command(self, base_dir, reserved=False):
+        if not reserved:
+            self.reserve(1)
+        command = Command(base_dir)
+        command.pool_slot = True
+        return command
+
+    def release(self, command):
+        if getattr(command, 'pool_slot', False):
+            command.pool_slot = False
+            self.unreserve(1)
+
+
+class RemoteProcess(object):
+    """
+    Process run by an agent, with the subset of the subprocess.Popen
+    interface used by workers.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        self.pid = None
+        self.returncode = None
+        self.cpu_time = 0
+        self.error = None
+
+    def read_events(self, timeout=None):
+        """
+        Return events received within timeout, None for no timeout. Raise
+        a CommandException if the connection is lost before the process
+        exits.
+        """
+        try:
+            readable = select.select([self.sock], [], [], timeout)[0]
+        except select.error, exc:
+            if exc.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, exc:
+            raise CommandException('Connection to agent lost: %s' % exc)
+        if not data:
+            raise CommandException('Connection to agent lost')
+
+        lines = (self.buf + data).split('\n')
+        self.buf = lines.pop()
+        events = []
+        for line in lines:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                raise CommandException('Invalid event from agent: %s' % line)
+            if event.get('event') == 'exit':
+                self.returncode = event.get('returncode')
+                self.cpu_time = event.get('cpu_time', 0)
+                self.sock.close()
+            elif event.get('event') == 'error':
+                self.error = event.get('error')
+                self.sock.close()
+                raise CommandException('Agent error: %s' % self.error)
+            events.append(event)
+        return events
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                self.read_events()
+            except CommandException:
+                # The agent kills processes of lost connections
+                self.returncode = -1
+        return self.returncode
+
+    def kill(self):
+        if self.returncode is not None:
+            return
+        try:
+            self.sock.sendall(json.dumps({'command': 'kill'}) + '\n')
+        except socket.error:
+            pass
+
+
+class RemoteCommand(object):
+    """
+    Command run by an agent, with the same interface as Command. Process
+    output is streamed back as it is produced, so that workers parse it
+    the same way as output of local processes.
+    """
+
+    def __init__(self, base_dir, address, connect_timeout=EXECUTOR_DEFAULT_CONNECT_TIMEOUT, secret=None):
+        self.base_dir = base_dir
+        self.address = address
+        self.secret = secret
+        self.connect_timeout = connect_timeout
+        self.process = None
+        self.memory_limit = 0
+        self.last_read = 0
+        self.timeout = COMMAND_DEFAULT_TIMEOUT
+        self.kill_timeout = COMMAND_DEFAULT_KILL_TIMEOUT
+        self.read_size = COMMAND_DEFAULT_READ_SIZE
+        self.launcher = COMMAND_DEFAULT_LAUNCHER
+        # Processes of agents are not preempted
+        self.suspended = False
+        self.suspended_time = 0
+        self.pending = []
+
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+
+    def set_read_size(self, read_size):
+        self.read_size = read_size
+
+    def _connect(self):
+        family, address = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock.connect(address)
+        except socket.error, exc:
+            sock.close()
+            raise CommandException('Could not connect to agent %s: %s' % (self.address, exc))
+        sock.settimeout(None)
+        return sock
+
+    def run(self, args):
+        """
+        Send the command to the agent and wait for its process to start,
+        which may wait for a free slot on the agent.
+        """
+        sock = self._connect()
+        self.process = RemoteProcess(sock)
+        request = {
+            'command': 'run',
+            'args': [str(arg) for arg in args],
+            'cwd': self.base_dir,
+            'memory_limit': self.memory_limit,
+            'kill_timeout': self.kill_timeout,
+        }
+        if self.secret:
+            request['secret'] = self.secret
+        try:
+            sock.sendall(json.dumps(request) + '\n')
+        except socket.error, exc:
+            sock.close()
+            raise CommandException('Could not send command to agent %s: %s' % (self.address, exc))
+
+        self.pending = []
+        while self.process.pid is None:
+            for event in self.process.read_events():
+                if event.get('event') == 'started':
+                    self.process.pid = event.get('pid')
+                else:
+                    self.pending.append(event)
+        self.last_read = time.time()
+
+    def get_cpu_time(self):
+        return self.process and self.process.cpu_time or 0
+
+    def wait(self, callback=None, loop=True):
+
+        while self.process.returncode is None or self.pending:
+
+            events = self.pending or self.process.read_events(self.timeout)
+            self.pending = []
+            stdout = ''.join([decode_output(event.get('stdout', '')) for event in events])
+            stderr = ''.join([decode_output(event.get('stderr', '')) for event in events])
+
+            if not stdout and not stderr:
+                if callback:
+                    callback('', '')
+                if (time.time() - self.last_read) > self.kill_timeout:
+                    self.process.kill()
+                    raise CommandException('Process (pid = %s) has timed out' %
+                                           (self.process.pid))
+            else:
+                self.last_read = time.time()
+                if callback:
+                    callback(stdout, stderr)
+            if not loop:
+                break
+
+        return self.process.returncode
+
+
+class AgentExecutor(object):
+    """
+    Run worker commands on a remote node through a toolbox2-agent, see
+    toolbox2.agent.Agent. Paths in commands must be valid on the agent
+    node, usually on a shared filesystem.
+    """
+
+    is_local = False
+
+    def __init__(self, address, connect_timeout=EXECUTOR_DEFAULT_CONNECT_TIMEOUT, secret=None):
+        """
+        :param address: path of a Unix socket or host:port of the agent
+        :type address: string
+
+        :param secret: secret shared with the agent
+        :type secret: string
+        """
+        parse_address(address)
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self.secret = secret
+
+    def reserve(self, count):
+        pass
+
+    def unreserve(self, count):
+        pass
+
+    def create_command(self, base_dir, reserved=False):
+        return RemoteCommand(base_dir, self.address, self.connect_timeout, self.secret)
+
+    def release(self, command):
+        pass
+
+
+LOCAL_EXECUTOR = LocalExecutor()
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(conf, tool):
+    """
+    Return the executor of a tool described in configuration, the local
+    executor if there is none. Executors are shared by all workers of the
+    process, so that pool slots are.
+
+    :param conf: parsed configuration file
+    :type conf: ConfigParser.SafeConfigParser
+
+    :param tool: tool name
+    :type tool: string
+    """
+    try:
+        executor_type = conf.get('executor', 'type')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return LOCAL_EXECUTOR
+
+    if conf.has_option('executor', 'tools'):
+        tools = [name.strip() for name in conf.get('executor', 'tools').split(',')]
+        if tool not in tools:
+            return LOCAL_EXECUTOR
+
+    if executor_type not in EXECUTOR_TYPES:
+        raise ExecutorException('Unknown executor type: %s' % executor_type)
+    if executor_type == 'local':
+        return LOCAL_EXECUTOR
+
+    try:
+        if executor_type == 'pool':
+            key = (executor_type, conf.getint('executor', 'size'))
+        else:
+            key = (executor_type, conf.get('executor', 'address'))
+    except (ConfigParser.NoOptionError, ValueError), exc:
+        raise ExecutorException('Invalid %s executor configuration: %s' % (executor_type, exc))
+
+    with _executors_lock:
+        if key not in _executors:
+            if executor_type == 'pool':
+                _executors[key] = PoolExecutor(key[1])
+            else:
+                secret = None
+                if conf.has_option('executor', 'secret'):
+                    secret = conf.get('executor', 'secret')
+                _executors[key] = AgentExecutor(key[1], secret=secret)
+        return _executors[key]
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import errno
+import fcntl
+import shutil
+import hashlib
+
+FILE_DEFAULT_READ_SIZE = 1024 * 1024
+
+# Linux ioctl cloning a file content on copy-on-write filesystems
+FICLONE = 0x40049409
+
+
+def get_file_identity(path):
+    """
+    Return a cheap identity of a file based on its metadata, or None if the
+    file does not exist.
+
+    :param path: path of the file
+    :type path: string
+
+    :return: file identity
+    :rtype: dict
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return {
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'ino': st.st_ino,
+    }
+
+
+def get_file_checksum(path, read_size=FILE_DEFAULT_READ_SIZE):
+    """
+    Return the md5 checksum of a file content as an hexadecimal string.
+
+    :param path: path of the file
+    :type path: string
+    """
+    checksum = hashlib.md5()
+    with open(path, 'rb') as fileobj:
+        while True:
+            buf = fileobj.read(read_size)
+            if not buf:
+                break
+            checksum.update(buf)
+    return checksum.hexdigest()
+
+
+def copy_file(src, dst, throttle=None, read_size=FILE_DEFAULT_READ_SIZE):
+    """
+    Copy the content of a file, within a bandwidth budget if given.
+
+    :param throttle: bandwidth budget consumed by the copy
+    :type throttle: toolbox2.iosched.TokenBucket
+    """
+    if not throttle:
+        shutil.copyfile(src, dst)
+        return
+
+    with open(src, 'rb') as src_obj:
+        with open(dst, 'wb') as dst_obj:
+            while True:
+                buf = src_obj.read(read_size)
+                if not buf:
+                    break
+                throttle.consume(len(buf))
+                dst_obj.write(buf)
+
+
+def clone_file(src, dst, hardlink=True, throttle=None):
+    """
+    Make dst a copy of src as cheaply as possible: a copy-on-write clone
+    (reflink) when the filesystem supports it, then a hard link if allowed,
+    and a regular copy otherwise.
+
+    :param src: path of the source file
+    :type src: string
+
+    :param dst: path of the destination file, which must not exist
+    :type dst: string
+
+    :param hardlink: allow src and dst to share the same inode
+    :type hardlink: bool
+
+    :param throttle: bandwidth budget consumed by a regular copy
+    :type throttle: toolbox2.iosched.TokenBucket
+    """
+    dst_dir = os.path.dirname(dst)
+    if dst_dir and not os.path.isdir(dst_dir):
+        os.makedirs(dst_dir)
+
+    with open(src, 'rb') as src_obj:
+        with open(dst, 'wb') as dst_obj:
+            try:
+                fcntl.ioctl(dst_obj.fileno(), FICLONE, src_obj.fileno())
+                return
+            except (IOError, OSError):
+                pass
+
+    if hardlink:
+        try:
+            os.unlink(dst)
+            os.link(src, dst)
+            return
+        except OSError, exc:
+            if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+
+    copy_file(src, dst, throttle)
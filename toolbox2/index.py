@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import struct
+import bisect
+import hashlib
+from array import array
+
+from toolbox2.cache import DirectoryCache
+from toolbox2.exception import Toolbox2Exception
+from toolbox2.fileutils import get_file_identity
+
+INDEX_MAGIC = 'TB2INDEX'
+INDEX_VERSION = 1
+
+
+class PacketIndexException(Toolbox2Exception):
+    pass
+
+
+class PacketIndex(object):
+    """
+    Index of the packets of a stream in decoding order: presentation and
+    decoding times in seconds, byte offsets, sizes and keyframe flags. Each
+    field is stored in an array, so that an index takes about 29 bytes per
+    packet, and is saved as a binary file:
+
+        magic, header size (uint32), json header, then each array
+    """
+
+    # Field name and array type code, in file order
+    fields = [
+        ('pts', 'd'),
+        ('dts', 'd'),
+        ('pos', 'd'),
+        ('size', 'I'),
+        ('keyframe', 'B'),
+    ]
+
+    def __init__(self, header=None):
+        """
+        :param header: description of the indexed stream and file
+        :type header: dict
+        """
+        self.header = header or {}
+        for name, typecode in self.fields:
+            setattr(self, name, array(typecode))
+        self.keyframes = array('I')
+        self.keyframe_times = array('d')
+
+    def add_packet(self, pts, dts, pos, size, keyframe):
+        """
+        Append a packet, in decoding order. Unknown times and offsets are
+        given as None.
+        """
+        if dts is None:
+            dts = self.dts and self.dts[-1] or 0.0
+        if pts is None:
+            pts = dts
+        if keyframe:
+            self.keyframes.append(len(self.pts))
+            self.keyframe_times.append(pts)
+        self.pts.append(pts)
+        self.dts.append(dts)
+        self.pos.append(pos is None and -1.0 or pos)
+        self.size.append(size)
+        self.keyframe.append(keyframe and 1 or 0)
+
+    def __len__(self):
+        return len(self.pts)
+
+    def get_frame_count(self):
+        return len(self.pts)
+
+    def get_keyframe_count(self):
+        return len(self.keyframes)
+
+    def get_keyframe(self, time):
+        """
+        Return the index of the last keyframe presented at or before time,
+        which is where decoding must start to present time, or the first
+        keyframe if time is before it. Return None if there is no keyframe.
+        """
+        if not self.keyframes:
+            return None
+        position = bisect.bisect_right(self.keyframe_times, time) - 1
+        return self.keyframes[max(position, 0)]
+
+    def get_nearest_keyframe(self, time):
+        """
+        Return the index of the keyframe presented the closest to time.
+        """
+        if not self.keyframes:
+            return None
+        position = bisect.bisect_left(self.keyframe_times, time)
+        candidates = self.keyframes[max(position - 1, 0):position + 1]
+        return min(candidates, key=lambda idx: abs(self.pts[idx] - time))
+
+    def get_byte_range(self, start, end=None):
+        """
+        Return the byte range of the file to read to decode packets
+        presented between start and end: from the keyframe preceding start
+        to the first packet decoded after end. The end offset is None when
+        the range goes to the end of file.
+
+        :rtype: tuple
+        """
+        first = self.get_keyframe(start)
+        if first is None:
+            raise PacketIndexException('Index holds no keyframe')
+
+        last = None
+        if end is not None:
+            position = bisect.bisect_right(self.dts, end)
+            # Packets presented up to end may be decoded after it
+            next_keyframe = bisect.bisect_right(self.keyframes, position - 1)
+            if next_keyframe < len(self.keyframes):
+                last = self.keyframes[next_keyframe]
+
+        end_offset = None
+        if last is not None and self.pos[last] >= 0:
+            end_offset = int(self.pos[last])
+        return (int(self.pos[first]), end_offset)
+
+    def get_gop_sizes(self):
+        """
+        Return the number of packets of each GOP, from a keyframe to the
+        next one.
+        """
+        bounds = list(self.keyframes) + [len(self.pts)]
+        return [bounds[i + 1] - bounds[i] for i in range(len(bounds) - 1)]
+
+    def get_summary(self):
+        gop_sizes = self.get_gop_sizes()
+        return {
+            'nb_packets': self.get_frame_count(),
+            'nb_keyframes': self.get_keyframe_count(),
+            'gop_size_max': gop_sizes and max(gop_sizes) or 0,
+            'duration': self.pts and (max(self.pts) - min(self.pts)) or 0,
+        }
+
+    def save(self, path):
+        header = dict(self.header, version=INDEX_VERSION, byteorder=sys.byteorder, count=len(self.pts))
+        buf = json.dumps(header)
+        tmp_path = '%s.tmp-%s' % (path, os.getpid())
+        with open(tmp_path, 'wb') as fileobj:
+            fileobj.write(INDEX_MAGIC)
+            fileobj.write(struct.pack('<I', len(buf)))
+            fileobj.write(buf)
+            for name, _ in self.fields:
+                getattr(self, name).tofile(fileobj)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fileobj:
+            if fileobj.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise PacketIndexException('%s is not a packet index' % path)
+            try:
+                size = struct.unpack('<I', fileobj.read(4))[0]
+                header = json.loads(fileobj.read(size))
+            except (struct.error, ValueError), exc:
+                raise PacketIndexException('%s header is corrupted: %s' % (path, exc))
+            if header.get('version') != INDEX_VERSION:
+                raise PacketIndexException('%s has unsupported version %s' % (path, header.get('version')))
+
+            index = cls(header)
+            for name, _ in cls.fields:
+                values = getattr(index, name)
+                try:
+                    values.fromfile(fileobj, header['count'])
+                except EOFError:
+                    raise PacketIndexException('%s is truncated' % path)
+                if header['byteorder'] != sys.byteorder:
+                    values.byteswap()
+
+        for idx, keyframe in enumerate(index.keyframe):
+            if keyframe:
+                index.keyframes.append(idx)
+                index.keyframe_times.append(index.pts[idx])
+        return index
+
+
+class IndexCache(DirectoryCache):
+    """
+    Packet indexes of media files, keyed by their real path and identity,
+    so that an index is built once per version of a file.
+    """
+
+    name = 'index.bin'
+
+    def get_key(self, path):
+        """
+        Return the key of a file, or None if it does not exist.
+        """
+        path = os.path.realpath(path)
+        identity = get_file_identity(path)
+        if identity is None:
+            return None
+        buf = '%s:%s:%s:%s' % (path, identity['size'], identity['mtime'], identity['ino'])
+        return hashlib.sha1(buf).hexdigest()
+
+    def get_index_path(self, key):
+        """
+        Return the path of a cached index, or None on cache miss.
+        """
+        with self:
+            if not self.get(key):
+                return None
+            path = self.get_file_path(key, self.name)
+            if not os.path.isfile(path):
+                self.remove(key)
+                return None
+            return path
+
+    def load(self, key):
+        """
+        Return a cached index, or None on cache miss.
+        """
+        path = self.get_index_path(key)
+        if not path:
+            return None
+        try:
+            return PacketIndex.load(path)
+        except (IOError, PacketIndexException):
+            with self:
+                self.remove(key)
+            return None
+
+    def store(self, key, path, source):
+        """
+        Store an index file built for a source file.
+        """
+        with self:
+            return self.put(key, {self.name: path}, {'source': os.path.realpath(source)})
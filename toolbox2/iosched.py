@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import time
+import threading
+
+from toolbox2 import posix
+
+IO_DEFAULT_CLASS = 'normal'
+
+# I/O scheduling class, level within the class and nice value of worker
+# processes of each action I/O class, None to leave them unchanged
+IO_CLASSES = {
+    'realtime': (posix.IOPRIO_CLASS_RT, 4, 0),
+    'high': (posix.IOPRIO_CLASS_BE, 0, 0),
+    'normal': None,
+    'low': (posix.IOPRIO_CLASS_BE, 7, 10),
+    'idle': (posix.IOPRIO_CLASS_IDLE, 0, 19),
+}
+
+
+def apply_io_class(pid, io_class):
+    """
+    Set the I/O priority and nice value of all threads of a process. The
+    realtime class requires CAP_SYS_ADMIN, and lowering nice values
+    CAP_SYS_NICE.
+
+    :param pid: process identifier, 0 for the calling thread only
+    :type pid: int
+
+    :param io_class: one of IO_CLASSES names
+    :type io_class: string
+    """
+    settings = IO_CLASSES[io_class]
+    if settings is None:
+        return
+    ioclass, level, nice = settings
+
+    tids = [0]
+    if pid:
+        tids = [int(tid) for tid in os.listdir('/proc/%d/task' % pid)]
+    for tid in tids:
+        posix.set_ioprio(tid, ioclass, level)
+        posix.set_priority(tid, nice)
+
+
+class TokenBucket(object):
+    """
+    Bandwidth budget shared by the I/O of an action. Copies done by toolbox2
+    itself consume tokens and wait for them when the budget is exhausted,
+    I/O of external tools is charged without waiting, so that it delays the
+    copies running meanwhile.
+    """
+
+    def __init__(self, rate, burst=0):
+        """
+        :param rate: budget in bytes per second
+        :type rate: int
+
+        :param burst: bytes which can be consumed at once after idle time,
+                      defaults to one second of budget
+        :type burst: int
+        """
+        self.rate = float(rate)
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+        self.copied_bytes = 0
+        self.charged_bytes = 0
+        self.throttled_time = 0
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.tokens + (now - self.updated_at) * self.rate, self.burst)
+        self.updated_at = now
+
+    def consume(self, size):
+        """
+        Take tokens for size bytes, waiting until the budget allows it.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens -= size
+            self.copied_bytes += size
+            wait = max(-self.tokens / self.rate, 0)
+            self.throttled_time += wait
+        if wait:
+            time.sleep(wait)
+
+    def charge(self, size):
+        """
+        Take tokens for size bytes already transferred. The debt is bounded
+        to a burst, so that copies keep progressing under external load.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = max(self.tokens - size, -self.burst)
+            self.charged_bytes += size
+
+    def get_summary(self):
+        with self.lock:
+            return {
+                'budget': int(self.rate),
+                'copied_bytes': self.copied_bytes,
+                'charged_bytes': self.charged_bytes,
+                'throttled_time': round(self.throttled_time, 2),
+            }
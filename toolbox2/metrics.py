@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import time
+import sqlite3
+import threading
+import ConfigParser
+
+# Runtime of a job of an unknown group, per input byte, in seconds
+MODEL_DEFAULT_SECONDS_PER_BYTE = 1.0 / (50 * 1024 * 1024)
+MODEL_DEFAULT_SAMPLES = 200
+MODEL_MIN_SAMPLES = 3
+MODEL_CACHE_TTL = 60
+
+
+def get_job_group(action, params):
+    """
+    Return the group of a job. Jobs of a group are expected to have a
+    runtime proportional to the size of their inputs.
+
+    :param action: action name
+    :type action: string
+
+    :param params: action parameters
+    :type params: dict
+    """
+    params = params or {}
+    return '%s:%s:%s' % (action, params.get('video_codec', ''), params.get('muxer', ''))
+
+
+def get_input_size(resources):
+    """
+    Return the total size in bytes of input files of action resources.
+    """
+    size = 0
+    for resource in (resources or {}).get('inputs', {}).itervalues():
+        path = resource.get('path')
+        try:
+            if path:
+                size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+def get_metrics_store(conf):
+    """
+    Return the metrics store described in configuration, or None if it is
+    not configured.
+
+    :param conf: parsed configuration file
+    :type conf: ConfigParser.SafeConfigParser
+    """
+    try:
+        path = conf.get('metrics', 'path')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return None
+    return MetricsStore(path)
+
+
+class MetricsStore(object):
+    """
+    SQLite database of metrics of completed jobs: features of their input
+    and parameters, wall and cpu time. It may be shared by processes of a
+    node, each thread uses its own connection.
+    """
+
+    columns = [
+        ('group_key', 'TEXT'),
+        ('action', 'TEXT'),
+        ('input_size', 'INTEGER'),
+        ('duration', 'REAL'),
+        ('resolution', 'TEXT'),
+        ('fps', 'REAL'),
+        ('video_codec', 'TEXT'),
+        ('muxer', 'TEXT'),
+        ('decoding_threads', 'INTEGER'),
+        ('encoding_threads', 'INTEGER'),
+        ('wall_time', 'REAL'),
+        ('cpu_time', 'REAL'),
+        ('created_at', 'REAL'),
+    ]
+
+    def __init__(self, path):
+        """
+        :param path: path of the database file
+        :type path: string
+        """
+        self.path = path
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs (%s)' % ', '.join(['%s %s' % column for column in self.columns]))
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_group ON jobs (group_key, created_at)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, metrics):
+        """
+        Store metrics of a completed job.
+
+        :param metrics: column values, missing ones are stored as NULL
+        :type metrics: dict
+        """
+        metrics = dict(metrics, created_at=time.time())
+        names = [name for name, _ in self.columns]
+        with self._connect() as conn:
+            conn.execute('INSERT INTO jobs (%s) VALUES (%s)' % (', '.join(names), ', '.join(['?'] * len(names))),
+                         [metrics.get(name) for name in names])
+
+    def get_samples(self, column, value, limit=MODEL_DEFAULT_SAMPLES):
+        """
+        Return input size and wall time of the latest jobs matching a
+        column value.
+
+        :rtype: list
+        """
+        with self._connect() as conn:
+            cursor = conn.execute('SELECT input_size, wall_time FROM jobs WHERE %s = ? AND input_size > 0 '
+                                  'ORDER BY created_at DESC LIMIT ?' % column, (value, limit))
+            return cursor.fetchall()
+
+
+def fit_runtime(samples):
+    """
+    Fit wall time as a linear function of input size by least squares.
+    Fall back to a ratio through the origin when the fit is degenerate.
+
+    :return: intercept and slope
+    :rtype: tuple
+    """
+    nb_samples = float(len(samples))
+    mean_x = sum([x for x, _ in samples]) / nb_samples
+    mean_y = sum([y for _, y in samples]) / nb_samples
+    var_x = sum([(x - mean_x) ** 2 for x, _ in samples])
+    cov_xy = sum([(x - mean_x) * (y - mean_y) for x, y in samples])
+
+    if var_x > 0 and cov_xy > 0:
+        slope = cov_xy / var_x
+        intercept = mean_y - slope * mean_x
+        if intercept >= 0:
+            return (intercept, slope)
+    return (0, mean_y / mean_x)
+
+
+class RuntimeModel(object):
+    """
+    Predict the runtime of a job from the runtime of previous jobs of the
+    same group, or of the same action when the group has too few samples.
+    Input size is the only feature known before running a job, as probing
+    inputs would cost as much as short jobs themselves.
+    """
+
+    def __init__(self, store=None):
+        """
+        :param store: metrics of previous jobs, None to predict from input
+                      size with a default throughput
+        :type store: toolbox2.metrics.MetricsStore
+        """
+        self.store = store
+        self.fits = {}
+        self.lock = threading.Lock()
+
+    def _get_fit(self, column, value):
+        key = (column, value)
+        with self.lock:
+            fit, fitted_at = self.fits.get(key, (None, 0))
+            if time.time() - fitted_at < MODEL_CACHE_TTL:
+                return fit
+
+        samples = self.store.get_samples(column, value)
+        fit = None
+        if len(samples) >= MODEL_MIN_SAMPLES:
+            fit = fit_runtime(samples)
+
+        with self.lock:
+            self.fits[key] = (fit, time.time())
+        return fit
+
+    def predict(self, action, params, resources):
+        """
+        Return the expected runtime of a job in seconds.
+        """
+        input_size = get_input_size(resources)
+
+        if self.store:
+            try:
+                fit = self._get_fit('group_key', get_job_group(action, params)) or \
+                      self._get_fit('action', action)
+                if fit:
+                    return fit[0] + fit[1] * input_size
+            except sqlite3.Error:
+                pass
+
+        return input_size * MODEL_DEFAULT_SECONDS_PER_BYTE
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import ctypes
+import ctypes.util
+
+# posix_spawnattr_setflags flags (glibc)
+POSIX_SPAWN_SETSIGDEF = 0x04
+POSIX_SPAWN_SETSIGMASK = 0x08
+
+# posix_fadvise advices
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# ioprio_set classes and syscall numbers, which glibc does not wrap
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+_SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+}
+# Resolved at import, since set_ioprio runs between fork and exec where
+# platform.machine() would import modules and run uname
+_SYS_IOPRIO_SET_NR = _SYS_IOPRIO_SET.get(os.uname()[4])
+
+# setpriority which
+_PRIO_PROCESS = 0
+
+# Opaque glibc structures are allocated with generous sizes
+_SPAWN_FILE_ACTIONS_SIZE = 256
+_SPAWN_ATTR_SIZE = 1024
+_SIGSET_SIZE = 128
+_CPU_SETSIZE = 1024
+
+
+class PosixException(Exception):
+    pass
+
+
+class _rlimit(ctypes.Structure):
+    _fields_ = [
+        ('rlim_cur', ctypes.c_ulonglong),
+        ('rlim_max', ctypes.c_ulonglong),
+    ]
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+
+def _has_symbols(*names):
+    if not _libc:
+        return False
+    for name in names:
+        if not hasattr(_libc, name):
+            return False
+    return True
+
+
+def _raise_errno(func, err=None):
+    if err is None:
+        err = ctypes.get_errno()
+    raise OSError(err, '%s failed: %s' % (func, os.strerror(err)))
+
+
+def spawn_available():
+    """
+    Return True if the C library provides everything needed by spawn:
+    posix_spawn with chdir (glibc >= 2.29) and closefrom (glibc >= 2.34)
+    file actions.
+    """
+    return _has_symbols('posix_spawnp',
+                        'posix_spawn_file_actions_addchdir_np',
+                        'posix_spawn_file_actions_addclosefrom_np')
+
+
+# Prototypes of spawn functions, so that arguments of a wrong type raise
+# instead of being silently marshalled, such as unicode as wchar_t*
+_SPAWN_PROTOTYPES = [
+    ('posix_spawn_file_actions_init', [ctypes.c_void_p]),
+    ('posix_spawn_file_actions_destroy', [ctypes.c_void_p]),
+    ('posix_spawn_file_actions_adddup2', [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]),
+    ('posix_spawn_file_actions_addclosefrom_np', [ctypes.c_void_p, ctypes.c_int]),
+    ('posix_spawn_file_actions_addchdir_np', [ctypes.c_void_p, ctypes.c_char_p]),
+    ('posix_spawnattr_init', [ctypes.c_void_p]),
+    ('posix_spawnattr_destroy', [ctypes.c_void_p]),
+    ('posix_spawnattr_setsigmask', [ctypes.c_void_p, ctypes.c_void_p]),
+    ('posix_spawnattr_setsigdefault', [ctypes.c_void_p, ctypes.c_void_p]),
+    ('posix_spawnattr_setflags', [ctypes.c_void_p, ctypes.c_short]),
+    ('sigemptyset', [ctypes.c_void_p]),
+    ('sigaddset', [ctypes.c_void_p, ctypes.c_int]),
+    ('posix_spawnp', [ctypes.POINTER(ctypes.c_int), ctypes.c_char_p, ctypes.c_void_p, ctypes.c_void_p,
+                      ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_char_p)]),
+]
+
+if spawn_available():
+    for _name, _argtypes in _SPAWN_PROTOTYPES:
+        getattr(_libc, _name).argtypes = _argtypes
+        getattr(_libc, _name).restype = ctypes.c_int
+
+
+def _fs_encode(value):
+    """
+    Return value as a str in the filesystem encoding, as expected by C
+    functions taking paths and command lines.
+    """
+    if isinstance(value, unicode):
+        return value.encode(sys.getfilesystemencoding() or 'utf-8')
+    return str(value)
+
+
+def _check_spawn(func, ret):
+    # posix_spawn functions return an error number instead of setting errno
+    if ret != 0:
+        _raise_errno(func, ret)
+
+
+def _check_sigset(func, ret):
+    if ret != 0:
+        _raise_errno(func)
+
+
+def spawn(args, cwd, stdout, stderr, sigdefault=None):
+    """
+    Launch a process with posix_spawnp, which uses vfork semantics and thus
+    does not duplicate the caller address space. All file descriptors but
+    standard ones are closed in the child.
+
+    :param args: command line, args[0] is looked up in PATH
+    :type args: list
+
+    :param cwd: working directory of the child
+    :type cwd: string
+
+    :param stdout: file descriptor used as child standard output
+    :type stdout: int
+
+    :param stderr: file descriptor used as child standard error
+    :type stderr: int
+
+    :param sigdefault: signals reset to their default disposition
+    :type sigdefault: list
+
+    :return: child pid
+    :rtype: int
+    """
+    file_actions = ctypes.create_string_buffer(_SPAWN_FILE_ACTIONS_SIZE)
+    attr = ctypes.create_string_buffer(_SPAWN_ATTR_SIZE)
+    sigset = ctypes.create_string_buffer(_SIGSET_SIZE)
+
+    args = [_fs_encode(arg) for arg in args]
+    cwd = _fs_encode(cwd)
+    argv = (ctypes.c_char_p * (len(args) + 1))(*(args + [None]))
+    env = ['%s=%s' % (_fs_encode(key), _fs_encode(value)) for key, value in os.environ.iteritems()]
+    envp = (ctypes.c_char_p * (len(env) + 1))(*(env + [None]))
+
+    _check_spawn('posix_spawn_file_actions_init', _libc.posix_spawn_file_actions_init(file_actions))
+    try:
+        _check_spawn('posix_spawnattr_init', _libc.posix_spawnattr_init(attr))
+        try:
+            _check_spawn('posix_spawn_file_actions_adddup2',
+                         _libc.posix_spawn_file_actions_adddup2(file_actions, stdout, 1))
+            _check_spawn('posix_spawn_file_actions_adddup2',
+                         _libc.posix_spawn_file_actions_adddup2(file_actions, stderr, 2))
+            _check_spawn('posix_spawn_file_actions_addclosefrom_np',
+                         _libc.posix_spawn_file_actions_addclosefrom_np(file_actions, 3))
+            _check_spawn('posix_spawn_file_actions_addchdir_np',
+                         _libc.posix_spawn_file_actions_addchdir_np(file_actions, cwd))
+
+            _check_sigset('sigemptyset', _libc.sigemptyset(sigset))
+            _check_spawn('posix_spawnattr_setsigmask', _libc.posix_spawnattr_setsigmask(attr, sigset))
+            for signum in sigdefault or []:
+                _check_sigset('sigaddset', _libc.sigaddset(sigset, signum))
+            _check_spawn('posix_spawnattr_setsigdefault', _libc.posix_spawnattr_setsigdefault(attr, sigset))
+            _check_spawn('posix_spawnattr_setflags',
+                         _libc.posix_spawnattr_setflags(attr, POSIX_SPAWN_SETSIGDEF | POSIX_SPAWN_SETSIGMASK))
+
+            pid = ctypes.c_int(0)
+            ret = _libc.posix_spawnp(ctypes.byref(pid), args[0], file_actions, attr, argv, envp)
+            _check_spawn('posix_spawnp(%s)' % args[0], ret)
+            return pid.value
+        finally:
+            _libc.posix_spawnattr_destroy(attr)
+    finally:
+        _libc.posix_spawn_file_actions_destroy(file_actions)
+
+
+def set_rlimit(pid, resource, limit):
+    """
+    Set both soft and hard limits of a resource for another process.
+
+    :param resource: resource identifier such as resource.RLIMIT_AS
+    :type resource: int
+    """
+    if not _has_symbols('prlimit'):
+        raise PosixException('prlimit is not available')
+
+    rlim = _rlimit(limit, limit)
+    if _libc.prlimit(pid, resource, ctypes.byref(rlim), None) != 0:
+        _raise_errno('prlimit')
+
+
+def set_affinity(pid, cpus):
+    """
+    Restrict a thread to the given set of cpus with sched_setaffinity.
+
+    :param pid: thread identifier, 0 for the calling thread
+    :type pid: int
+
+    :param cpus: cpu indexes
+    :type cpus: list
+    """
+    if not _has_symbols('sched_setaffinity'):
+        raise PosixException('sched_setaffinity is not available')
+
+    ulong_bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    mask = (ctypes.c_ulong * (_CPU_SETSIZE / ulong_bits))()
+    for cpu in cpus:
+        mask[cpu / ulong_bits] |= 1 << (cpu % ulong_bits)
+
+    if _libc.sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        _raise_errno('sched_setaffinity')
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Announce how a file range is going to be accessed with posix_fadvise.
+
+    :param fd: file descriptor
+    :type fd: int
+
+    :param offset: start of the range
+    :type offset: int
+
+    :param length: length of the range, 0 to extend it to the end of file
+    :type length: int
+
+    :param advice: one of POSIX_FADV_* constants
+    :type advice: int
+    """
+    if not _has_symbols('posix_fadvise64'):
+        raise PosixException('posix_fadvise64 is not available')
+
+    ret = _libc.posix_fadvise64(fd, ctypes.c_longlong(offset), ctypes.c_longlong(length), advice)
+    if ret != 0:
+        _raise_errno('posix_fadvise', ret)
+
+
+def set_ioprio(pid, ioclass, level=0):
+    """
+    Set the I/O scheduling class and level of a thread with ioprio_set.
+
+    :param pid: thread identifier, 0 for the calling thread
+    :type pid: int
+
+    :param ioclass: one of IOPRIO_CLASS_* constants
+    :type ioclass: int
+
+    :param level: priority within the class, from 0 (highest) to 7
+    :type level: int
+    """
+    if _SYS_IOPRIO_SET_NR is None or not _has_symbols('syscall'):
+        raise PosixException('ioprio_set is not available')
+
+    if _libc.syscall(_SYS_IOPRIO_SET_NR, _IOPRIO_WHO_PROCESS, pid, (ioclass << _IOPRIO_CLASS_SHIFT) | level) != 0:
+        _raise_errno('ioprio_set')
+
+
+def set_priority(pid, nice):
+    """
+    Set the nice value of a thread with setpriority.
+
+    :param pid: thread identifier, 0 for the calling thread
+    :type pid: int
+    """
+    if not _has_symbols('setpriority'):
+        raise PosixException('setpriority is not available')
+
+    if _libc.setpriority(_PRIO_PROCESS, pid, nice) != 0:
+        _raise_errno('setpriority')
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import signal
+
+from toolbox2.cpuset import get_allowed_cpus
+from toolbox2.state import SharedState, get_process_start_time, process_exists
+
+PREEMPTION_DEFAULT_PRIORITY = 0
+# Interval at which workers of suspended processes check if they may resume
+PREEMPTION_REFRESH_INTERVAL = 5
+
+
+class PreemptionController(object):
+    """
+    Suspend worker processes of all toolbox2 processes of a node in favor
+    of processes of higher priority. Processes of the highest priority
+    always run. Processes of lower priorities run as long as the cpus left
+    by processes of higher priorities fit their thread count, and are
+    suspended with SIGSTOP otherwise, the latest registered first. They are
+    resumed with SIGCONT once cpus are available again.
+
+    Processes of a same priority never suspend each other, so that nodes
+    where all jobs share the default priority behave as without preemption.
+    """
+
+    def __init__(self, state_path, nb_cpus=0):
+        """
+        :param state_path: path of the file shared by all processes of the node
+        :type state_path: string
+
+        :param nb_cpus: number of cpus shared by worker processes, 0 for all
+                        allowed cpus
+        :type nb_cpus: int
+        """
+        self.state_path = state_path
+        self.nb_cpus = nb_cpus or len(get_allowed_cpus())
+
+    def _schedule(self, processes):
+        """
+        Return keys of processes which must be suspended.
+        """
+        suspended = set()
+        busy = 0
+        by_priority = sorted(processes.iteritems(), key=lambda item: (-item[1]['priority'], item[1]['registered']))
+        top_priority = by_priority and by_priority[0][1]['priority']
+        for key, process in by_priority:
+            threads = min(process['threads'], self.nb_cpus)
+            if process['priority'] == top_priority or busy + threads <= self.nb_cpus:
+                busy += threads
+            else:
+                suspended.add(key)
+        return suspended
+
+    def _signal(self, process, signum):
+        try:
+            os.kill(process['pid'], signum)
+            return True
+        except OSError:
+            return False
+
+    def _update(self, state):
+        processes = state.data.setdefault('processes', {})
+        for key, process in processes.items():
+            if not process_exists(process['pid'], process['start_time']):
+                del processes[key]
+
+        suspended = self._schedule(processes)
+        for key, process in processes.iteritems():
+            if key in suspended and not process.get('suspended'):
+                process['suspended'] = self._signal(process, signal.SIGSTOP)
+            elif key not in suspended and process.get('suspended'):
+                self._signal(process, signal.SIGCONT)
+                process['suspended'] = False
+
+    def acquire(self, pid, threads, priority=PREEMPTION_DEFAULT_PRIORITY):
+        """
+        Register a process, which may suspend processes of lower priority,
+        or the process itself.
+
+        :param threads: number of threads run by the process
+        :type threads: int
+
+        :param priority: priority of the process, higher is more urgent
+        :type priority: int
+
+        :return: True if the process has been suspended
+        :rtype: bool
+        """
+        start_time = get_process_start_time(pid)
+        if start_time is None:
+            return False
+
+        with SharedState(self.state_path) as state:
+            processes = state.data.setdefault('processes', {})
+            state.data['sequence'] = state.data.get('sequence', 0) + 1
+            processes[str(pid)] = {
+                'pid': pid,
+                'start_time': start_time,
+                'threads': max(threads, 1),
+                'priority': priority,
+                'registered': state.data['sequence'],
+            }
+            self._update(state)
+            return processes.get(str(pid), {}).get('suspended', False)
+
+    def release(self, pid):
+        """
+        Unregister a process and resume suspended processes which fit in the
+        cpus it leaves.
+        """
+        with SharedState(self.state_path) as state:
+            state.data.setdefault('processes', {}).pop(str(pid), None)
+            self._update(state)
+
+    def refresh(self):
+        """
+        Resume suspended processes which fit in the cpus left by processes
+        which have exited without being released.
+        """
+        with SharedState(self.state_path) as state:
+            self._update(state)
+
+    def get_processes(self):
+        """
+        Return registered processes which are still running.
+        """
+        with SharedState(self.state_path) as state:
+            self._update(state)
+            return state.data['processes'].values()
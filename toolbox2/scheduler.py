@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import time
+import heapq
+import threading
+import Queue
+
+from toolbox2.exception import Toolbox2Exception
+
+SCHEDULER_POLICIES = ['fifo', 'sjf']
+SCHEDULER_DEFAULT_AGING = 1.0
+
+
+class SchedulerException(Toolbox2Exception):
+    pass
+
+
+def get_priority(policy, cost, enqueued_at, aging=SCHEDULER_DEFAULT_AGING):
+    """
+    Return the priority of a queued job, lowest first.
+
+    With sjf policy, jobs are ordered by expected runtime minus aging times
+    the time they have waited. As all queued jobs age at the same rate, this
+    order does not change over time and is given by expected runtime plus
+    aging times enqueue time. A job waits at most its expected runtime
+    excess divided by aging before shorter jobs submitted later.
+
+    :param policy: fifo or sjf
+    :type policy: string
+
+    :param cost: expected runtime in seconds
+    :type cost: float
+
+    :param enqueued_at: enqueue time
+    :type enqueued_at: float
+
+    :param aging: seconds of expected runtime forgiven per second waited
+    :type aging: float
+    """
+    if policy == 'sjf':
+        return cost + aging * enqueued_at
+    return enqueued_at
+
+
+def check_policy(policy, aging):
+    if policy not in SCHEDULER_POLICIES:
+        raise SchedulerException('Unknown scheduling policy: %s' % policy)
+    if aging <= 0:
+        raise SchedulerException('Aging must be positive')
+
+
+class JobQueue(Queue.Queue):
+    """
+    Bounded queue returning items in scheduling policy order. Items are put
+    as (cost, item) tuples and got as item. Items with a None cost come out
+    after all other ones, which suits worker stop markers.
+    """
+
+    def __init__(self, maxsize=0, policy='fifo', aging=SCHEDULER_DEFAULT_AGING):
+        check_policy(policy, aging)
+        self.policy = policy
+        self.aging = aging
+        Queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.sequence = 0
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, item):
+        cost, item = item
+        self.sequence += 1
+        if cost is None:
+            priority = float('inf')
+        else:
+            priority = get_priority(self.policy, cost, time.time(), self.aging)
+        heapq.heappush(self.queue, (priority, self.sequence, item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+
+class Scheduler(object):
+    """
+    Limit the number of jobs run at the same time by threads. Threads
+    waiting for a slot get it by decreasing priority, then in scheduling
+    policy order.
+
+        scheduler.acquire(cost, priority)
+        try:
+            run job
+        finally:
+            scheduler.release(priority)
+
+    With preemption, jobs only count against the concurrency of jobs of the
+    same or a higher priority, so that an urgent job starts at once and
+    preempts the worker processes of running jobs of lower priorities, see
+    toolbox2.preemption.PreemptionController.
+    """
+
+    def __init__(self, concurrency, policy='fifo', aging=SCHEDULER_DEFAULT_AGING, preemption=False):
+        """
+        :param concurrency: number of jobs run at the same time
+        :type concurrency: int
+
+        :param preemption: whether worker processes of lower priority jobs
+                           are preempted, without it all jobs count against
+                           concurrency
+        :type preemption: bool
+        """
+        check_policy(policy, aging)
+        self.concurrency = concurrency
+        self.preemption = preemption
+        self.policy = policy
+        self.aging = aging
+        self.running = []
+        self.waiters = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+    def _get_running(self, priority):
+        if not self.preemption:
+            return len(self.running)
+        return len([running for running in self.running if running >= priority])
+
+    def acquire(self, cost=0, priority=0):
+        """
+        Wait for a free slot.
+
+        :param cost: expected runtime of the job in seconds
+        :type cost: float
+
+        :param priority: priority of the job, higher is more urgent
+        :type priority: int
+        """
+        with self.condition:
+            self.sequence += 1
+            waiter = (-priority, get_priority(self.policy, cost, time.time(), self.aging), self.sequence)
+            heapq.heappush(self.waiters, waiter)
+            while self._get_running(priority) >= self.concurrency or self.waiters[0] != waiter:
+                self.condition.wait()
+            heapq.heappop(self.waiters)
+            self.running.append(priority)
+            # The next waiter may also get a slot
+            self.condition.notifyAll()
+
+    def release(self, priority=0):
+        with self.condition:
+            self.running.remove(priority)
+            self.condition.notifyAll()
+
+    def get_status(self):
+        with self.condition:
+            return {'running': len(self.running), 'queued': len(self.waiters)}
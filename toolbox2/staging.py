@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import time
+import errno
+import shutil
+import hashlib
+import threading
+
+from toolbox2 import posix
+from toolbox2.cache import DirectoryCache
+from toolbox2.exception import Toolbox2Exception
+from toolbox2.fileutils import get_file_identity
+
+STAGING_READ_SIZE = 8 * 1024 * 1024
+
+
+class StagingException(Toolbox2Exception):
+    pass
+
+
+def _fadvise(fd, offset, length, advice):
+    try:
+        posix.fadvise(fd, offset, length, advice)
+    except (OSError, posix.PosixException):
+        pass
+
+
+def copy_sequential(src, dst, read_size=STAGING_READ_SIZE, stop_event=None, throttle=None):
+    """
+    Copy a file with large sequential reads. The kernel is asked to read
+    the source ahead of the copy and to drop its pages once copied, the
+    copy pages are kept as they are about to be read.
+
+    :param stop_event: abort the copy as soon as it is set
+    :type stop_event: threading.Event
+
+    :param throttle: bandwidth budget consumed by the copy
+    :type throttle: toolbox2.iosched.TokenBucket
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            _fadvise(src_fd, 0, 0, posix.POSIX_FADV_SEQUENTIAL)
+            offset = 0
+            while True:
+                if stop_event and stop_event.isSet():
+                    raise StagingException('Staging of %s cancelled' % src)
+                _fadvise(src_fd, offset + read_size, read_size, posix.POSIX_FADV_WILLNEED)
+                buf = os.read(src_fd, read_size)
+                if not buf:
+                    break
+                if throttle:
+                    throttle.consume(len(buf))
+                written = 0
+                while written < len(buf):
+                    written += os.write(dst_fd, buf[written:])
+                _fadvise(src_fd, offset, len(buf), posix.POSIX_FADV_DONTNEED)
+                offset += len(buf)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+class StagingCache(DirectoryCache):
+    """
+    Local cache of input files, keyed by their real path and identity.
+    Files are copied to a scratch directory of the cache without holding
+    its lock, and moved into the cache once complete.
+    """
+
+    def __init__(self, path, max_size, read_size=STAGING_READ_SIZE):
+        DirectoryCache.__init__(self, path, max_size)
+        self.read_size = read_size
+        self.scratch_path = os.path.join(self.path, '.staging')
+
+    def get_key(self, path, identity):
+        buf = '%s:%s:%s:%s' % (path, identity['size'], identity['mtime'], identity['ino'])
+        return hashlib.sha1(buf).hexdigest()
+
+    def lookup(self, key):
+        """
+        Return the path of a cached file and mark it as recently used, or
+        None on cache miss.
+        """
+        with self:
+            manifest = self.get(key)
+            if not manifest:
+                return None
+            path = self.get_file_path(key, manifest['name'])
+            if not os.path.isfile(path):
+                self.remove(key)
+                return None
+            return path
+
+    def stage(self, src, stop_event=None, throttle=None):
+        """
+        Return the path of a local copy of src, copying it first on cache
+        miss. The copy keeps the base name of src.
+
+        :return: path of the local copy and whether it was already cached
+        :rtype: tuple
+        """
+        src = os.path.realpath(src)
+        identity = get_file_identity(src)
+        if identity is None:
+            raise StagingException('%s does not exist' % src)
+
+        key = self.get_key(src, identity)
+        path = self.lookup(key)
+        if path:
+            return (path, True)
+
+        if identity['size'] > self.max_size:
+            raise StagingException('%s is larger than the staging cache' % src)
+
+        name = os.path.basename(src)
+        tmp_dir = os.path.join(self.scratch_path, '%s-%s-%s' % (key, os.getpid(), threading.currentThread().ident))
+        tmp_path = os.path.join(tmp_dir, name)
+        try:
+            os.makedirs(tmp_dir)
+            copy_sequential(src, tmp_path, self.read_size, stop_event, throttle)
+            if get_file_identity(src) != identity:
+                raise StagingException('%s was modified while being staged' % src)
+
+            manifest = {'source': src, 'name': name, 'identity': identity}
+            with self:
+                self.put(key, {name: tmp_path}, manifest, move=True)
+        finally:
+            shutil.rmtree(tmp_dir, True)
+
+        # The entry may also have been stored by a concurrent process
+        path = self.lookup(key)
+        if not path:
+            raise StagingException('%s could not be stored in staging cache' % src)
+        return (path, False)
+
+
+class StagedFile(object):
+    """
+    Input file staged by a background thread, so that the copy overlaps
+    with other processing of the action such as probing.
+    """
+
+    def __init__(self, log, cache, src, pin_dir, throttle=None):
+        """
+        :param cache: staging cache, used by this file only
+        :type cache: toolbox2.staging.StagingCache
+
+        :param src: path of the input file
+        :type src: string
+
+        :param pin_dir: directory where the local copy is hard linked, so
+                        that it outlives its eviction from the cache
+        :type pin_dir: string
+
+        :param throttle: bandwidth budget consumed by the copy
+        :type throttle: toolbox2.iosched.TokenBucket
+        """
+        self.log = log
+        self.cache = cache
+        self.src = src
+        self.pin_dir = pin_dir
+        self.throttle = throttle
+        self.path = None
+        self.error = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+
+    def _pin(self, path):
+        if not os.path.isdir(self.pin_dir):
+            os.makedirs(self.pin_dir)
+        pinned_path = os.path.join(self.pin_dir, os.path.basename(path))
+        try:
+            if os.path.exists(pinned_path):
+                os.unlink(pinned_path)
+            os.link(path, pinned_path)
+        except OSError, exc:
+            if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            return path
+        return pinned_path
+
+    def _run(self):
+        started_at = time.time()
+        try:
+            path, hit = self.cache.stage(self.src, self.stop_event, self.throttle)
+            self.path = self._pin(path)
+            self.log.info('Staged %s to %s (%s, %.2fs)', self.src, self.path,
+                          hit and 'cached' or 'copied', time.time() - started_at)
+        except (IOError, OSError, Toolbox2Exception), exc:
+            self.error = exc
+            self.log.warning('Input %s not staged: %s', self.src, exc)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def wait(self):
+        """
+        Wait for the local copy and return its path, or None if the file
+        could not be staged.
+        """
+        self.thread.join()
+        return self.path
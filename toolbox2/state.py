@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import json
+import fcntl
+
+
+def get_process_start_time(pid):
+    """
+    Return the start time of a process in clock ticks since boot, or None if
+    the process does not exist. Together with the pid, it identifies a
+    process even if its pid is reused.
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as fileobj:
+            stat = fileobj.read()
+    except IOError:
+        return None
+
+    # The command name may contain spaces and is enclosed by parentheses
+    fields = stat[stat.rfind(')') + 2:].split()
+    return int(fields[19])
+
+
+def get_process_state(pid):
+    """
+    Return the state of a process, such as R for running, S for sleeping
+    or T for stopped, or None if the process does not exist.
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as fileobj:
+            stat = fileobj.read()
+    except IOError:
+        return None
+    return stat[stat.rfind(')') + 2:].split()[0]
+
+
+def process_exists(pid, start_time):
+    """
+    Check if the process identified by pid and start_time is still alive.
+    Zombie processes have exited and are only waiting to be reaped.
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as fileobj:
+            stat = fileobj.read()
+    except IOError:
+        return False
+
+    fields = stat[stat.rfind(')') + 2:].split()
+    return fields[0] != 'Z' and int(fields[19]) == start_time
+
+
+class SharedState(object):
+    """
+    JSON document shared by all toolbox2 processes of a node. It is locked,
+    loaded and saved back when used as a context manager:
+
+        with SharedState(path) as state:
+            state.data['key'] = value
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_fd = None
+        self.data = {}
+
+    def __enter__(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.lock_fd = os.open('%s.lock' % self.path, os.O_RDWR | os.O_CREAT, 0666)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+
+        try:
+            with open(self.path, 'r') as fileobj:
+                self.data = json.load(fileobj)
+        except (IOError, ValueError):
+            self.data = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                tmp_path = '%s.tmp' % self.path
+                with open(tmp_path, 'w') as fileobj:
+                    json.dump(self.data, fileobj)
+                os.rename(tmp_path, self.path)
+        finally:
+            os.close(self.lock_fd)
+            self.lock_fd = None
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import time
+from collections import deque
+
+TELEMETRY_DEFAULT_MAX_SAMPLES = 120
+
+_CLK_TCK = os.sysconf('SC_CLK_TCK')
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_process_stats(pid):
+    """
+    Read cumulated cpu time, resident memory, I/O counters and state of a
+    process from /proc. I/O counters include reads and writes on network
+    filesystems. Return None if the process does not exist anymore.
+
+    :rtype: dict
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as fileobj:
+            stat = fileobj.read()
+    except IOError:
+        return None
+
+    # The command name may contain spaces and is enclosed by parentheses
+    fields = stat[stat.rfind(')') + 2:].split()
+    stats = {
+        'state': fields[0],
+        'cpu_time': float(int(fields[11]) + int(fields[12])) / _CLK_TCK,
+        'rss': int(fields[21]) * _PAGE_SIZE,
+        'read_bytes': 0,
+        'write_bytes': 0,
+    }
+
+    io = read_process_io(pid)
+    if io:
+        stats['read_bytes'], stats['write_bytes'] = io
+
+    return stats
+
+
+def read_process_io(pid):
+    """
+    Read the number of bytes a process has read and written from /proc,
+    including reads and writes on network filesystems. Return None if they
+    are not available.
+
+    :rtype: tuple
+    """
+    read_bytes, write_bytes = 0, 0
+    try:
+        with open('/proc/%d/io' % pid, 'r') as fileobj:
+            for line in fileobj:
+                name, value = line.split(':', 1)
+                if name == 'rchar':
+                    read_bytes = int(value)
+                elif name == 'wchar':
+                    write_bytes = int(value)
+    except (IOError, ValueError):
+        return None
+    return (read_bytes, write_bytes)
+
+
+class TelemetrySampler(object):
+    """
+    Sample cpu usage, resident memory, I/O rates and state of a process at
+    a given interval. The latest samples are kept in a bounded time series,
+    and summarized over the whole process life.
+    """
+
+    def __init__(self, pid, interval, max_samples=TELEMETRY_DEFAULT_MAX_SAMPLES):
+        """
+        :param pid: process to sample
+        :type pid: int
+
+        :param interval: minimum time between samples, in seconds
+        :type interval: float
+
+        :param max_samples: number of samples kept
+        :type max_samples: int
+        """
+        self.pid = pid
+        self.interval = interval
+        self.samples = deque(maxlen=max_samples)
+        self.last_stats = None
+        self.last_time = 0
+        self.started_at = time.time()
+
+        self.nb_samples = 0
+        self.nb_blocked = 0
+        self.cpu_max = 0
+        self.rss_max = 0
+        self.read_rate_max = 0
+        self.write_rate_max = 0
+
+    def sample(self):
+        """
+        Take a sample if the interval has elapsed since the previous one.
+
+        :return: the new sample, or None
+        :rtype: dict
+        """
+        now = time.time()
+        if now - self.last_time < self.interval:
+            return None
+
+        stats = read_process_stats(self.pid)
+        # Exited processes have released their memory and counters
+        if stats is None or stats['state'] == 'Z':
+            return None
+
+        last_stats = self.last_stats
+        if last_stats is None:
+            last_stats = {'cpu_time': 0, 'read_bytes': 0, 'write_bytes': 0}
+            elapsed = now - self.started_at
+        else:
+            elapsed = now - self.last_time
+        elapsed = max(elapsed, 0.001)
+
+        sample = {
+            'time': now,
+            'state': stats['state'],
+            'cpu': round((stats['cpu_time'] - last_stats['cpu_time']) / elapsed * 100, 1),
+            'rss': stats['rss'],
+            'read_rate': int((stats['read_bytes'] - last_stats['read_bytes']) / elapsed),
+            'write_rate': int((stats['write_bytes'] - last_stats['write_bytes']) / elapsed),
+        }
+        self.samples.append(sample)
+        self.last_stats = stats
+        self.last_time = now
+
+        self.nb_samples += 1
+        # Uninterruptible sleep, usually waiting for disk or network I/O
+        if stats['state'] == 'D':
+            self.nb_blocked += 1
+        self.cpu_max = max(self.cpu_max, sample['cpu'])
+        self.rss_max = max(self.rss_max, sample['rss'])
+        self.read_rate_max = max(self.read_rate_max, sample['read_rate'])
+        self.write_rate_max = max(self.write_rate_max, sample['write_rate'])
+        return sample
+
+    def get_last_sample(self):
+        if not self.samples:
+            return None
+        return self.samples[-1]
+
+    def get_summary(self):
+        """
+        Summarize the process life up to the latest sample.
+
+        :rtype: dict
+        """
+        stats = self.last_stats or {'cpu_time': 0, 'read_bytes': 0, 'write_bytes': 0}
+        elapsed = max(self.last_time - self.started_at, 0.001)
+        return {
+            'samples': self.nb_samples,
+            'cpu_avg': round(stats['cpu_time'] / elapsed * 100, 1),
+            'cpu_max': self.cpu_max,
+            'rss_max': self.rss_max,
+            'read_bytes': stats['read_bytes'],
+            'write_bytes': stats['write_bytes'],
+            'read_rate_max': self.read_rate_max,
+            'write_rate_max': self.write_rate_max,
+            'blocked_ratio': round(float(self.nb_blocked) / max(self.nb_samples, 1), 2),
+        }
+
+
+def merge_samples(samples):
+    """
+    Merge samples of processes running concurrently into a single one.
+    """
+    samples = [sample for sample in samples if sample]
+    if not samples:
+        return None
+
+    merged = {'time': max([sample['time'] for sample in samples]),
+              'state': ''.join([sample['state'] for sample in samples])}
+    for key in ['cpu', 'rss', 'read_rate', 'write_rate']:
+        merged[key] = sum([sample[key] for sample in samples])
+    return merged
+
+
+def merge_summaries(summaries):
+    """
+    Merge summaries of processes running concurrently into a single one.
+    Maximum values are summed, which overestimates them.
+    """
+    summaries = [summary for summary in summaries if summary]
+    if not summaries:
+        return None
+
+    merged = {'blocked_ratio': max([summary['blocked_ratio'] for summary in summaries])}
+    for key in ['samples', 'cpu_avg', 'cpu_max', 'rss_max', 'read_bytes', 'write_bytes',
+                'read_rate_max', 'write_rate_max']:
+        merged[key] = sum([summary[key] for summary in summaries])
+    return merged
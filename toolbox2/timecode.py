@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from toolbox2.exception import Toolbox2Exception
+
+timecode_re = re.compile('^(\d{2}):(\d{2}):(\d{2})([:;.])(\d{2})$')
+
+
+class TimecodeException(Toolbox2Exception):
+    pass
+
+
+def _get_drop_frames(fps, drop_frame):
+    """
+    Return the number of frame numbers dropped each minute, except every
+    tenth minute, by drop frame timecodes.
+    """
+    if not drop_frame:
+        return 0
+    return int(round(fps * 0.066666))
+
+
+def timecode_to_frames(timecode, fps):
+    """
+    Return the frame number of a SMPTE timecode. Timecodes with a ';' or
+    '.' separator are drop frame.
+
+    :param timecode: HH:MM:SS:FF timecode
+    :type timecode: string
+
+    :param fps: frame rate
+    :type fps: float
+    """
+    match = timecode_re.match(timecode)
+    if not match:
+        raise TimecodeException('Invalid timecode: %s' % timecode)
+
+    hours, minutes, seconds, separator, frames = match.groups()
+    hours, minutes, seconds, frames = int(hours), int(minutes), int(seconds), int(frames)
+    timebase = int(round(fps))
+    drop = _get_drop_frames(fps, separator != ':')
+
+    total_minutes = 60 * hours + minutes
+    frames += ((hours * 60 + minutes) * 60 + seconds) * timebase
+    return frames - drop * (total_minutes - total_minutes / 10)
+
+
+def frames_to_timecode(frames, fps, drop_frame=False):
+    """
+    Return the SMPTE timecode of a frame number.
+    """
+    timebase = int(round(fps))
+    drop = _get_drop_frames(fps, drop_frame)
+
+    if drop:
+        frames_per_minute = timebase * 60 - drop
+        frames_per_10_minutes = timebase * 600 - drop * 9
+        tens, remainder = divmod(frames, frames_per_10_minutes)
+        frames += drop * 9 * tens
+        if remainder > drop:
+            frames += drop * ((remainder - drop) / frames_per_minute)
+
+    # Timecodes wrap around every 24 hours
+    frames %= timebase * 86400
+    seconds, frame = divmod(frames, timebase)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return '%02d:%02d:%02d%s%02d' % (hour, minute, second, drop and ';' or ':', frame)
+
+
+def offset_timecode(timecode, frames, fps):
+    """
+    Return a timecode shifted by a number of frames, keeping its drop
+    frame mode.
+    """
+    frame = timecode_to_frames(timecode, fps)
+    return frames_to_timecode(frame + frames, fps, timecode_re.match(timecode).group(4) != ':')
+
+
+def parse_position(position, fps, start_timecode='00:00:00:00'):
+    """
+    Return the frame number, counted from the first frame of a file, of a
+    position given as a frame number or as a timecode of the file.
+
+    :param position: frame number or HH:MM:SS:FF timecode
+    :type position: int or string
+
+    :param start_timecode: timecode of the first frame of the file
+    :type start_timecode: string
+    """
+    if isinstance(position, (int, long)):
+        frame = position
+    elif str(position).strip().isdigit():
+        frame = int(str(position).strip())
+    else:
+        frame = timecode_to_frames(str(position).strip(), fps) - timecode_to_frames(start_timecode, fps)
+
+    if frame < 0:
+        raise TimecodeException('Position %s is before start timecode %s' % (position, start_timecode))
+    return frame
+
+
+def get_range(in_point, out_point, fps, start_timecode='00:00:00:00', nb_frames=0):
+    """
+    Return first and end (excluded) frame numbers of a range given by in
+    and out points, either of them may be None. End frame is None when the
+    range goes to the end of file and its frame count is not known.
+
+    :param nb_frames: frame count of the file, 0 if unknown
+    :type nb_frames: int
+
+    :rtype: tuple
+    """
+    if not fps:
+        raise TimecodeException('Range requires input frame rate')
+
+    start = 0
+    if in_point not in [None, '']:
+        start = parse_position(in_point, fps, start_timecode)
+
+    end = nb_frames or None
+    if out_point not in [None, '']:
+        end = parse_position(out_point, fps, start_timecode)
+        if nb_frames:
+            end = min(end, nb_frames)
+
+    if end is not None and end <= start:
+        raise TimecodeException('Empty range: in=%s out=%s' % (in_point, out_point))
+    return (start, end)
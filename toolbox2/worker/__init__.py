@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
-from toolbox2.command import Command
-from toolbox2.command import COMMAND_DEFAULT_KILL_TIMEOUT
+import time
+
+from toolbox2.command import COMMAND_DEFAULT_KILL_TIMEOUT, COMMAND_DEFAULT_LAUNCHER
 from toolbox2.exception import Toolbox2Exception
+from toolbox2.executor import LOCAL_EXECUTOR
+from toolbox2.preemption import PREEMPTION_DEFAULT_PRIORITY, PREEMPTION_REFRESH_INTERVAL
+from toolbox2.telemetry import TelemetrySampler, merge_samples, merge_summaries, read_process_io
 
 
 class WorkerException(Toolbox2Exception):
@@ -39,6 +43,8 @@ class Worker(object):
         self.params = params or {}
         self.command = None
         self.tool = None
+        self.args = []
+        self.resumable = True
         self.is_running = False
         self.input_files = []
         self.output_files = []
@@ -48,6 +54,20 @@ class Worker(object):
         self.progress = 0
         self.memory_limit = 0
         self.kill_timeout = COMMAND_DEFAULT_KILL_TIMEOUT
+        self.launcher = COMMAND_DEFAULT_LAUNCHER
+        self.executor = LOCAL_EXECUTOR
+        # Set when the executor slot of the next run has been reserved
+        self.reserved_slot = False
+        self.nb_threads = 1
+        self.cpuset = None
+        self.preemption = None
+        self.priority = PREEMPTION_DEFAULT_PRIORITY
+        self.refreshed_at = 0
+        self.telemetry_interval = 0
+        self.telemetry = None
+        self.io_class = None
+        self.io_budget = None
+        self.io_counters = (0, 0)
 
         self.stdout = ''
         self.stderr = ''
@@ -104,6 +124,75 @@ class Worker(object):
         args += self.get_args()
         return args
 
+    def get_checkpoint_args(self):
+        """
+        Return the command line as prepared, without arguments which do not
+        change outputs and may differ between runs, such as thread counts.
+        """
+        return self.args
+
+    def sample_telemetry(self):
+        """
+        Sample the worker process if telemetry is enabled and its sampling
+        interval has elapsed.
+        """
+        if self.telemetry and self.is_running:
+            self.telemetry.sample()
+
+    def get_telemetry(self):
+        """
+        Return the latest telemetry sample of the worker process, or None.
+        """
+        if not self.telemetry:
+            return None
+        return self.telemetry.get_last_sample()
+
+    def get_telemetry_summary(self):
+        """
+        Return the telemetry summary of the worker process, or None.
+        """
+        if not self.telemetry:
+            return None
+        return self.telemetry.get_summary()
+
+    def _account_io(self):
+        """
+        Update bytes read and written by the process, and charge them to the
+        bandwidth budget of the worker.
+        """
+        io = read_process_io(self.command.process.pid)
+        if not io:
+            return
+        if self.io_budget:
+            self.io_budget.charge(max(io[0] - self.io_counters[0], 0) + max(io[1] - self.io_counters[1], 0))
+        self.io_counters = io
+
+    def get_io_bytes(self):
+        """
+        Return the number of bytes read and written by the process, as last
+        sampled while it was running.
+
+        :rtype: tuple
+        """
+        return self.io_counters
+
+    def get_suspended_time(self):
+        """
+        Return the time the process has been suspended by preemption, in
+        seconds.
+        """
+        if not self.command:
+            return 0
+        return self.command.suspended_time
+
+    def get_cpu_time(self):
+        """
+        Return cpu time used by the worker process, in seconds.
+        """
+        if not self.command:
+            return 0
+        return self.command.get_cpu_time()
+
     def get_error(self):
         """
         Return the last lines from stderr. The number of lines returned
@@ -138,30 +227,110 @@ class Worker(object):
         """
         pass
 
-    def run(self, base_dir):
+    def prepare(self, base_dir):
         """
-        Compute and launch command line.
+        Initialize the worker and compute its command line without
+        launching it.
         """
         self._setup(base_dir)
 
         args = self.get_process_args()
-        args = [str(arg) for arg in args]
+        self.args = [str(arg) for arg in args]
+        return self.args
+
+    def run(self, base_dir):
+        """
+        Compute and launch command line.
+        """
+        args = self.prepare(base_dir)
         cmd = ' '.join(args)
         self.log.info('Running command: %s', cmd)
 
-        self.command = Command(base_dir)
+        reserved, self.reserved_slot = self.reserved_slot, False
+        self.command = self.executor.create_command(base_dir, reserved)
         self.command.memory_limit = self.memory_limit
         self.command.kill_timeout = self.kill_timeout
-        self.command.run(args)
+        self.command.launcher = self.launcher
+        self.command.io_class = self.io_class
+        self.io_counters = (0, 0)
+        try:
+            self.command.run(args)
+        except:
+            self.executor.release(self.command)
+            raise
 
         self.is_running = True
+        self._on_process_start()
+
+    def _on_process_start(self):
+        """
+        Called once the process has been launched.
+        """
+        if not self.executor.is_local:
+            self.telemetry = None
+            return
+
+        if self.cpuset and self.nb_threads > 0:
+            cpus = self.cpuset.acquire(self.command.process.pid, self.nb_threads)
+            self.log.debug('Process (pid = %s) pinned to cpus %s', self.command.process.pid, cpus)
+
+        if self.preemption:
+            if self.preemption.acquire(self.command.process.pid, self.nb_threads, self.priority):
+                self.log.info('Process (pid = %s) suspended by higher priority processes', self.command.process.pid)
+            self.refreshed_at = time.time()
+
+        self.telemetry = None
+        if self.telemetry_interval > 0:
+            self.telemetry = TelemetrySampler(self.command.process.pid, self.telemetry_interval)
+            # Poll at least as often as samples are taken
+            self.command.set_timeout(min(self.command.timeout, self.telemetry_interval))
+
+    def _on_process_exit(self):
+        """
+        Called once the process has exited, whatever its exit code.
+        """
+        self.is_running = False
+        if self.cpuset and self.nb_threads > 0 and self.executor.is_local:
+            self.cpuset.release(self.command.process.pid)
+        if self.preemption and self.executor.is_local:
+            self.preemption.release(self.command.process.pid)
+        self.executor.release(self.command)
+
+    def kill(self):
+        """
+        Kill running process and wait for its termination.
+        """
+        if not self.is_running:
+            return
+        # Do not signal a reaped process, its pid may have been reused
+        if self.command.process.returncode is None:
+            try:
+                self.command.process.kill()
+            except OSError:
+                pass
+        self.command.process.wait()
+        self._on_process_exit()
+
+    def _wait_command(self, loop):
+        """
+        Wait the command and release its process once it has exited. If
+        waiting fails, the process is killed, reaped and released.
+        """
+        try:
+            ret = self.command.wait(self._handle_output, loop=loop)
+        except:
+            self.kill()
+            raise
+        if ret is not None:
+            self._on_process_exit()
+        return ret
 
     def wait(self):
         """
         Wait running process. If an error occurs raise a WorkerException,
         otherwise returns 0
         """
-        ret = self.command.wait(self._handle_output)
+        ret = self._wait_command(True)
         if ret != 0:
             error = self.get_error()
             raise WorkerException(error)
@@ -174,7 +343,167 @@ class Worker(object):
         If process has not exited yet, this method returns None otherwise,
         it returns its exit code.
         """
-        ret = self.command.wait(self._handle_output, loop=False)
+        if self.executor.is_local:
+            self._account_io()
+        ret = self._wait_command(False)
+        if ret is None and self.command.suspended and self.preemption and self.executor.is_local:
+            # Processes which preempted this one may have died unreleased
+            if time.time() - self.refreshed_at > PREEMPTION_REFRESH_INTERVAL:
+                self.preemption.refresh()
+                self.refreshed_at = time.time()
         if ret == 0:
             self._finalize()
         return ret
+
+
+class ParallelWorker(Worker):
+    """
+    Run several workers concurrently, as a single worker. It succeeds once
+    all its workers have succeeded, and fails as soon as one of them fails,
+    in which case the others are killed.
+    """
+
+    def __init__(self, log, workers):
+        """
+        :param workers: workers to run concurrently
+        :type workers: list
+        """
+        Worker.__init__(self, log)
+        self.workers = workers
+        self.failed_worker = None
+        self.returncodes = {}
+
+        for worker in self.workers:
+            self.resumable = self.resumable and worker.resumable
+            for input_file in worker.input_files:
+                if input_file.path not in [f.path for f in self.input_files]:
+                    self.input_files.append(input_file)
+            self.output_files += worker.output_files
+
+    def get_cpu_time(self):
+        return sum([worker.get_cpu_time() for worker in self.workers])
+
+    def get_io_bytes(self):
+        counters = [worker.get_io_bytes() for worker in self.workers]
+        return (sum([read for read, _ in counters]), sum([written for _, written in counters]))
+
+    def get_suspended_time(self):
+        return max([worker.get_suspended_time() for worker in self.workers])
+
+    def sample_telemetry(self):
+        for worker in self.workers:
+            worker.sample_telemetry()
+
+    def get_telemetry(self):
+        return merge_samples([worker.get_telemetry() for worker in self.workers])
+
+    def get_telemetry_summary(self):
+        return merge_summaries([worker.get_telemetry_summary() for worker in self.workers])
+
+    def get_error(self):
+        if self.failed_worker:
+            return self.failed_worker.get_error()
+        return ''
+
+    def get_checkpoint_args(self):
+        args = []
+        for worker in self.workers:
+            if args:
+                args.append('&')
+            args += worker.get_checkpoint_args()
+        return args
+
+    def prepare(self, base_dir):
+        self.args = []
+        for worker in self.workers:
+            if self.args:
+                self.args.append('&')
+            self.args += worker.prepare(base_dir)
+        return self.args
+
+    def run(self, base_dir):
+        self.returncodes = {}
+        self.failed_worker = None
+
+        # Reserve executor slots of all workers at once, so that pools
+        # shared with other workers never leave them partially started
+        counts = {}
+        for worker in self.workers:
+            counts[worker.executor] = counts.get(worker.executor, 0) + 1
+        reserved = []
+        try:
+            for executor, count in counts.iteritems():
+                executor.reserve(count)
+                reserved.append(executor)
+        except:
+            for executor in reserved:
+                executor.unreserve(counts[executor])
+            raise
+        for worker in self.workers:
+            worker.reserved_slot = True
+
+        try:
+            for worker in self.workers:
+                worker.run(base_dir)
+        except:
+            self._kill_all()
+            for worker in self.workers:
+                if worker.reserved_slot:
+                    worker.reserved_slot = False
+                    worker.executor.unreserve(1)
+            raise
+        self.is_running = True
+
+    def _update_progress(self):
+        self.progress = sum([worker.progress for worker in self.workers]) / len(self.workers)
+
+    def _kill_all(self):
+        for worker in self.workers:
+            if worker.is_running:
+                worker.kill()
+        self.is_running = False
+
+    def kill(self):
+        self._kill_all()
+
+    def wait(self):
+        """
+        Wait all workers. If one of them fails raise a WorkerException,
+        otherwise returns 0
+        """
+        ret = None
+        while ret is None:
+            ret = self.wait_noloop()
+        if ret != 0:
+            raise WorkerException(self.get_error())
+        return ret
+
+    def wait_noloop(self):
+        """
+        Poll each running worker once. Return None while some workers are
+        still running, the exit code of the first failed worker, or 0 once
+        all have succeeded.
+        """
+        for index, worker in enumerate(self.workers):
+            if index in self.returncodes:
+                continue
+            try:
+                ret = worker.wait_noloop()
+            except Exception:
+                self._kill_all()
+                raise
+            if ret is None:
+                continue
+            self.returncodes[index] = ret
+            if ret != 0:
+                self.failed_worker = worker
+                self._kill_all()
+                return ret
+
+        self._update_progress()
+        if len(self.returncodes) < len(self.workers):
+            return None
+
+        self.is_running = False
+        self._finalize()
+        return 0
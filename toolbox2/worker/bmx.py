@@ -62,6 +62,7 @@ class Raw2BmxWorker(Worker):
         for output_file in self.output_files:
             args += output_file.get_args()
 
+        self.inputs_size = 0
         for input_file in self.input_files:
             args += input_file.get_args()
             self.inputs_size += os.stat(input_file.path).st_size
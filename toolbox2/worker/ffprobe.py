@@ -3,6 +3,7 @@
 import re
 import json
 
+from toolbox2.index import PacketIndex
 from toolbox2.worker import Worker, WorkerException
 
 
@@ -14,16 +15,64 @@ class FFprobeWorker(Worker):
     """
     FFprobe worker.
     """
+
+    # Entries shown by probe profiles, all of them with the full profile.
+    # Timecode tags are read from format, video and data streams, and the
+    # timecode of the first GOP from video streams.
+    profiles = {
+        'minimal': 'format=format_name,start_time,duration:format_tags=timecode,timecode_at_mark_in:'
+                   'stream=index,codec_type,codec_name,width,height,r_frame_rate,display_aspect_ratio,channels,'
+                   'nb_read_packets,nb_read_frames,timecode:stream_tags=timecode',
+        'transcode': 'format=format_name,start_time,duration,size,bit_rate,nb_streams:'
+                     'format_tags=timecode,timecode_at_mark_in:'
+                     'stream=index,codec_type,codec_name,pix_fmt,width,height,r_frame_rate,display_aspect_ratio,'
+                     'field_order,has_b_frames,sample_rate,channels,bit_rate,duration,nb_frames,'
+                     'nb_read_packets,nb_read_frames,timecode:stream_tags=timecode',
+        'full': None,
+    }
+
     def __init__(self, log, params=None):
         Worker.__init__(self, log, params)
         self.tool = 'ffprobe'
         self.metadata = {}
+        self.resumable = False
+        self.profile = 'full'
+        self.description = True
         self.params.update({
             '-print_format': 'json',
             '-show_format': None,
             '-show_streams': None,
         })
 
+    def set_profile(self, profile, description=None):
+        """
+        Only probe entries of a profile: minimal for AVInfo fields,
+        transcode for fields read by actions, or full.
+
+        :param description: capture the stream description printed on
+                            stderr, by default only with the full profile
+        :type description: bool
+        """
+        if profile not in self.profiles:
+            raise FFprobeWorkerException('Unknown probe profile: %s' % profile)
+        self.profile = profile
+        if description is None:
+            description = profile == 'full'
+        self.description = description
+
+        for option in ['-show_format', '-show_streams', '-show_entries', '-v']:
+            self.params.pop(option, None)
+        if self.profiles[profile]:
+            self.params['-show_entries'] = self.profiles[profile]
+        else:
+            self.params.update({
+                '-show_format': None,
+                '-show_streams': None,
+            })
+        if not description:
+            # Do not print stream descriptions, errors are still reported
+            self.params['-v'] = 'error'
+
     def count_frames(self):
         self.params.update({
             '-count_frames': None,
@@ -48,6 +97,8 @@ class FFprobeWorker(Worker):
         except ValueError, exc:
             raise FFprobeWorkerException('FFProbe output could not be decoded: %s, %s' % (exc, self.stdout))
 
+        self.metadata.setdefault('format', {})
+        self.metadata.setdefault('streams', [])
         nb_audio_streams = 0
         nb_video_streams = 0
         for stream in self.metadata['streams']:
@@ -58,7 +109,8 @@ class FFprobeWorker(Worker):
 
         self.metadata['format']['nb_audio_streams'] = nb_audio_streams
         self.metadata['format']['nb_video_streams'] = nb_video_streams
-        self.metadata['description'] = self._get_description()
+        if self.description:
+            self.metadata['description'] = self._get_description()
 
     def _get_description(self):
         desc = ''
@@ -70,3 +122,80 @@ class FFprobeWorker(Worker):
                     line = re.sub(', from.*', '', line)
                 desc += line + '\n'
         return desc.strip()
+
+
+class FFprobeIndexWorker(Worker):
+    """
+    FFprobe worker reading packets of the first video stream into a packet
+    index. Packets are parsed as they are printed, so that memory usage
+    only depends on the size of the index.
+    """
+    # Size of stderr tail kept to report errors
+    STDERR_MAX_SIZE = 64 * 1024
+
+    def __init__(self, log, params=None):
+        Worker.__init__(self, log, params)
+        self.tool = 'ffprobe'
+        self.resumable = False
+        self.stdout_buf = ''
+        self.duration = 0
+        self.index = PacketIndex()
+        self.params.update({
+            '-select_streams': 'v:0',
+            '-show_entries': 'packet=pts_time,dts_time,size,pos,flags',
+            '-print_format': 'compact=p=0',
+        })
+
+    def set_duration(self, duration):
+        """
+        Set the duration of the input, used to report progress.
+        """
+        self.duration = duration
+
+    def _get_value(self, fields, key, _type):
+        try:
+            return _type(fields[key])
+        except (KeyError, ValueError):
+            return None
+
+    def _handle_line(self, line):
+        fields = {}
+        for field in line.strip().split('|'):
+            if '=' in field:
+                key, value = field.split('=', 1)
+                fields[key] = value
+        if 'size' not in fields:
+            return
+
+        pts = self._get_value(fields, 'pts_time', float)
+        self.index.add_packet(pts,
+                              self._get_value(fields, 'dts_time', float),
+                              self._get_value(fields, 'pos', float),
+                              self._get_value(fields, 'size', int) or 0,
+                              'K' in fields.get('flags', ''))
+
+        if pts is not None and self.duration > 0:
+            self.progress = min(int(pts / self.duration * 100), 99)
+
+    def _handle_output(self, stdout, stderr):
+        # Packets are added to the index instead of being stored, and only
+        # the end of stderr is kept
+        self.stderr = (self.stderr + stderr)[-self.STDERR_MAX_SIZE:]
+
+        lines = (self.stdout_buf + stdout).split('\n')
+        self.stdout_buf = lines.pop()
+        for line in lines:
+            self._handle_line(line)
+
+    def _finalize(self):
+        if self.stdout_buf:
+            self._handle_line(self.stdout_buf)
+            self.stdout_buf = ''
+
+    def get_args(self):
+        args = Worker.get_args(self)
+
+        for input_file in self.input_files:
+            args += input_file.get_args()
+
+        return args
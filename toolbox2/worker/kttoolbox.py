@@ -45,10 +45,17 @@ class KTToolboxWorker(Worker):
         def get_args(self):
             return ['-o', self.path]
 
+    line_re = re.compile('\r\n|\r|\n')
+    progress_re = re.compile('Progress: (\d+)%')
+    output_re = re.compile('output-(\w+): (.*)')
+
     def __init__(self, log, params=None):
         Worker.__init__(self, log, params)
         self.tool = 'kt-toolbox'
         self.stls = {}
+        self.stdout_buf = ''
+        self.output_callback = None
+        self.resumable = False
         self.error_lines = 4
         self.args = params.get('args', [])
         self.action = params.get('action', 'VBITOSTL')
@@ -62,21 +69,47 @@ class KTToolboxWorker(Worker):
                 self.options.append(option)
                 self.options.append(option_value)
 
-    def _handle_output(self, stdout, stderr):
-        Worker._handle_output(self, stdout, stderr)
-
-        res = re.findall('Progress: (\d+)%', self.stdout)
-        if len(res) > 0:
-            progress = int(res[-1])
+    def set_output_callback(self, callback):
+        """
+        Set a callable called as soon as kt-toolbox announces an output file,
+        while extraction of other tracks goes on.
+
+        :param callback: callback receiving the worker, the track id and the
+                         path of the output file
+        :type callback: callable(worker, _id, path)
+        """
+        self.output_callback = callback
+
+    def _handle_line(self, line):
+        match = self.progress_re.search(line)
+        if match:
+            progress = int(match.group(1))
             if progress > 99:
                 progress = 99
             self.progress = progress
 
-        res = re.findall('output-(\w+): (.*)', self.stdout)
-        for output in res:
-            _id = output[0]
-            path = output[1]
-            self.stls[_id] = path
+        match = self.output_re.search(line)
+        if match:
+            _id = match.group(1)
+            path = match.group(2).strip()
+            if _id not in self.stls:
+                self.stls[_id] = path
+                if callable(self.output_callback):
+                    self.output_callback(self, _id, path)
+
+    def _handle_output(self, stdout, stderr):
+        Worker._handle_output(self, stdout, stderr)
+
+        # Only parse complete lines of the new output
+        lines = self.line_re.split(self.stdout_buf + stdout)
+        self.stdout_buf = lines.pop()
+        for line in lines:
+            self._handle_line(line)
+
+    def _finalize(self):
+        if self.stdout_buf:
+            self._handle_line(self.stdout_buf)
+            self.stdout_buf = ''
 
     def get_args(self):
         args = []
@@ -13,38 +13,80 @@ class VideoparserWorker(Worker):
     """
     videoparser worker.
     """
+    # Longest line kept while waiting for its end
+    LINE_MAX_SIZE = 64 * 1024
+    # Size of stderr tail kept to report errors
+    STDERR_MAX_SIZE = 64 * 1024
+    # Default maximum size of the full description
+    FULL_DESC_MAX_SIZE = 1024 * 1024
+
+    field_re = re.compile('(\w+):\s+(.+)')
+    from_re = re.compile(', from.*')
+
     def __init__(self, log, params=None):
         Worker.__init__(self, log, params)
         self.stdout_buf = ''
         self.full_desc = False
+        self.full_desc_lines = []
+        self.full_desc_size = 0
+        self.full_desc_max_size = self.FULL_DESC_MAX_SIZE
         self.tool = 'videoparser'
         self.metadata = {}
+        self.resumable = False
         self.error_lines = 4
         self.memory_limit = 150 * 1024 * 1024
 
-    def _handle_output(self, stdout, stderr):
-        Worker._handle_output(self, stdout, stderr)
-        self.stdout_buf += stdout
-
-        while '\n' in self.stdout_buf:
-            line, self.stdout_buf = self.stdout_buf.split('\n', 1)
-            res = re.findall('(\w+):\s+([^\n]+)', line)
-            if not self.full_desc:
-                if len(res) > 0:
-                    if res[0][0] == 'full_desc':
-                        self.full_desc = True
-                    else:
-                        self.metadata[res[0][0]] = res[0][1]
+    def set_full_desc_max_size(self, size):
+        """
+        Set the maximum size of the full description kept in metadata,
+        following lines are dropped.
+        """
+        self.full_desc_max_size = size
 
+    def _handle_line(self, line):
+        match = self.field_re.search(line)
+        if not match:
+            return
+
+        key, value = match.groups()
+        if not self.full_desc:
+            if key == 'full_desc':
+                self.full_desc = True
+                self.full_desc_lines = []
+                self.full_desc_size = 0
+            else:
+                self.metadata[key] = value
+        else:
+            if key == 'full_desc':
+                self.full_desc = False
+                self.metadata['full_desc'] = '\n'.join(self.full_desc_lines)
+                self.full_desc_lines = []
             else:
-                if len(res) > 0:
-                    if res[0][0] == 'full_desc':
-                        self.full_desc = False
-                        self.metadata['full_desc'] = self.metadata['full_desc'].rstrip('\n')
-                    else:
-                        if 'full_desc' not in self.metadata:
-                            self.metadata['full_desc'] = ''
-                        self.metadata['full_desc'] += '%s\n' % re.sub(', from.*', '', line)
+                line = self.from_re.sub('', line)
+                self.full_desc_size += len(line) + 1
+                if self.full_desc_size <= self.full_desc_max_size:
+                    self.full_desc_lines.append(line)
+                else:
+                    self.metadata['full_desc_truncated'] = True
+
+    def _handle_output(self, stdout, stderr):
+        # stdout is parsed on the fly instead of being stored, and only the
+        # end of stderr is kept
+        self.stderr = (self.stderr + stderr)[-self.STDERR_MAX_SIZE:]
+
+        lines = (self.stdout_buf + stdout).split('\n')
+        self.stdout_buf = lines.pop()
+        if len(self.stdout_buf) > self.LINE_MAX_SIZE:
+            self.log.warning('Dropping videoparser output line longer than %d bytes', self.LINE_MAX_SIZE)
+            self.stdout_buf = ''
+
+        for line in lines:
+            self._handle_line(line)
+
+    def _finalize(self):
+        if self.stdout_buf:
+            self._handle_line(self.stdout_buf)
+            self.stdout_buf = ''
 
     def get_args(self):
         args = Worker.get_args(self)
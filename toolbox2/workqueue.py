@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from toolbox2 import Loader
+from toolbox2.action import get_config
+from toolbox2.batch import run_job
+from toolbox2.exception import Toolbox2Exception
+
+WORKQUEUE_DEFAULT_LEASE_TIME = 60
+WORKQUEUE_DEFAULT_MAX_ATTEMPTS = 3
+WORKQUEUE_DEFAULT_POLL_INTERVAL = 5
+
+WORKQUEUE_STATUSES = ['queued', 'running', 'done', 'error']
+
+
+class WorkQueueException(Toolbox2Exception):
+    pass
+
+
+class WorkQueue(object):
+    """
+    Queue of jobs shared by the nodes of a cluster through a SQLite database
+    on shared storage. The filesystem must support POSIX locks, and node
+    clocks must be synchronized, as leases expire at a wall clock time.
+
+    A node claims the oldest queued job with a lease, which it renews by
+    heartbeats while the job runs. Leases of nodes which have died or lost
+    the storage expire, and their jobs are queued again, up to max_attempts
+    runs. Results are only accepted from the current lease holder.
+    """
+
+    columns = [
+        ('id', 'INTEGER PRIMARY KEY AUTOINCREMENT'),
+        ('job_id', 'TEXT'),
+        ('job', 'TEXT'),
+        ('status', 'TEXT'),
+        ('attempts', 'INTEGER'),
+        ('max_attempts', 'INTEGER'),
+        ('node', 'TEXT'),
+        ('lease', 'TEXT'),
+        ('lease_expires', 'REAL'),
+        ('result', 'TEXT'),
+        ('created_at', 'REAL'),
+        ('started_at', 'REAL'),
+        ('finished_at', 'REAL'),
+    ]
+
+    def __init__(self, path, lease_time=WORKQUEUE_DEFAULT_LEASE_TIME):
+        """
+        :param path: path of the database file
+        :type path: string
+
+        :param lease_time: seconds a lease lasts without heartbeat
+        :type lease_time: float
+        """
+        if lease_time <= 0:
+            raise WorkQueueException('Lease time must be positive')
+
+        self.path = path
+        self.lease_time = lease_time
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs (%s)' % ', '.join(['%s %s' % column for column in self.columns]))
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+
+    def _connect(self):
+        # Transactions are started explicitly, see _transaction
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _transaction(self):
+        return _Transaction(self._connect())
+
+    def submit(self, job, max_attempts=WORKQUEUE_DEFAULT_MAX_ATTEMPTS):
+        """
+        Queue a job and return its number in the queue.
+
+        :param job: action, params and resources of the job, and optional id
+        :type job: dict
+
+        :param max_attempts: number of times the job is run before giving up
+                             on expired leases
+        :type max_attempts: int
+
+        :rtype: int
+        """
+        if not isinstance(job, dict) or 'action' not in job:
+            raise WorkQueueException('Job must be a JSON object with an action')
+        if max_attempts < 1:
+            raise WorkQueueException('Max attempts must be at least 1')
+
+        with self._transaction() as conn:
+            cursor = conn.execute('INSERT INTO jobs (job_id, job, status, attempts, max_attempts, created_at) '
+                                  'VALUES (?, ?, ?, 0, ?, ?)',
+                                  (job.get('id') is not None and str(job['id']) or None, json.dumps(job),
+                                   'queued', max_attempts, time.time()))
+            return cursor.lastrowid
+
+    def _expire_leases(self, conn, now):
+        """
+        Queue again jobs whose lease has expired, or fail them once they
+        have been run max_attempts times.
+        """
+        error = json.dumps({'status': 'error', 'error': 'Lease expired, giving up'})
+        conn.execute("UPDATE jobs SET status = 'error', result = ?, finished_at = ?, lease = NULL "
+                     "WHERE status = 'running' AND lease_expires < ? AND attempts >= max_attempts",
+                     (error, now, now))
+        conn.execute("UPDATE jobs SET status = 'queued', node = NULL, lease = NULL "
+                     "WHERE status = 'running' AND lease_expires < ?", (now,))
+
+    def claim(self, node):
+        """
+        Lease the oldest queued job to a node.
+
+        :param node: name of the node, reported in job status
+        :type node: string
+
+        :return: number, lease and description of the job, or None if no job
+                 is queued
+        :rtype: dict
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire_leases(conn, now)
+            row = conn.execute("SELECT id, job FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+
+            lease = uuid.uuid4().hex
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, node = ?, lease = ?, "
+                         "lease_expires = ?, started_at = ? WHERE id = ?",
+                         (node, lease, now + self.lease_time, now, row[0]))
+            return {'number': row[0], 'lease': lease, 'job': json.loads(row[1])}
+
+    def heartbeat(self, number, lease):
+        """
+        Renew the lease of a running job.
+
+        :return: False if the lease has been lost
+        :rtype: bool
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease = ? AND status = 'running'",
+                                  (time.time() + self.lease_time, number, lease))
+            return cursor.rowcount == 1
+
+    def complete(self, number, lease, result):
+        """
+        Store the result of a job, see toolbox2.batch.run_job.
+
+        :return: False if the lease has been lost, the result is then
+                 discarded
+        :rtype: bool
+        """
+        status = result.get('status') == 'done' and 'done' or 'error'
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = ?, result = ?, finished_at = ?, lease = NULL "
+                                  "WHERE id = ? AND lease = ? AND status = 'running'",
+                                  (status, json.dumps(result, default=str), time.time(), number, lease))
+            return cursor.rowcount == 1
+
+    def get(self, number):
+        """
+        Return the status of a job, with its result once it is done, or None
+        if it does not exist.
+
+        :rtype: dict
+        """
+        with self._transaction() as conn:
+            row = conn.execute('SELECT job_id, status, attempts, node, result FROM jobs WHERE id = ?',
+                               (number,)).fetchone()
+        if row is None:
+            return None
+        job_id, status, attempts, node, result = row
+        info = {'number': number, 'id': job_id or str(number), 'status': status, 'attempts': attempts, 'node': node}
+        if result:
+            info['result'] = json.loads(result)
+        return info
+
+    def get_status(self):
+        """
+        Return the number of jobs of each status.
+
+        :rtype: dict
+        """
+        status = dict([(name, 0) for name in WORKQUEUE_STATUSES])
+        with self._transaction() as conn:
+            for name, count in conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'):
+                status[name] = count
+        return status
+
+    def purge(self, before):
+        """
+        Remove jobs done or failed before a given time.
+
+        :param before: timestamp
+        :type before: float
+
+        :return: number of removed jobs
+        :rtype: int
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute("DELETE FROM jobs WHERE status IN ('done', 'error') AND finished_at < ?", (before,))
+            return cursor.rowcount
+
+
+class _Transaction(object):
+    """
+    Write transaction on a connection, taking the database lock up front so
+    that concurrent claims are serialized. The connection is closed on
+    exit, as connections can not be shared between threads.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.conn.execute('COMMIT')
+            else:
+                self.conn.execute('ROLLBACK')
+        finally:
+            self.conn.close()
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Renew the lease of a running job until stopped.
+    """
+
+    def __init__(self, log, queue, number, lease, interval):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.log = log
+        self.queue = queue
+        self.number = number
+        self.lease = lease
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.isSet():
+                return
+            try:
+                if not self.queue.heartbeat(self.number, self.lease):
+                    self.log.warning('Lease of job #%s lost, its result will be discarded', self.number)
+                    self.lost = True
+                    return
+            except sqlite3.Error, exc:
+                # The lease expires if the storage stays unavailable
+                self.log.warning('Heartbeat of job #%s failed: %s', self.number, exc)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class QueueWorker(object):
+    """
+    Run jobs claimed from a work queue with bounded concurrency, until
+    stopped. Each thread claims a job only once it is free, so that idle
+    nodes take the next jobs and the cluster throughput grows with the
+    number of nodes.
+    """
+
+    def __init__(self, log, queue, base_dir, node=None, concurrency=1,
+                 poll_interval=WORKQUEUE_DEFAULT_POLL_INTERVAL):
+        """
+        :param log: logger instance to use
+        :type log: logging.Logger
+
+        :param queue: work queue jobs are claimed from
+        :type queue: toolbox2.workqueue.WorkQueue
+
+        :param base_dir: default working base directory of actions
+        :type base_dir: string
+
+        :param node: name of the node, defaults to its hostname
+        :type node: string
+
+        :param concurrency: number of jobs run at the same time
+        :type concurrency: int
+
+        :param poll_interval: seconds between claims while the queue is empty
+        :type poll_interval: float
+        """
+        if concurrency < 1:
+            raise WorkQueueException('Concurrency must be at least 1')
+
+        self.log = log
+        self.queue = queue
+        self.base_dir = base_dir
+        self.node = node or socket.gethostname()
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        self.prefix = '%.6f' % time.time()
+
+        Loader()
+        try:
+            get_config()
+        except (Exception, IOError), exc:
+            self.log.warning('%s', exc)
+
+    def run_next(self):
+        """
+        Claim and run a single job.
+
+        :return: False if no job is queued
+        :rtype: bool
+        """
+        item = self.queue.claim(self.node)
+        if item is None:
+            return False
+
+        number, lease, job = item['number'], item['lease'], item['job']
+        heartbeat = _Heartbeat(self.log, self.queue, number, lease, self.queue.lease_time / 3.0)
+        heartbeat.start()
+        try:
+            self.log.info('Running job #%s (action = %s)', number, job.get('action'))
+            result = run_job(self.log, self.base_dir, '%s-%s' % (self.prefix, number), job)
+        finally:
+            heartbeat.stop()
+
+        result.update(id=job.get('id') is not None and str(job['id']) or str(number), node=self.node)
+        if heartbeat.lost or not self.queue.complete(number, lease, result):
+            self.log.warning('Result of job #%s discarded, its lease has expired', number)
+        return True
+
+    def _run_thread(self):
+        while not self.stopped.isSet():
+            try:
+                if self.run_next():
+                    continue
+            except sqlite3.Error, exc:
+                self.log.warning('Work queue unavailable: %s', exc)
+            self.stopped.wait(self.poll_interval)
+
+    def serve_forever(self):
+        """
+        Run jobs until stop is called or the process is interrupted. Running
+        jobs are completed before returning, jobs of a node killed meanwhile
+        are run again by other nodes once their lease expires.
+        """
+        self.log.info('Running jobs of %s (node = %s, concurrency = %d)', self.queue.path, self.node, self.concurrency)
+        threads = []
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self._run_thread)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        try:
+            # Join with a timeout, so that signals are handled
+            while [thread for thread in threads if thread.isAlive()]:
+                for thread in threads:
+                    thread.join(1)
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def wait_results(queue, numbers, poll_interval=1):
+    """
+    Yield the status of jobs of a queue as they finish, in completion order.
+
+    :param numbers: numbers returned by WorkQueue.submit
+    :type numbers: list
+
+    :rtype: generator of dict
+    """
+    pending = list(numbers)
+    while pending:
+        for number in list(pending):
+            info = queue.get(number)
+            if info is None or info['status'] in ['done', 'error']:
+                pending.remove(number)
+                yield info or {'number': number, 'status': 'error'}
+        if pending:
+            time.sleep(poll_interval)